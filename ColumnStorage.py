@@ -0,0 +1,301 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+#number of rows that is read at once when a whole out-of-core dataset has to be processed (e.g. encoded or hashed)
+DEFAULT_CHUNK_SIZE = 100000
+
+
+#The storages below hold the descriptive data of a Dataset. They all read data by column and by row positions, so that
+#a Dataset (or a view on it) only loads the columns and rows it needs. Text columns are always handed out as
+#pandas categoricals, whose categories (the vocabulary) are the same for every read of the same column.
+
+#Data that is already in memory
+class DataFrameStorage:
+    in_memory = True
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def columns(self):
+        return list(self.data.columns)
+
+    @property
+    def n_rows(self):
+        return len(self.data)
+
+    def read_rows(self, row_indices=None, columns=None):
+        data = self.data if columns is None else self.data[columns]
+        if row_indices is None:
+            return data
+        return data.iloc[row_indices].reset_index(drop=True)
+
+    def read_column(self, column, row_indices=None):
+        return self.read_rows(row_indices, [column])[column]
+
+    def read_codes(self, column, row_indices=None):
+        codes = self.data[column].cat.codes.to_numpy()
+        if row_indices is None:
+            return codes
+        return codes[row_indices]
+
+    def is_categorical(self, column):
+        return self.data[column].dtype.name == 'category'
+
+    def get_vocabulary(self, column):
+        return list(self.data[column].cat.categories)
+
+    #the data from which an encoder can learn the encoding schema
+    def get_schema_data(self):
+        return self.data
+
+
+#Base class for the storages that stay on disk
+class OutOfCoreStorage:
+    in_memory = False
+
+    def read_rows(self, row_indices=None, columns=None):
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame({column: self.read_column(column, row_indices) for column in columns}, columns=columns)
+
+    def read_column(self, column, row_indices=None):
+        values = self.read_values(column, row_indices)
+        if not self.is_categorical(column):
+            return pd.Series(values, name=column)
+        codes = self.get_codes_from_values(column, values)
+        return pd.Series(pd.Categorical.from_codes(codes, categories=self.get_vocabulary(column)), name=column)
+
+    def read_codes(self, column, row_indices=None):
+        return self.get_codes_from_values(column, self.read_values(column, row_indices))
+
+    #a zero row frame with the full vocabulary of every text column as categories, which is all an encoder needs
+    def get_schema_data(self):
+        schema_data = {}
+        for column in self.columns:
+            if self.is_categorical(column):
+                schema_data[column] = pd.Categorical([], categories=self.get_vocabulary(column))
+            else:
+                schema_data[column] = np.array([], dtype=self.get_dtype(column))
+        return pd.DataFrame(schema_data, columns=self.columns)
+
+
+#A directory with one .npy file per column, which is memory-mapped when it is read. Text columns are stored as
+#integer codes, their vocabularies are stored in schema.json
+class MemmapStorage(OutOfCoreStorage):
+    SCHEMA_FILE = 'schema.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, self.SCHEMA_FILE)) as schema_file:
+            schema = json.load(schema_file)
+        self.n_rows = schema['n_rows']
+        self.column_schemas = {column_schema['name']: column_schema for column_schema in schema['columns']}
+        self.columns = [column_schema['name'] for column_schema in schema['columns']]
+        self.arrays = {}
+
+    #writes a DataFrame in chunks of rows, so only one chunk needs to be converted to codes at a time
+    @staticmethod
+    def write(data, directory, chunk_size=DEFAULT_CHUNK_SIZE):
+        data = data.astype({column: 'category' for column in data.columns if data[column].dtype == object})
+        if len(data) == 0:
+            return MemmapStorage.write_chunks([data], 0, directory)
+        data_chunks = (data.iloc[start:end] for start, end in iterate_over_row_chunks(len(data), chunk_size))
+        return MemmapStorage.write_chunks(data_chunks, len(data), directory)
+
+    #writes data that comes in chunks of rows (DataFrames with the same columns), e.g. data that is generated chunk by
+    #chunk and doesn't fit in memory as a whole. The categorical columns need the same categories in every chunk
+    @staticmethod
+    def write_chunks(data_chunks, n_rows, directory):
+        os.makedirs(directory, exist_ok=True)
+        column_schemas = None
+        start = 0
+        for chunk in data_chunks:
+            if column_schemas is None:
+                column_schemas, arrays = [], []
+                for position, column in enumerate(chunk.columns):
+                    values = chunk[column]
+                    vocabulary = None
+                    if values.dtype.name == 'category':
+                        vocabulary = [to_json_value(value) for value in values.cat.categories]
+                        values = values.cat.codes
+                    dtype = values.to_numpy()[:0].dtype
+                    file_name = f"column_{position}.npy"
+                    arrays.append(np.lib.format.open_memmap(os.path.join(directory, file_name), mode='w+', dtype=dtype, shape=(n_rows,)))
+                    column_schemas.append({'name': column, 'file': file_name, 'vocabulary': vocabulary, 'dtype': dtype.str})
+
+            for array, column_schema in zip(arrays, column_schemas):
+                values = chunk[column_schema['name']]
+                if column_schema['vocabulary'] is not None:
+                    if [to_json_value(value) for value in values.cat.categories] != column_schema['vocabulary']:
+                        raise ValueError(f"The categories of column {column_schema['name']} differ between the chunks")
+                    values = values.cat.codes
+                array[start:start + len(chunk)] = values.to_numpy()
+            start += len(chunk)
+        if start != n_rows:
+            raise ValueError(f"The chunks hold {start} rows instead of {n_rows}")
+
+        for array in arrays:
+            array.flush()
+        del arrays
+        with open(os.path.join(directory, MemmapStorage.SCHEMA_FILE), 'w') as schema_file:
+            json.dump({'n_rows': n_rows, 'columns': column_schemas}, schema_file)
+        return MemmapStorage(directory)
+
+    def get_array(self, column):
+        if column not in self.arrays:
+            file_path = os.path.join(self.directory, self.column_schemas[column]['file'])
+            self.arrays[column] = np.load(file_path, mmap_mode='r')
+        return self.arrays[column]
+
+    def read_values(self, column, row_indices=None):
+        array = self.get_array(column)
+        if row_indices is None:
+            return np.array(array)
+        return array[row_indices]
+
+    def is_categorical(self, column):
+        return self.column_schemas[column]['vocabulary'] is not None
+
+    def get_codes_from_values(self, column, values):
+        return values
+
+    def get_vocabulary(self, column):
+        return list(self.column_schemas[column]['vocabulary'])
+
+    def get_dtype(self, column):
+        return np.dtype(self.column_schemas[column]['dtype'])
+
+    #the memory maps can't be pickled, they are reopened after unpickling
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+
+#Base class for Arrow based files (Parquet, Arrow IPC), which consist of batches of rows that can be read per column.
+#The vocabulary of a text column is collected by reading that column batch by batch
+class RecordBatchStorage(OutOfCoreStorage):
+    def initialize_batches(self, schema, batch_row_counts):
+        self.schema = schema
+        self.columns = list(schema.names)
+        self.batch_starts = np.concatenate([[0], np.cumsum(batch_row_counts)]).astype(np.int64)
+        self.n_rows = int(self.batch_starts[-1])
+        self.vocabularies = {}
+        self.code_lookups = {}
+
+    def read_values(self, column, row_indices=None):
+        if row_indices is None:
+            return np.concatenate([self.read_batch_column(batch, column) for batch in range(len(self.batch_starts) - 1)])
+
+        row_indices = np.asarray(row_indices, dtype=np.int64)
+        batch_of_rows = np.searchsorted(self.batch_starts, row_indices, side='right') - 1
+        values = None
+        for batch in np.unique(batch_of_rows):
+            rows_in_batch = np.flatnonzero(batch_of_rows == batch)
+            batch_values = self.read_batch_column(batch, column)[row_indices[rows_in_batch] - self.batch_starts[batch]]
+            if values is None:
+                values = np.empty(len(row_indices), dtype=batch_values.dtype)
+            values[rows_in_batch] = batch_values
+        if values is None:
+            values = np.array([], dtype=self.get_dtype(column))
+        return values
+
+    def read_batch_column(self, batch, column):
+        return self.read_batch(batch, column).to_numpy(zero_copy_only=False)
+
+    def is_categorical(self, column):
+        return self.get_dtype(column) == object
+
+    def get_dtype(self, column):
+        return np.dtype(self.schema.field(column).type.to_pandas_dtype())
+
+    def get_vocabulary(self, column):
+        if column not in self.vocabularies:
+            unique_values = set()
+            for batch in range(len(self.batch_starts) - 1):
+                unique_values.update(pd.unique(self.read_batch_column(batch, column)))
+            self.vocabularies[column] = sorted(value for value in unique_values if not pd.isnull(value))
+        return self.vocabularies[column]
+
+    def get_codes_from_values(self, column, values):
+        return pd.Categorical(values, categories=self.get_vocabulary(column)).codes
+
+
+class ParquetStorage(RecordBatchStorage):
+    def __init__(self, path):
+        self.path = path
+        self.open()
+
+    def open(self):
+        pq = import_pyarrow_module('pyarrow.parquet')
+        self.parquet_file = pq.ParquetFile(self.path, memory_map=True)
+        metadata = self.parquet_file.metadata
+        self.initialize_batches(self.parquet_file.schema_arrow,
+                                [metadata.row_group(row_group).num_rows for row_group in range(metadata.num_row_groups)])
+
+    def read_batch(self, batch, column):
+        return self.parquet_file.read_row_group(int(batch), columns=[column]).column(0)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.open()
+
+
+class ArrowIPCStorage(RecordBatchStorage):
+    def __init__(self, path):
+        self.path = path
+        self.open()
+
+    def open(self):
+        pa = import_pyarrow_module('pyarrow')
+        self.reader = pa.ipc.open_file(pa.memory_map(self.path, 'r'))
+        self.initialize_batches(self.reader.schema,
+                                [self.reader.get_batch(batch).num_rows for batch in range(self.reader.num_record_batches)])
+
+    def read_batch(self, batch, column):
+        return self.reader.get_batch(int(batch)).column(column)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.open()
+
+
+#pyarrow is only needed for the Parquet and Arrow IPC storages, so it is only imported when they are used
+def import_pyarrow_module(module_name):
+    try:
+        import importlib
+        return importlib.import_module(module_name)
+    except ImportError as error:
+        raise ImportError("Reading Parquet or Arrow IPC files requires pyarrow, install it with 'pip install pyarrow'") from error
+
+
+def to_json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def iterate_over_row_chunks(n_rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    for start in range(0, n_rows, chunk_size):
+        yield start, min(start + chunk_size, n_rows)
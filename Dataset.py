@@ -11,15 +11,39 @@
 # limitations under the License.
 
 
-from sklearn.model_selection import train_test_split
+from DatasetEncoder import DatasetEncoder
+from ColumnStorage import DataFrameStorage, iterate_over_row_chunks
 import random
+import hashlib
 import pandas as pd
-from copy import deepcopy
+import numpy as np
 random.seed(4)
 
 class Dataset:
-    def __init__(self, descriptive_data, ordinal_to_numeric_dicts, decision_attribute, undesirable_label, desirable_label, sensitive_attributes, reference_group_list, categorical_features, distance_function, one_hot_encoded_data = None):
-        self.descriptive_data = descriptive_data
+    #descriptive_data is either a DataFrame or one of the storages of ColumnStorage (e.g. a ParquetStorage or
+    #MemmapStorage), in which case the data stays on disk and only the columns and rows that are used are read
+    def __init__(self, descriptive_data, ordinal_to_numeric_dicts, decision_attribute, undesirable_label, desirable_label, sensitive_attributes, reference_group_list, categorical_features, distance_function, one_hot_encoded_data = None, row_indices = None, feature_matrices = None):
+        #text columns are stored as integer codes + a vocabulary per column, so that filtering on attribute values
+        #compares integers instead of strings
+        if isinstance(descriptive_data, pd.DataFrame):
+            descriptive_data = DataFrameStorage(convert_text_columns_to_categorical(descriptive_data))
+        self.storage = descriptive_data
+        self.shared_one_hot_encoded_data = one_hot_encoded_data
+        #a dataset with row_indices is a view on the rows of the shared data (e.g. the result of a split),
+        #its own data is only copied out of the shared data when it is accessed for the first time
+        self.row_indices = row_indices
+        self.materialized_descriptive_data = None
+        self.materialized_one_hot_encoded_data = None
+        self.materialized_binary_labels = None
+        #(encoder, feature matrix) of the last encoder that was used on this dataset
+        self.encoded_feature_matrix = None
+        #precomputed feature matrices of all rows of the storage (e.g. loaded from a cache), per encoder schema
+        self.shared_feature_matrices = {} if feature_matrices is None else feature_matrices
+        if row_indices is None:
+            if self.storage.in_memory:
+                self.materialized_descriptive_data = self.storage.read_rows()
+            self.materialized_one_hot_encoded_data = one_hot_encoded_data
+
         self.ordinal_to_numeric_dicts = ordinal_to_numeric_dicts
         self.decision_attribute = decision_attribute
         self.undesirable_label = undesirable_label
@@ -28,15 +52,127 @@ class Dataset:
         self.reference_group_list = reference_group_list
         self.categorical_features = categorical_features
         self.distance_function = distance_function
-        self.binary_labels = self.decision_attribute_to_binary_array()
         self.predictions = None
         self.prediction_probabilities = None
 
-        if one_hot_encoded_data is None:
-            self.one_hot_encoded_data = self.one_hot_encode_data()
+    @property
+    def descriptive_data(self):
+        if self.materialized_descriptive_data is None:
+            self.materialized_descriptive_data = self.storage.read_rows(self.row_indices)
+        return self.materialized_descriptive_data
+
+    #replacing the descriptive data turns a view into a dataset of its own
+    @descriptive_data.setter
+    def descriptive_data(self, descriptive_data):
+        self.storage = DataFrameStorage(convert_text_columns_to_categorical(descriptive_data))
+        self.shared_one_hot_encoded_data = None
+        self.row_indices = None
+        self.materialized_descriptive_data = self.storage.read_rows()
+        self.materialized_one_hot_encoded_data = None
+        self.materialized_binary_labels = None
+        self.encoded_feature_matrix = None
+        self.shared_feature_matrices = {}
+
+    @property
+    def one_hot_encoded_data(self):
+        if self.materialized_one_hot_encoded_data is None:
+            if self.shared_one_hot_encoded_data is not None:
+                self.materialized_one_hot_encoded_data = self.shared_one_hot_encoded_data.iloc[self.row_indices].reset_index(drop=True)
+            else:
+                #the categories of every column are shared by all views, so encoding only the rows of this view
+                #gives exactly the same columns as encoding all data
+                self.materialized_one_hot_encoded_data = self.one_hot_encode_data()
+        return self.materialized_one_hot_encoded_data
+
+    @one_hot_encoded_data.setter
+    def one_hot_encoded_data(self, one_hot_encoded_data):
+        self.materialized_one_hot_encoded_data = one_hot_encoded_data
+
+    #unlabeled data, e.g. data that needs to be scored in production, has no binary labels
+    @property
+    def binary_labels(self):
+        if self.materialized_binary_labels is None and self.has_ground_truth():
+            self.materialized_binary_labels = self.decision_attribute_to_binary_array()
+        return self.materialized_binary_labels
+
+    #all data of the storage, for datasets that are views or are kept on disk this reads everything into memory
+    @property
+    def shared_descriptive_data(self):
+        return self.storage.read_rows()
+
+    def __len__(self):
+        if self.row_indices is None:
+            return self.storage.n_rows
+        return len(self.row_indices)
+
+    def has_ground_truth(self):
+        return self.decision_attribute in self.storage.columns
+
+    #reads a single column, without loading the other columns of a dataset that is kept on disk
+    def get_column(self, column):
+        if self.materialized_descriptive_data is not None:
+            return self.materialized_descriptive_data[column]
+        return self.storage.read_column(column, self.row_indices)
+
+    #yields the descriptive data in chunks of rows, so that data that doesn't fit in memory can be processed piece by piece
+    def iterate_over_descriptive_data_chunks(self, chunk_size=None):
+        if self.materialized_descriptive_data is not None:
+            yield self.materialized_descriptive_data
+            return
+
+        chunk_arguments = () if chunk_size is None else (chunk_size,)
+        for start, end in iterate_over_row_chunks(len(self), *chunk_arguments):
+            if self.row_indices is None:
+                yield self.storage.read_rows(np.arange(start, end))
+            else:
+                yield self.storage.read_rows(self.row_indices[start:end])
+
+    #creates a dataset for new (possibly unlabeled) data, which is described in the same way as this dataset
+    def create_dataset_from_descriptive_data(self, descriptive_data):
+        return Dataset(descriptive_data, self.ordinal_to_numeric_dicts, self.decision_attribute, self.undesirable_label,
+                       self.desirable_label, self.sensitive_attributes, self.reference_group_list,
+                       self.categorical_features, self.distance_function)
+
+    #row_indices are positions within this dataset, the view points directly to the shared data (views of views don't nest)
+    def create_view(self, row_indices):
+        row_indices = np.asarray(row_indices)
+        if self.row_indices is not None:
+            row_indices = self.row_indices[row_indices]
+        return Dataset(self.storage, self.ordinal_to_numeric_dicts, self.decision_attribute, self.undesirable_label,
+                       self.desirable_label, self.sensitive_attributes, self.reference_group_list,
+                       self.categorical_features, self.distance_function,
+                       one_hot_encoded_data=self.shared_one_hot_encoded_data, row_indices=row_indices,
+                       feature_matrices=self.shared_feature_matrices)
+
+    #the vocabularies are taken from the shared data, so every view of the same data gets the same encoding schema
+    def fit_encoder(self, sparse=False, one_hot=True):
+        return DatasetEncoder(self.ordinal_to_numeric_dicts, self.categorical_features, self.decision_attribute,
+                              sparse=sparse, one_hot=one_hot).fit(self.storage.get_schema_data())
+
+    #the encoded features (without the decision attribute) as a NumPy or scipy.sparse CSR matrix, depending on the encoder.
+    #The matrix is kept, so encoding the same dataset again with the same encoder doesn't cost anything
+    def get_feature_matrix(self, encoder):
+        encoded_feature_matrix = self.encoded_feature_matrix
+        if encoded_feature_matrix is not None and encoded_feature_matrix[0] is encoder:
+            return encoded_feature_matrix[1]
+
+        shared_feature_matrix = self.shared_feature_matrices.get(encoder.schema_fingerprint)
+        if shared_feature_matrix is not None:
+            feature_matrix = shared_feature_matrix if self.row_indices is None else shared_feature_matrix[self.row_indices]
+        elif self.materialized_descriptive_data is not None or self.storage.in_memory:
+            feature_matrix = encoder.transform(self.descriptive_data)
         else:
-            self.one_hot_encoded_data = one_hot_encoded_data
+            feature_matrix = encoder.transform_chunks(self.iterate_over_descriptive_data_chunks(), len(self))
+        self.encoded_feature_matrix = (encoder, feature_matrix)
+        return feature_matrix
 
+    #drops the kept feature matrix, for datasets that live as long as a model but are only encoded once
+    def release_feature_matrix(self):
+        self.encoded_feature_matrix = None
+
+    #feature_matrix holds the encoded features of all rows of the storage, it is shared with all views on this dataset
+    def set_shared_feature_matrix(self, encoder, feature_matrix):
+        self.shared_feature_matrices[encoder.schema_fingerprint] = feature_matrix
 
     def set_predictions(self, predictions):
         self.predictions = predictions
@@ -50,73 +186,111 @@ class Dataset:
     def get_prediction_probabilities(self):
         return self.prediction_probabilities
 
+    def get_vocabulary(self, column):
+        return self.storage.get_vocabulary(column)
+
+    def get_codes(self, column):
+        return self.storage.read_codes(column, self.row_indices)
+
     def __str__(self):
         return (self.descriptive_data.head(10).to_string())
 
+    #content hash of the data and the information describing it, equal datasets give equal fingerprints across runs
+    def compute_fingerprint(self):
+        hasher = hashlib.sha256()
+        for descriptive_data_chunk in self.iterate_over_descriptive_data_chunks():
+            hasher.update(pd.util.hash_pandas_object(descriptive_data_chunk, index=False).values.tobytes())
+        hasher.update(self.describe_metadata().encode())
+        return hasher.hexdigest()
+
+    #everything that describes the data, apart from the data itself
+    def describe_metadata(self):
+        return repr((self.storage.columns, self.ordinal_to_numeric_dicts, self.decision_attribute,
+                     self.undesirable_label, self.desirable_label, self.sensitive_attributes,
+                     self.reference_group_list, self.categorical_features))
+
+    #the feature matrices are only kept to avoid encoding again, they are left out when a dataset is pickled (e.g. as
+    #part of a model or a stage cache entry) and are encoded again when needed
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['encoded_feature_matrix'] = None
+        state['shared_feature_matrices'] = {}
+        return state
+
 
     def decision_attribute_to_binary_array(self):
-        decision_labels = self.descriptive_data[self.decision_attribute]
-        binary_decision_labels = []
-        for label in decision_labels:
-            if label == self.desirable_label:
-                binary_decision_labels.append(1)
-            else:
-                binary_decision_labels.append(0)
+        decision_labels = self.get_column(self.decision_attribute)
+        binary_decision_labels = (decision_labels == self.desirable_label).to_numpy().astype(int)
         return pd.Series(binary_decision_labels)
 
+    #The same frame as pd.get_dummies(..., columns=categorical_features) would give, but built from the shared codes and
+    #vocabularies of the storage: every one-hot column compares the integer codes with the code of its category
     def one_hot_encode_data(self):
-        numerical_data = deepcopy(self.descriptive_data)
-        for column, conversion_dict in self.ordinal_to_numeric_dicts.items():
-            numerical_data[column] = numerical_data[column].replace(conversion_dict)
-
-        df_encoded = pd.get_dummies(numerical_data, columns=self.categorical_features)
-        return df_encoded
+        index = self.materialized_descriptive_data.index if self.materialized_descriptive_data is not None else pd.RangeIndex(len(self))
+        encoded_columns = {}
+        for column in self.storage.columns:
+            if column in self.categorical_features:
+                continue
+            values = self.get_column(column)
+            if column in self.ordinal_to_numeric_dicts:
+                values = convert_ordinal_column_to_numeric(values, self.ordinal_to_numeric_dicts[column])
+            encoded_columns[column] = values.array
+
+        for column in self.categorical_features:
+            if self.storage.is_categorical(column):
+                codes, vocabulary = self.get_codes(column), self.get_vocabulary(column)
+            else:
+                categorical_values = pd.Categorical(self.get_column(column))
+                codes, vocabulary = categorical_values.codes, categorical_values.categories
+            for code, value in enumerate(vocabulary):
+                encoded_columns[f"{column}_{value}"] = (codes == code).astype(np.uint8)
+        return pd.DataFrame(encoded_columns, index=index)
 
 
-    def split_into_multiple_test_sets(self, number_of_test_sets):
+    def split_into_multiple_test_sets(self, number_of_test_sets, random_state=4):
         list_of_test_sets = []
-        size_of_each_set = len(self.descriptive_data) // number_of_test_sets
-        remaining_des_data = deepcopy(self.descriptive_data)
-        remaining_one_hot_data = deepcopy(self.one_hot_encoded_data)
+        size_of_each_set = len(self) // number_of_test_sets
+        remaining_dataset = self
         for i in range(number_of_test_sets-1):
-            remaining_des_data, desc_data_test, remaining_one_hot_data, one_hot_data_test = train_test_split(
-                remaining_des_data, remaining_one_hot_data, test_size=size_of_each_set,
-                random_state=4)
+            remaining_dataset, dataset_test = remaining_dataset.split_into_train_test(size_of_each_set, random_state=random_state)
+            list_of_test_sets.append(dataset_test)
 
-            desc_data_test = desc_data_test.reset_index(drop=True)
-            one_hot_data_test = one_hot_data_test.reset_index(drop=True)
+        list_of_test_sets.append(remaining_dataset)
+        return list_of_test_sets
 
-            dataset_test = Dataset(desc_data_test, self.ordinal_to_numeric_dicts, self.decision_attribute, self.undesirable_label,
-                                   self.desirable_label, self.categorical_features, self.distance_function,
-                                   one_hot_encoded_data=one_hot_data_test)
-            list_of_test_sets.append(dataset_test)
+    #train_size rows are used for training, the remaining rows are divided over number_of_test_sets test sets
+    def split_into_train_and_multiple_test_sets(self, train_size, number_of_test_sets, random_state=4):
+        from sklearn.model_selection import train_test_split
+        train_indices, test_indices = train_test_split(np.arange(len(self)), train_size=train_size, random_state=random_state)
+        test_data = self.create_view(test_indices)
+        return self.create_view(train_indices), test_data.split_into_multiple_test_sets(number_of_test_sets, random_state=random_state)
 
-        remaining_des_data = remaining_des_data.reset_index(drop=True)
-        remaining_one_hot_data = remaining_one_hot_data.reset_index(drop=True)
 
-        final_dataset = Dataset(remaining_des_data, self.ordinal_to_numeric_dicts, self.decision_attribute, self.undesirable_label,
-                                self.desirable_label, self.categorical_features, self.distance_function,
-                                one_hot_encoded_data=remaining_one_hot_data)
-        list_of_test_sets.append(final_dataset)
+    #the splits are views on the data of this dataset, no data is copied
+    def split_into_train_test(self, test_fraction, random_state=4):
+        from sklearn.model_selection import train_test_split
+        train_indices, test_indices = train_test_split(np.arange(len(self)), test_size=test_fraction, random_state=random_state)
+        return self.create_view(train_indices), self.create_view(test_indices)
 
-        return list_of_test_sets
 
+def convert_text_columns_to_categorical(descriptive_data):
+    text_columns = [column for column in descriptive_data.columns if descriptive_data[column].dtype == object]
+    if len(text_columns) == 0:
+        return descriptive_data
+    return descriptive_data.astype({column: 'category' for column in text_columns})
 
-    def split_into_train_test(self, test_fraction):
-        desc_data_train, desc_data_test, one_hot_data_train, one_hot_data_test = train_test_split(self.descriptive_data, self.one_hot_encoded_data, test_size=test_fraction, random_state=4)
-        desc_data_train = desc_data_train.reset_index(drop=True)
-        desc_data_test = desc_data_test.reset_index(drop=True)
-        one_hot_data_train = one_hot_data_train.reset_index(drop=True)
-        one_hot_data_test = one_hot_data_test.reset_index(drop=True)
 
-        dataset_train = Dataset(desc_data_train, self.ordinal_to_numeric_dicts, self.decision_attribute, self.undesirable_label,
-                                self.desirable_label, self.sensitive_attributes, self.reference_group_list, self.categorical_features, self.distance_function,
-                                one_hot_encoded_data=one_hot_data_train)
-        dataset_test = Dataset(desc_data_test, self.ordinal_to_numeric_dicts, self.decision_attribute, self.undesirable_label,
-                               self.desirable_label, self.sensitive_attributes, self.reference_group_list, self.categorical_features, self.distance_function,
-                               one_hot_encoded_data=one_hot_data_test)
+#only the vocabulary of the column is converted, the codes then pick the numeric value of every row
+def convert_ordinal_column_to_numeric(column, conversion_dict):
+    if column.dtype.name != 'category':
+        return column.replace(conversion_dict)
 
-        return dataset_train, dataset_test
+    numeric_vocabulary = pd.Series(column.cat.categories).replace(conversion_dict).infer_objects().to_numpy()
+    codes = column.cat.codes.to_numpy()
+    numeric_values = numeric_vocabulary[codes]
+    if (codes == -1).any():
+        numeric_values = np.where(codes == -1, np.nan, numeric_values)
+    return pd.Series(numeric_values, index=column.index)
 
 
 def split_into_one_hot_encoded_X_and_y(data):
@@ -130,19 +304,20 @@ def split_into_one_hot_encoded_X_and_y(data):
 
 
 def stack_folds_onto_each_other(list_of_datasets):
-    final_descriptive_data = pd.DataFrame([])
-    final_one_hot_encoded_data = pd.DataFrame([])
-
-    for dataset in list_of_datasets:
-        descriptive_data_of_fold = dataset.descriptive_data
-        one_hot_encoded_data_of_fold = dataset.one_hot_encoded_data
-
-        final_descriptive_data = pd.concat([final_descriptive_data, descriptive_data_of_fold], ignore_index=True)
-        final_one_hot_encoded_data = pd.concat([final_one_hot_encoded_data, one_hot_encoded_data_of_fold], ignore_index=True)
+    dataset = list_of_datasets[0]
+    #views on the same shared data can be stacked by only stacking their row indices
+    if all((fold.row_indices is not None) and (fold.storage is dataset.storage) for fold in list_of_datasets):
+        root_dataset = Dataset(dataset.storage, dataset.ordinal_to_numeric_dicts, dataset.decision_attribute, dataset.undesirable_label,
+                               dataset.desirable_label, dataset.sensitive_attributes, dataset.reference_group_list,
+                               dataset.categorical_features, dataset.distance_function, one_hot_encoded_data=dataset.shared_one_hot_encoded_data,
+                               feature_matrices=dataset.shared_feature_matrices)
+        return root_dataset.create_view(np.concatenate([fold.row_indices for fold in list_of_datasets]))
+
+    final_descriptive_data = pd.concat([fold.descriptive_data for fold in list_of_datasets], ignore_index=True)
+    final_one_hot_encoded_data = pd.concat([fold.one_hot_encoded_data for fold in list_of_datasets], ignore_index=True)
 
     final_dataset = Dataset(final_descriptive_data, dataset.ordinal_to_numeric_dicts, dataset.decision_attribute, dataset.undesirable_label,
-                            dataset.desirable_label, dataset.categorical_features, dataset.distance_function, final_one_hot_encoded_data)
+                            dataset.desirable_label, dataset.sensitive_attributes, dataset.reference_group_list,
+                            dataset.categorical_features, dataset.distance_function, final_one_hot_encoded_data)
 
     return final_dataset
-
-
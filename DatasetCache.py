@@ -0,0 +1,150 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from ColumnStorage import MemmapStorage
+
+logger = logging.getLogger(__name__)
+
+#bump whenever the layout of the cache changes, older caches are then rebuilt
+CACHE_FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+FEATURE_MATRIX_FILE = 'feature_matrix.npy'
+
+
+#Loads a csv file into a Dataset, using a binary cache that is stored next to the csv file (<csv_path>.cache).
+#The cache holds the integer coded descriptive columns and the encoded feature matrix, which are memory-mapped on
+#later loads, so the csv doesn't need to be parsed and encoded again.
+#create_dataset is called with the descriptive data (a DataFrame or a storage) and has to return the Dataset.
+#The cache is rebuilt when the csv changes (checked through its modification time, size and sha256 hash) or when
+#the dataset that create_dataset returns is described differently (e.g. other columns or ordinal mappings)
+def load_csv_with_cache(csv_path, columns, create_dataset, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = csv_path + '.cache'
+
+    manifest = read_manifest(cache_dir)
+    if manifest is not None and is_csv_unchanged(csv_path, manifest, cache_dir):
+        dataset = create_dataset(MemmapStorage(cache_dir))
+        if manifest['loader_config'] == compute_loader_config_hash(dataset):
+            dataset.set_shared_feature_matrix(dataset.fit_encoder(), np.load(os.path.join(cache_dir, FEATURE_MATRIX_FILE), mmap_mode='r'))
+            logger.info("Loaded %s from the cache in %s", csv_path, cache_dir)
+            return dataset
+
+    logger.info("Building the cache of %s in %s", csv_path, cache_dir)
+    dataset = create_dataset(pd.read_csv(csv_path)[columns])
+    write_cache(csv_path, dataset, cache_dir)
+    return dataset
+
+
+def write_cache(csv_path, dataset, cache_dir):
+    #the cache is written to a temporary directory first, so a cache that is half written is never used
+    temporary_cache_dir = cache_dir + '.tmp' + str(os.getpid())
+    shutil.rmtree(temporary_cache_dir, ignore_errors=True)
+    MemmapStorage.write(dataset.descriptive_data, temporary_cache_dir)
+
+    feature_matrix = dataset.get_feature_matrix(dataset.fit_encoder())
+    np.save(os.path.join(temporary_cache_dir, FEATURE_MATRIX_FILE), feature_matrix)
+
+    csv_stat = os.stat(csv_path)
+    manifest = {'format_version': CACHE_FORMAT_VERSION,
+                'csv_mtime_ns': csv_stat.st_mtime_ns,
+                'csv_size': csv_stat.st_size,
+                'csv_sha256': compute_file_hash(csv_path),
+                'loader_config': compute_loader_config_hash(dataset)}
+    write_manifest(temporary_cache_dir, manifest)
+    install_cache(temporary_cache_dir, cache_dir, manifest)
+
+
+#Several processes can build the same cache at the same time (e.g. two runs of main.py). The cache that is already in
+#place is moved aside with a rename instead of being deleted file by file, so the new cache is put in place at once.
+#When another process installed a cache of the same csv and loader in the meantime, that cache is kept and the
+#temporary one is discarded. A reader that loads in the short moment between the two renames finds no cache and
+#builds one itself
+def install_cache(temporary_cache_dir, cache_dir, manifest):
+    if is_same_cache(read_manifest(cache_dir), manifest):
+        shutil.rmtree(temporary_cache_dir, ignore_errors=True)
+        return
+
+    old_cache_dir = cache_dir + '.old' + str(os.getpid())
+    try:
+        os.rename(cache_dir, old_cache_dir)
+    except FileNotFoundError:
+        old_cache_dir = None
+    try:
+        os.replace(temporary_cache_dir, cache_dir)
+    except OSError:
+        #another process installed its cache between the two renames
+        if not is_same_cache(read_manifest(cache_dir), manifest):
+            raise
+        shutil.rmtree(temporary_cache_dir, ignore_errors=True)
+    finally:
+        if old_cache_dir is not None:
+            shutil.rmtree(old_cache_dir, ignore_errors=True)
+
+
+def is_same_cache(installed_manifest, manifest):
+    return installed_manifest is not None and installed_manifest['csv_sha256'] == manifest['csv_sha256'] and \
+        installed_manifest['loader_config'] == manifest['loader_config']
+
+
+def read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_FILE)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('format_version') != CACHE_FORMAT_VERSION:
+        return None
+    return manifest
+
+
+#the manifest is replaced at once, so a process that reads it at the same time never sees half of it
+def write_manifest(cache_dir, manifest):
+    temporary_manifest_path = os.path.join(cache_dir, MANIFEST_FILE + '.tmp' + str(os.getpid()))
+    with open(temporary_manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temporary_manifest_path, os.path.join(cache_dir, MANIFEST_FILE))
+
+
+#the hash is only computed when the modification time or size changed, e.g. a csv that was copied or touched but
+#has the same content keeps its cache
+def is_csv_unchanged(csv_path, manifest, cache_dir):
+    try:
+        csv_stat = os.stat(csv_path)
+    except OSError:
+        return False
+    if csv_stat.st_mtime_ns == manifest['csv_mtime_ns'] and csv_stat.st_size == manifest['csv_size']:
+        return True
+    if csv_stat.st_size != manifest['csv_size'] or compute_file_hash(csv_path) != manifest['csv_sha256']:
+        return False
+
+    manifest['csv_mtime_ns'] = csv_stat.st_mtime_ns
+    write_manifest(cache_dir, manifest)
+    return True
+
+
+def compute_file_hash(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024**2), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def compute_loader_config_hash(dataset):
+    return hashlib.sha256(dataset.describe_metadata().encode()).hexdigest()
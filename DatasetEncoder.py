@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+#Learns the one-hot encoding schema of a dataset once, afterwards any (small) batch of descriptive data is mapped
+#onto exactly the same columns. The columns are in the same order as pd.get_dummies would give them: first the
+#ordinal/numerical features, then the one-hot encoded categorical features. Values that weren't seen when fitting
+#are encoded as all zeros.
+#With sparse=True the encoded data is a scipy.sparse CSR matrix, which only stores one entry per categorical feature
+#(instead of one per category) and is therefore much smaller when the categorical features have many categories
+#(scipy is only imported for sparse matrices).
+#With one_hot=False every categorical feature becomes a single column holding the code of its category (unseen values
+#become NaN), for classifiers that handle categorical features natively.
+class DatasetEncoder:
+    def __init__(self, ordinal_to_numeric_dicts, categorical_features, decision_attribute, dtype=np.float32, sparse=False, one_hot=True):
+        if sparse and not one_hot:
+            raise ValueError("Only one-hot encoded data can be stored as a sparse matrix")
+        self.ordinal_to_numeric_dicts = ordinal_to_numeric_dicts
+        self.categorical_features = categorical_features
+        self.decision_attribute = decision_attribute
+        self.dtype = dtype
+        self.sparse = sparse
+        self.one_hot = one_hot
+
+    def fit(self, descriptive_data):
+        feature_columns = [column for column in descriptive_data.columns if column != self.decision_attribute]
+        self.numerical_columns = [column for column in feature_columns if column not in self.categorical_features]
+        self.encoded_categorical_features = [column for column in self.categorical_features if column in feature_columns]
+
+        self.vocabularies = {}
+        for column in self.encoded_categorical_features:
+            self.vocabularies[column] = get_vocabulary_of_column(descriptive_data[column])
+
+        self.feature_names = list(self.numerical_columns)
+        self.position_of_value = {}
+        self.code_of_value = {}
+        self.offsets = {}
+        for column in self.encoded_categorical_features:
+            self.offsets[column] = len(self.feature_names)
+            if not self.one_hot:
+                self.feature_names.append(column)
+            for code, value in enumerate(self.vocabularies[column]):
+                self.code_of_value[(column, value)] = code
+                if self.one_hot:
+                    self.position_of_value[(column, value)] = len(self.feature_names)
+                    self.feature_names.append(f"{column}_{value}")
+
+        #for the ordinal columns, the vocabulary is stored together with the numeric value of every entry
+        self.ordinal_vocabularies = {}
+        for column, conversion_dict in self.ordinal_to_numeric_dicts.items():
+            if column in self.numerical_columns:
+                self.ordinal_vocabularies[column] = (list(conversion_dict.keys()), np.array(list(conversion_dict.values()), dtype=np.float64))
+
+        #encoders with the same schema encode data in exactly the same way, so they can share encoded matrices
+        self.schema_fingerprint = hashlib.sha256(repr((self.feature_names, self.ordinal_to_numeric_dicts,
+                                                       np.dtype(self.dtype).str, self.sparse, self.one_hot)).encode()).hexdigest()
+        return self
+
+    def get_number_of_features(self):
+        return len(self.feature_names)
+
+    #the memory of the feature matrix of n_rows rows, for a sparse matrix including the arrays it is built from
+    def estimate_feature_matrix_memory(self, n_rows):
+        itemsize = np.dtype(self.dtype).itemsize
+        if self.sparse:
+            n_slots = len(self.numerical_columns) + len(self.encoded_categorical_features)
+            return 2 * n_rows * n_slots * (itemsize + 4) + 8 * (n_rows + 1)
+        return n_rows * self.get_number_of_features() * itemsize
+
+    #marks the columns that hold category codes (only when one_hot is False)
+    def get_categorical_feature_mask(self):
+        categorical_feature_mask = np.zeros(self.get_number_of_features(), dtype=bool)
+        if not self.one_hot:
+            categorical_feature_mask[[self.offsets[column] for column in self.encoded_categorical_features]] = True
+        return categorical_feature_mask
+
+    def transform(self, descriptive_data):
+        if self.sparse:
+            return self.transform_to_sparse(descriptive_data)
+
+        n_rows = len(descriptive_data)
+        encoded_matrix = np.zeros((n_rows, self.get_number_of_features()), dtype=self.dtype)
+
+        for position, column in enumerate(self.numerical_columns):
+            encoded_matrix[:, position] = self.convert_numerical_column(column, descriptive_data[column])
+
+        all_rows = np.arange(n_rows)
+        for column in self.encoded_categorical_features:
+            codes = pd.Categorical(descriptive_data[column], categories=self.vocabularies[column]).codes
+            known_values = codes >= 0
+            if self.one_hot:
+                encoded_matrix[all_rows[known_values], self.offsets[column] + codes[known_values]] = 1
+            else:
+                encoded_matrix[:, self.offsets[column]] = np.where(known_values, codes, np.nan)
+        return encoded_matrix
+
+    #every row has one slot per numerical column and one per categorical feature, the zeros and unseen values are left
+    #out, which directly gives the (sorted) column indices of a CSR matrix
+    def transform_to_sparse(self, descriptive_data):
+        n_rows = len(descriptive_data)
+        n_slots = len(self.numerical_columns) + len(self.encoded_categorical_features)
+        values = np.ones((n_rows, n_slots), dtype=self.dtype)
+        column_indices = np.zeros((n_rows, n_slots), dtype=np.int32)
+
+        for position, column in enumerate(self.numerical_columns):
+            values[:, position] = self.convert_numerical_column(column, descriptive_data[column])
+            column_indices[:, position] = position
+
+        for slot, column in enumerate(self.encoded_categorical_features, start=len(self.numerical_columns)):
+            codes = pd.Categorical(descriptive_data[column], categories=self.vocabularies[column]).codes
+            values[codes < 0, slot] = 0
+            column_indices[:, slot] = self.offsets[column] + codes
+
+        stored_entries = values != 0
+        row_pointers = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(stored_entries.sum(axis=1), out=row_pointers[1:])
+        from scipy import sparse as scipy_sparse
+        return scipy_sparse.csr_matrix((values[stored_entries], column_indices[stored_entries], row_pointers),
+                                       shape=(n_rows, self.get_number_of_features()))
+
+    #encodes data that comes in chunks of rows (e.g. from a dataset that is kept on disk), so that only one chunk of
+    #descriptive data is in memory at a time
+    def transform_chunks(self, descriptive_data_chunks, n_rows):
+        if self.sparse:
+            from scipy import sparse as scipy_sparse
+            return scipy_sparse.vstack([self.transform(chunk) for chunk in descriptive_data_chunks], format='csr')
+
+        encoded_matrix = np.empty((n_rows, self.get_number_of_features()), dtype=self.dtype)
+        start = 0
+        for chunk in descriptive_data_chunks:
+            encoded_matrix[start:start + len(chunk)] = self.transform(chunk)
+            start += len(chunk)
+        return encoded_matrix
+
+    #encodes a list of dictionaries (one per instance) without going through pandas, meant for scoring single rows
+    def transform_records(self, records):
+        encoded_matrix = np.zeros((len(records), self.get_number_of_features()), dtype=self.dtype)
+        for row, record in enumerate(records):
+            for position, column in enumerate(self.numerical_columns):
+                value = record[column]
+                if column in self.ordinal_to_numeric_dicts:
+                    value = self.ordinal_to_numeric_dicts[column].get(value, np.nan)
+                encoded_matrix[row, position] = value
+            for column in self.encoded_categorical_features:
+                if not self.one_hot:
+                    encoded_matrix[row, self.offsets[column]] = self.code_of_value.get((column, record[column]), np.nan)
+                    continue
+                position = self.position_of_value.get((column, record[column]))
+                if position is not None:
+                    encoded_matrix[row, position] = 1
+        if self.sparse:
+            from scipy import sparse as scipy_sparse
+            return scipy_sparse.csr_matrix(encoded_matrix)
+        return encoded_matrix
+
+    def convert_numerical_column(self, column, values):
+        if column not in self.ordinal_vocabularies:
+            return values.to_numpy(dtype=np.float64)
+
+        vocabulary, numeric_values = self.ordinal_vocabularies[column]
+        codes = pd.Categorical(values, categories=vocabulary).codes
+        return np.where(codes >= 0, numeric_values[codes], np.nan)
+
+
+def get_vocabulary_of_column(column):
+    if column.dtype.name == 'category':
+        return list(column.cat.categories)
+    return sorted(pd.unique(column.dropna()))
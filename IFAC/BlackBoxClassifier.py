@@ -1,55 +1,202 @@
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.svm import SVC
-from sklearn.metrics import accuracy_score
+from .Instrumentation import get_instrumentation
+from .CompiledTrees import CompiledTreeClassifier
+from collections import OrderedDict
+import hashlib
+import importlib
+import pickle
+import threading
 import numpy as np
 import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+#these classifiers handle categorical features themselves, they get one column of category codes per categorical
+#feature instead of the one-hot encoded columns
+NATIVE_CATEGORICAL_CLASSIFIERS = ['Gradient Boosting']
+
+#used unless they are overridden by the kwargs of fit, the SGD classifier needs a logistic loss to predict probabilities
+DEFAULT_CLASSIFIER_KWARGS = {
+    'Logistic Regression': {'max_iter': 1000},
+    'SGD': {'loss': 'log_loss'}}
+
+#compiled trees are faster for single rows and small batches, for large batches sklearn is faster
+COMPILED_INFERENCE_MAX_ROWS = 100
+
+#the module and name of every classifier, a classifier is only imported when it is used (unpickling a fitted model
+#imports its own classifier), which keeps importing IFAC fast for short-lived scoring jobs
+CLASSIFIER_MAPPING = {
+    'Decision Tree': ('sklearn.tree', 'DecisionTreeClassifier'),
+    'Random Forest': ('sklearn.ensemble', 'RandomForestClassifier'),
+    'SVM': ('sklearn.svm', 'SVC'),
+    'Gradient Boosting': ('sklearn.ensemble', 'HistGradientBoostingClassifier'),
+    'Logistic Regression': ('sklearn.linear_model', 'LogisticRegression'),
+    'SGD': ('sklearn.linear_model', 'SGDClassifier')}
 
 class BlackBoxClassifier:
 
-    def __init__(self, classifier_name):
+    #with sparse=True the classifier is trained on a scipy.sparse CSR matrix instead of a dense one.
+    #With compiled_inference=True a fitted decision tree or random forest is compiled into flat arrays (see
+    #CompiledTrees), which makes scoring single rows and small batches much faster.
+    #With prediction_cache_size > 0 the predictions of that many datasets are kept (see enable_prediction_cache)
+    def __init__(self, classifier_name, sparse=False, compiled_inference=False, prediction_cache_size=0):
         self.classifier_name = classifier_name
-        self.CLASSIFIER_MAPPING = {
-        'Decision Tree': DecisionTreeClassifier,
-        'Random Forest': RandomForestClassifier,
-        'SVM': SVC}
+        self.sparse = sparse
+        self.compiled_inference = compiled_inference
+        self.compiled_classifier = None
+        self.prediction_cache_size = prediction_cache_size
+        self.prediction_cache = OrderedDict()
+        self.prediction_cache_lock = threading.Lock()
+        if sparse and self.uses_native_categorical_features():
+            raise ValueError(f"{classifier_name} can't be trained on sparse data")
 
 
     def get_classifier(self, **kwargs):
-        if self.classifier_name not in self.CLASSIFIER_MAPPING:
+        if self.classifier_name not in CLASSIFIER_MAPPING:
             raise ValueError(
-                f"Unsupported classifier type: {self.classifier_name}. Supported types are: {list(self.CLASSIFIER_MAPPING.keys())}")
-        return self.CLASSIFIER_MAPPING[self.classifier_name](**kwargs)
+                f"Unsupported classifier type: {self.classifier_name}. Supported types are: {list(CLASSIFIER_MAPPING.keys())}")
+        classifier_kwargs = dict(DEFAULT_CLASSIFIER_KWARGS.get(self.classifier_name, {}))
+        if self.uses_native_categorical_features():
+            classifier_kwargs['categorical_features'] = self.encoder.get_categorical_feature_mask()
+        classifier_kwargs.update(kwargs)
+        module_name, class_name = CLASSIFIER_MAPPING[self.classifier_name]
+        return getattr(importlib.import_module(module_name), class_name)(**classifier_kwargs)
+
+    def uses_native_categorical_features(self):
+        return self.classifier_name in NATIVE_CATEGORICAL_CLASSIFIERS
 
-    def fit(self, X_train_dataset, **kwargs):
+    #the encoding (one-hot or category codes, dense or sparse) that fits this classifier
+    def create_encoder(self, dataset):
+        return dataset.fit_encoder(sparse=self.sparse, one_hot=not self.uses_native_categorical_features())
+
+    #the encoder fixes the columns the classifier is trained on, every dataset that is predicted later is encoded with it.
+    #If no encoder is given, it is learned from the training data.
+    #kwargs are passed on to the constructor of the classifier, e.g. n_jobs=-1 to use all cores
+    def fit(self, X_train_dataset, encoder=None, **kwargs):
+        if encoder is None:
+            encoder = self.create_encoder(X_train_dataset)
+        self.encoder = encoder
         self.classifier = self.get_classifier(**kwargs)
-        y_train = X_train_dataset.descriptive_data[X_train_dataset.decision_attribute]
-        X_train = X_train_dataset.one_hot_encoded_data.loc[:, X_train_dataset.one_hot_encoded_data.columns != X_train_dataset.decision_attribute]
+        #only the labels are read, so a training set that is kept on disk is encoded chunk by chunk and never loaded as a whole
+        y_train = X_train_dataset.get_column(X_train_dataset.decision_attribute)
+        X_train = self.get_feature_matrix(X_train_dataset)
         self.classifier.fit(X_train, y_train)
+        self.compiled_classifier = None
+        self.clear_prediction_cache()
+        if self.compiled_inference:
+            self.compile_trees()
         return self.classifier
 
-    def predict(self, X_test_dataset):
-        y_test = X_test_dataset.descriptive_data[X_test_dataset.decision_attribute]
-        X_test = X_test_dataset.one_hot_encoded_data.loc[:,
-                  X_test_dataset.one_hot_encoded_data.columns != X_test_dataset.decision_attribute]
+    #identifies the fitted classifier and its encoding (e.g. in the keys of the stage cache), a pickled copy of the
+    #same fitted black box gets the same fingerprint
+    def compute_fingerprint(self):
+        if not hasattr(self, 'classifier'):
+            raise ValueError("The black box has to be fitted before it can be fingerprinted")
+        hasher = hashlib.sha256()
+        hasher.update(pickle.dumps(self.classifier, protocol=4))
+        hasher.update(repr((self.classifier_name, self.sparse, self.encoder.schema_fingerprint)).encode())
+        return hasher.hexdigest()
+
+    #exports the fitted trees into flat NumPy arrays, afterwards all predictions are made with the compiled trees
+    def compile_trees(self):
+        self.compiled_classifier = CompiledTreeClassifier(self.classifier)
+        return self.compiled_classifier
+
+    def use_compiled_classifier(self, X):
+        return self.compiled_classifier is not None and X.shape[0] <= COMPILED_INFERENCE_MAX_ROWS
+
+    def get_feature_matrix(self, X_dataset):
+        return X_dataset.get_feature_matrix(self.encoder)
+
+    #the accuracy is only computed when the data has labels and someone is listening (a logger at INFO level or an instrumentation recording metrics)
+    def predict(self, X_test_dataset, instrumentation=None):
+        X_test = self.get_feature_matrix(X_test_dataset)
 
-        predictions = self.classifier.predict(X_test)
-        print(accuracy_score(y_test, predictions))
+        if self.use_compiled_classifier(X_test):
+            predictions = self.compiled_classifier.predict(to_dense_matrix(X_test))
+        else:
+            predictions = self.classifier.predict(X_test)
+
+        instrumentation = get_instrumentation(instrumentation)
+        if X_test_dataset.has_ground_truth() and (instrumentation.record_metrics or logger.isEnabledFor(logging.INFO)):
+            from sklearn.metrics import accuracy_score
+            y_test = X_test_dataset.get_column(X_test_dataset.decision_attribute)
+            accuracy = accuracy_score(y_test, predictions)
+            logger.info("Black-box accuracy: %.4f", accuracy)
+            instrumentation.record_metric("black-box accuracy", accuracy)
 
         return predictions
 
 
     def predict_with_proba(self, X_dataset):
-        X = X_dataset.one_hot_encoded_data.loc[:,
-                 X_dataset.one_hot_encoded_data.columns != X_dataset.decision_attribute]
-        predicted_labels = pd.Series(self.classifier.predict(X))
+        if self.prediction_cache_size == 0:
+            return self.compute_predictions_with_proba(X_dataset)
+
+        fingerprint = X_dataset.compute_fingerprint()
+        with self.prediction_cache_lock:
+            cached_predictions = self.prediction_cache.get(fingerprint)
+            if cached_predictions is not None:
+                self.prediction_cache.move_to_end(fingerprint)
+        if cached_predictions is None:
+            cached_predictions = self.compute_predictions_with_proba(X_dataset)
+            with self.prediction_cache_lock:
+                self.prediction_cache[fingerprint] = cached_predictions
+                while len(self.prediction_cache) > self.prediction_cache_size:
+                    self.prediction_cache.popitem(last=False)
+        #the callers change the predictions they get (e.g. rejected predictions are replaced), so they get copies
+        return cached_predictions[0].copy(), cached_predictions[1].copy()
+
+    def compute_predictions_with_proba(self, X_dataset):
+        X = self.get_feature_matrix(X_dataset)
+        predicted_labels, probabilities_for_labels = self.predict_with_proba_from_feature_matrix(X)
+        return pd.Series(predicted_labels), pd.Series(probabilities_for_labels)
+
+    #keeps the predictions of the last cache_size datasets (keyed by the fingerprint of their data), so that methods
+    #that share this classifier (e.g. UBAC and IFAC in a comparison) only predict every test set once
+    def enable_prediction_cache(self, cache_size=16):
+        self.prediction_cache_size = cache_size
+        return self
+
+    def clear_prediction_cache(self):
+        with self.prediction_cache_lock:
+            self.prediction_cache.clear()
+
+    #scores a list of dictionaries (one per instance) directly, without building a Dataset first
+    def predict_records_with_proba(self, records):
+        return self.predict_with_proba_from_feature_matrix(self.encoder.transform_records(records))
+
+    def predict_with_proba_from_feature_matrix(self, X):
+        if self.use_compiled_classifier(X):
+            predicted_probabilities = self.compiled_classifier.predict_proba(to_dense_matrix(X))
+            predicted_labels = self.compiled_classifier.classes_.take(np.argmax(predicted_probabilities, axis=1), axis=0)
+            return predicted_labels, predicted_probabilities.max(axis=1)
+
+        predicted_labels = self.classifier.predict(X)
 
         # Predict the probabilities for each class
         predicted_probabilities = self.classifier.predict_proba(X)
 
         # Get the probability corresponding to the predicted label for each instance
-        probabilities_for_labels = pd.Series(predicted_probabilities.max(axis=1))
+        probabilities_for_labels = predicted_probabilities.max(axis=1)
 
         return predicted_labels, probabilities_for_labels
 
 
+    #the lock can't be pickled (e.g. when IFAC stores the black box in its stage cache), the cached predictions aren't stored
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['prediction_cache'] = OrderedDict()
+        del state['prediction_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.prediction_cache = OrderedDict()
+        self.prediction_cache_lock = threading.Lock()
+
+
+def to_dense_matrix(X):
+    from scipy import sparse as scipy_sparse
+    if scipy_sparse.issparse(X):
+        return X.toarray()
+    return X
@@ -0,0 +1,108 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+
+#The nodes of all trees of a fitted decision tree or random forest, stored in flat NumPy arrays. Scoring a row (or a
+#small batch) only walks these arrays, which avoids the input validation and joblib overhead of sklearn and gives
+#the same probabilities as predict_proba of the original classifier.
+class CompiledTreeClassifier:
+    def __init__(self, classifier):
+        from sklearn.tree import DecisionTreeClassifier
+        from sklearn.ensemble import RandomForestClassifier
+        if isinstance(classifier, RandomForestClassifier):
+            trees = [estimator.tree_ for estimator in classifier.estimators_]
+        elif isinstance(classifier, DecisionTreeClassifier):
+            trees = [classifier.tree_]
+        else:
+            raise ValueError(f"Only decision trees and random forests can be compiled, not {type(classifier).__name__}")
+
+        self.classes_ = classifier.classes_
+        self.classifier_type = type(classifier).__name__
+        self.n_features = classifier.n_features_in_
+        self.n_trees = len(trees)
+
+        #the node indices of every tree are shifted, so the children point to positions in the flat arrays
+        node_offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+        self.roots = node_offsets[:-1].astype(np.intp)
+        self.feature = np.concatenate([tree.feature for tree in trees]).astype(np.intp)
+        self.threshold = np.concatenate([tree.threshold for tree in trees])
+        self.left_child = np.concatenate([np.where(tree.children_left >= 0, tree.children_left + offset, -1)
+                                          for tree, offset in zip(trees, node_offsets)]).astype(np.intp)
+        self.right_child = np.concatenate([np.where(tree.children_right >= 0, tree.children_right + offset, -1)
+                                           for tree, offset in zip(trees, node_offsets)]).astype(np.intp)
+        #like sklearn, rows with missing values are only scored by classifiers that support them, all other
+        #classifiers reject them
+        self.supports_missing_values = supports_missing_values(classifier, trees)
+        if self.supports_missing_values:
+            self.missing_go_to_left = np.concatenate([np.asarray(tree.missing_go_to_left, dtype=bool) for tree in trees])
+        else:
+            self.missing_go_to_left = None
+        self.is_leaf = self.left_child < 0
+        #leaves are handled as nodes that point to themselves, so a row that reached its leaf stays there
+        self.left_child[self.is_leaf] = np.flatnonzero(self.is_leaf)
+        self.right_child[self.is_leaf] = np.flatnonzero(self.is_leaf)
+        self.feature[self.is_leaf] = 0
+        #children[node, 1] is the left child, so the outcome of the split picks the next node directly
+        self.children = np.stack([self.right_child, self.left_child], axis=1)
+        self.max_depth = max(tree.max_depth for tree in trees)
+
+        #class probabilities per node, normalized in the same way as DecisionTreeClassifier.predict_proba
+        node_values = np.concatenate([tree.value[:, 0, :len(self.classes_)] for tree in trees])
+        normalizer = node_values.sum(axis=1)
+        normalizer[normalizer == 0.0] = 1.0
+        self.node_probabilities = node_values / normalizer[:, np.newaxis]
+
+    #the leaf that every row ends up in, for every tree (shape: rows x trees)
+    def apply(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features:
+            raise ValueError(f"X has {X.shape[1]} features, but the classifier was fitted on {self.n_features} features")
+
+        has_missing_values = np.isnan(X).any()
+        if has_missing_values and not self.supports_missing_values:
+            raise ValueError(f"Input X contains NaN, which {self.classifier_type} doesn't support")
+        rows = np.arange(X.shape[0])[:, np.newaxis]
+        nodes = np.tile(self.roots, (X.shape[0], 1))
+        for _ in range(self.max_depth):
+            feature_values = X[rows, self.feature[nodes]]
+            go_left = feature_values <= self.threshold[nodes]
+            if has_missing_values:
+                go_left |= np.isnan(feature_values) & self.missing_go_to_left[nodes]
+            nodes = self.children[nodes, go_left.view(np.int8)]
+        return nodes
+
+    def predict_proba(self, X):
+        leaves = self.apply(X)
+        #the trees are added up one after the other (cumsum is sequential), like sklearn does, so the probabilities are exactly the same
+        probabilities = np.cumsum(self.node_probabilities[leaves], axis=1)[:, -1]
+        if self.n_trees > 1:
+            probabilities /= self.n_trees
+        return probabilities
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+#whether sklearn lets the classifier predict rows with missing values (its allow_nan tag), which also needs
+#trees that store the direction of missing values
+def supports_missing_values(classifier, trees):
+    if not all(hasattr(tree, 'missing_go_to_left') for tree in trees):
+        return False
+    try:
+        from sklearn.utils import get_tags
+    except ImportError:
+        return bool(classifier._get_tags().get('allow_nan', False))
+    return bool(get_tags(classifier).input_tags.allow_nan)
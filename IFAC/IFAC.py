@@ -12,19 +12,68 @@
 
 from .BlackBoxClassifier import BlackBoxClassifier
 from .PD_itemset import generate_potentially_discriminated_itemsets
-from .Rule import get_instances_covered_by_rule_base, get_instances_covered_by_rule, remove_rules_that_are_subsets_from_other_rules, convert_to_apriori_format, initialize_rule, calculate_support_conf_slift_and_significance
+from .Rule import get_instances_covered_by_rule_base, get_instances_covered_by_rule, remove_rules_that_are_subsets_from_other_rules, convert_to_apriori_format, initialize_rule, calculate_support_conf_slift_and_significance, estimate_apriori_memory
 from .Rule import Rule
 from .PD_itemset import PD_itemset
 from .Reject import create_uncertainty_based_reject, create_unfairness_based_reject
 from .SituationTesting import SituationTesting
-from copy import deepcopy
-from apyori import apriori
+from .StageCache import StageCache, compute_stage_key
+from .Instrumentation import Instrumentation, get_instrumentation
+from .MemoryBudget import MemoryBudget, MemoryLimitHook
+from ColumnStorage import iterate_over_row_chunks
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import numpy as np
 import itertools
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+#the memory of the intermediate frames of predict per row and column of the data (measured with tracemalloc on the
+#income data), most of it goes to the Reject objects and the instances they hold
+PREDICTION_BYTES_PER_ITEM = 128
+
+#the number of stages that are kept in the report of the instrumentation that is created for a memory limit
+MEMORY_LIMIT_REPORT_SIZE = 1000
+
+#The stages of IFAC.fit, in the order in which they are run. Every stage only depends on the outcome of the stages before it
+FIT_STAGES = ['split', 'black_box', 'validation_predictions', 'class_rules', 'reject_rules', 'situation_testing',
+              'reject_threshold_preparation', 'reject_thresholds']
+
+#The parameters of IFAC that are used in each stage, changing one of them invalidates that stage and all stages after it
+FIT_STAGE_PARAMETERS = {
+    'split': ['val1_ratio', 'val2_ratio'],
+    'black_box': ['base_classifier', 'sparse_encoding', 'base_classifier_kwargs', 'black_box'],
+    'validation_predictions': [],
+    'class_rules': [],
+    'reject_rules': ['max_pvalue_slift'],
+    'situation_testing': ['sit_test_k'],
+    'reject_threshold_preparation': ['sit_test_t'],
+    'reject_thresholds': ['coverage', 'fairness_weight']}
+
+#The attributes that hold the outcome of each stage, these are what gets stored when a cache directory is given
+FIT_STAGE_ARTIFACTS = {
+    'split': ['X_train_dataset', 'X_val1_dataset', 'X_val2_dataset'],
+    'black_box': ['encoder', 'BB'],
+    'validation_predictions': ['val_1_data_with_preds', 'val_1_data_with_preds_and_probas', 'val_2_data_with_preds_and_probas'],
+    'class_rules': ['class_rules_per_prot_itemset'],
+    'reject_rules': ['reject_rules'],
+    'situation_testing': ['situationTester', 'val_2_disc_scores'],
+    'reject_threshold_preparation': ['n_reject_threshold_instances', 'unfair_probabilities_descending', 'fair_probabilities_ascending'],
+    'reject_thresholds': ['unfair_and_certain_limit', 'fair_and_uncertain_limit']}
+
+
+def get_stage_invalidated_by_parameter(parameter):
+    for stage in FIT_STAGES:
+        if parameter in FIT_STAGE_PARAMETERS[stage]:
+            return stage
+    raise ValueError(f"Unknown parameter: {parameter}. Parameters that can be changed are: {list(itertools.chain.from_iterable(FIT_STAGE_PARAMETERS.values()))}")
+
 
 class IFAC:
 
-    def __init__(self, coverage, fairness_weight, val1_ratio=0.1, val2_ratio=0.1, base_classifier="Random Forest", max_pvalue_slift=0.01, sit_test_k = 10, sit_test_t = 0.2):
+    def __init__(self, coverage, fairness_weight, val1_ratio=0.1, val2_ratio=0.1, base_classifier="Random Forest", max_pvalue_slift=0.01, sit_test_k = 10, sit_test_t = 0.2, sparse_encoding=False, base_classifier_kwargs=None, black_box=None, cache_dir=None, max_cache_size_in_bytes=1024**3, instrumentation=None, memory_limit=None):
         self.coverage = coverage
         self.fairness_weight = fairness_weight
         self.val1_ratio = val1_ratio
@@ -33,9 +82,33 @@ class IFAC:
         self.max_pvalue_slift = max_pvalue_slift
         self.sit_test_k = sit_test_k
         self.sit_test_t = sit_test_t
+        self.sparse_encoding = sparse_encoding
+        #passed on to the constructor of the base classifier, e.g. {'n_jobs': -1}
+        self.base_classifier_kwargs = {} if base_classifier_kwargs is None else base_classifier_kwargs
+        #a BlackBoxClassifier that was already fitted (e.g. the one of another IFAC), which is then used instead of training
+        #a new one. It must not have been trained on the validation data of IFAC
+        self.black_box = black_box
+        #when a cache directory is given, the outcome of every stage of fit is stored on disk and reused
+        #by later fits on the same data with the same parameters
+        if cache_dir is None:
+            self.stage_cache = None
+        else:
+            self.stage_cache = StageCache(cache_dir, max_cache_size_in_bytes)
+        #an Instrumentation object records the duration, row counts, rule counts and memory of every stage of fit and predict
+        self.instrumentation = get_instrumentation(instrumentation)
+        #with a memory limit (in bytes or a string like '4GB'), the stages that grow with the size of the data work in
+        #chunks that fit in the limit, and a stage that can't fit raises a ValueError before it starts. Without a
+        #given instrumentation, the peak memory of every stage is then measured from the resident set size, which
+        #costs next to nothing, and only the most recent stages are kept in the report
+        self.memory_budget = MemoryBudget(memory_limit)
+        if self.memory_budget.is_limited():
+            if instrumentation is None:
+                self.instrumentation = Instrumentation(track_memory='rss', record_metrics=False,
+                                                       max_records=MEMORY_LIMIT_REPORT_SIZE)
+            self.instrumentation.add_hook(MemoryLimitHook(self.memory_budget.memory_limit))
 
     def fit(self, X):
-        print("Setting up IFAC")
+        logger.info("Setting up IFAC")
         # Generate potentially discriminated itemsets
         self.sensitive_attributes = X.sensitive_attributes
         self.reference_group_list = X.reference_group_list
@@ -45,55 +118,168 @@ class IFAC:
         self.negative_label = X.undesirable_label
         self.class_items = frozenset([X.decision_attribute + " : " + X.undesirable_label, X.decision_attribute + " : " + X.desirable_label])
 
-        #Step 0: Split into train and two validation sets
-        val1_n = int(self.val1_ratio * len(X.descriptive_data))
-        val2_n = int(self.val2_ratio * len(X.descriptive_data))
-        X_train_dataset, X_val1_dataset = X.split_into_train_test(val1_n)
-        X_train_dataset, X_val2_dataset = X_train_dataset.split_into_train_test(val2_n)
-
-        #Step 1: Train Black-Box Model
-        self.BB = BlackBoxClassifier(self.base_classifier)
-        self.BB.fit(X_train_dataset)
-
-        #Step 2: Extract at-risk subgroups dict, each key is a potentially_discriminated itemset (can be intersectional!) and each value
-        #is a list of rules that are problematic
-        #self.reject_rules = self.give_quick_sets_of_rules_for_income_testing_purposes()
-        val_1_data_with_preds = self.make_preds_for_data(X_val1_dataset)
-        self.reject_rules = self.learn_reject_rules(val_1_data_with_preds)
-
-        #Step 3: Prepare situation testing
-        val_1_data_with_preds_and_probas = self.make_preds_and_preds_proba_for_data(X_val1_dataset)
-        self.situationTester = SituationTesting(k=self.sit_test_k, t=self.sit_test_t, reference_group_list=self.reference_group_list, decision_label=self.decision_attribute, desirable_label=self.positive_label)
-        self.situationTester.fit(val_1_data_with_preds_and_probas)
-
-        #Learn uncertainty reject thresholds
-        val_2_data_with_preds_and_probas = self.make_preds_and_preds_proba_for_data(X_val2_dataset)
-        self.unfair_and_certain_limit, self.fair_and_uncertain_limit = self.learn_reject_thresholds(val_2_data_with_preds_and_probas)
+        #the training data and the outcome of every stage are kept, so that refit only has to rerun the invalidated stages
+        self.fit_data = X
+        if self.stage_cache is not None:
+            self.fit_data_fingerprint = X.compute_fingerprint()
+        self.fit_stage_keys = {}
+        self.run_fit_stages(FIT_STAGES)
+        return
+
+    #changes the given parameters and only reruns the stages of fit that are affected by them
+    def refit(self, **changed_params):
+        if not hasattr(self, 'fit_data'):
+            raise ValueError("IFAC needs to be fitted before it can be refitted")
+
+        invalidated_stage_indices = []
+        for parameter, value in changed_params.items():
+            stage = get_stage_invalidated_by_parameter(parameter)
+            if getattr(self, parameter) != value:
+                setattr(self, parameter, value)
+                invalidated_stage_indices.append(FIT_STAGES.index(stage))
+
+        if len(invalidated_stage_indices) != 0:
+            self.run_fit_stages(FIT_STAGES[min(invalidated_stage_indices):])
         return
 
-    def make_preds_for_data(self, data_set):
-        pred_for_data = self.BB.predict(data_set)
+    def run_fit_stages(self, stages):
+        stage_functions = {
+            'split': self.fit_split_stage,
+            'black_box': self.fit_black_box_stage,
+            'validation_predictions': self.fit_validation_predictions_stage,
+            'class_rules': self.fit_class_rules_stage,
+            'reject_rules': self.fit_reject_rules_stage,
+            'situation_testing': self.fit_situation_testing_stage,
+            'reject_threshold_preparation': self.fit_reject_threshold_preparation_stage,
+            'reject_thresholds': self.fit_reject_thresholds_stage}
+
+        for stage in stages:
+            if self.stage_cache is None:
+                stage_functions[stage]()
+            else:
+                self.run_fit_stage_with_cache(stage, stage_functions[stage])
+
+        #t is only needed when predicting, so the situation tester always gets the current one (also when it was loaded from cache)
+        self.situationTester.t = self.sit_test_t
+
+    def run_fit_stage_with_cache(self, stage, stage_function):
+        stage_index = FIT_STAGES.index(stage)
+        if stage_index == 0:
+            previous_key = self.fit_data_fingerprint
+        else:
+            previous_key = self.fit_stage_keys[FIT_STAGES[stage_index-1]]
+
+        stage_parameters = {parameter: getattr(self, parameter) for parameter in FIT_STAGE_PARAMETERS[stage]}
+        stage_key = compute_stage_key(previous_key, stage, stage_parameters)
+
+        if self.stage_cache.contains(stage_key):
+            with self.instrumentation.stage("cache load", details=stage):
+                for artifact_name, artifact in self.stage_cache.load(stage_key).items():
+                    setattr(self, artifact_name, artifact)
+        else:
+            stage_function()
+            self.stage_cache.store(stage_key, {artifact_name: getattr(self, artifact_name) for artifact_name in FIT_STAGE_ARTIFACTS[stage]})
+        self.fit_stage_keys[stage] = stage_key
+
+    #Step 0: Split into train and two validation sets
+    def fit_split_stage(self):
+        with self.instrumentation.stage("split", n_rows=len(self.fit_data)):
+            val1_n = int(self.val1_ratio * len(self.fit_data))
+            val2_n = int(self.val2_ratio * len(self.fit_data))
+            X_train_dataset, self.X_val1_dataset = self.fit_data.split_into_train_test(val1_n)
+            self.X_train_dataset, self.X_val2_dataset = X_train_dataset.split_into_train_test(val2_n)
+
+    #Step 1: Train Black-Box Model
+    def fit_black_box_stage(self):
+        if self.black_box is not None:
+            self.BB = self.black_box
+            self.encoder = self.black_box.encoder
+            return
+        with self.instrumentation.stage("black-box fit", n_rows=len(self.X_train_dataset)):
+            self.BB = BlackBoxClassifier(self.base_classifier, sparse=self.sparse_encoding)
+            #the encoding schema is learned once (on all of the data), so that any data that is predicted later is encoded in the same way
+            self.encoder = self.BB.create_encoder(self.fit_data)
+            self.memory_budget.check("black-box fit", self.encoder.estimate_feature_matrix_memory(len(self.X_train_dataset)), what="feature matrix")
+            self.BB.fit(self.X_train_dataset, encoder=self.encoder, **self.base_classifier_kwargs)
+        #the splits are kept by the fitted model, their feature matrices are not
+        self.X_train_dataset.release_feature_matrix()
+
+    def fit_validation_predictions_stage(self):
+        self.val_1_data_with_preds = self.make_preds_for_data(self.X_val1_dataset)
+        self.val_1_data_with_preds_and_probas = self.make_preds_and_preds_proba_for_data(self.X_val1_dataset)
+        self.val_2_data_with_preds_and_probas = self.make_preds_and_preds_proba_for_data(self.X_val2_dataset)
+        self.X_val1_dataset.release_feature_matrix()
+        self.X_val2_dataset.release_feature_matrix()
+
+    #Step 2: Extract at-risk subgroups dict, each key is a potentially_discriminated itemset (can be intersectional!) and each value
+    #is a list of rules that are problematic
+    def fit_class_rules_stage(self):
+        self.class_rules_per_prot_itemset = self.learn_class_rules_associated_with_prot_itemsets(self.val_1_data_with_preds)
+
+    def fit_reject_rules_stage(self):
+        self.reject_rules = self.select_reject_rules(self.class_rules_per_prot_itemset)
+
+    #Step 3: Prepare situation testing
+    def fit_situation_testing_stage(self):
+        self.situationTester = SituationTesting(k=self.sit_test_k, t=self.sit_test_t, reference_group_list=self.reference_group_list, decision_label=self.decision_attribute, desirable_label=self.positive_label,
+                                                 distance_function=self.fit_data.distance_function)
+        with self.instrumentation.stage("situation-testing fit", n_rows=len(self.val_1_data_with_preds_and_probas)):
+            self.situationTester.fit(self.val_1_data_with_preds_and_probas)
+        self.val_2_disc_scores = self.compute_disc_scores_of_data_falling_under_rules(self.val_2_data_with_preds_and_probas)
+
+    #Learn uncertainty reject thresholds
+    def fit_reject_threshold_preparation_stage(self):
+        self.prepare_reject_threshold_learning(self.val_2_data_with_preds_and_probas, self.val_2_disc_scores)
+
+    def fit_reject_thresholds_stage(self):
+        with self.instrumentation.stage("threshold learning"):
+            self.unfair_and_certain_limit, self.fair_and_uncertain_limit = self.compute_reject_thresholds(self.coverage, self.fairness_weight)
+
+    def make_preds_for_data(self, data_set, memory_budget=None):
+        with self.instrumentation.stage("black-box predict", n_rows=len(data_set)):
+            pred_for_data = self.predict_labels_with_black_box_in_chunks(data_set, self.memory_budget if memory_budget is None else memory_budget)
         data_descriptive = data_set.descriptive_data
 
-        data_with_preds = deepcopy(data_descriptive)
-        data_with_preds = data_with_preds.drop(columns=[self.decision_attribute])
+        #drop returns a new frame, so the descriptive data of the dataset isn't changed (and doesn't need to be copied first)
+        data_with_preds = data_descriptive.drop(columns=[self.decision_attribute], errors='ignore')
         data_with_preds[self.decision_attribute] = pred_for_data
         return data_with_preds
 
-    def make_preds_and_preds_proba_for_data(self, data_set):
-        pred_for_data, prediction_probs_for_data = self.BB.predict_with_proba(data_set)
+    def make_preds_and_preds_proba_for_data(self, data_set, memory_budget=None):
+        with self.instrumentation.stage("black-box predict", n_rows=len(data_set)):
+            pred_for_data, prediction_probs_for_data = self.predict_with_black_box_in_chunks(data_set, self.memory_budget if memory_budget is None else memory_budget)
         data_descriptive = data_set.descriptive_data
 
-        data_with_preds = deepcopy(data_descriptive)
-        data_with_preds = data_with_preds.drop(columns=[self.decision_attribute])
+        #unlabeled data (e.g. in production) doesn't have the decision attribute
+        data_with_preds = data_descriptive.drop(columns=[self.decision_attribute], errors='ignore')
         data_with_preds[self.decision_attribute] = pred_for_data
         data_with_preds['pred. probability'] = prediction_probs_for_data
         return data_with_preds
 
+    #the feature matrix of all rows is only made at once when it fits in the memory budget, otherwise the black box
+    #predicts views on chunks of the rows
+    def predict_with_black_box_in_chunks(self, data_set, memory_budget):
+        chunk_size = memory_budget.compute_chunk_size("black-box predict", len(data_set), self.encoder.estimate_feature_matrix_memory(1))
+        if chunk_size >= len(data_set):
+            return self.BB.predict_with_proba(data_set)
+
+        predictions_per_chunk = [self.BB.predict_with_proba(data_set.create_view(np.arange(start, end))) for start, end in iterate_over_row_chunks(len(data_set), chunk_size)]
+        return pd.concat([predictions for predictions, _ in predictions_per_chunk], ignore_index=True), \
+            pd.concat([probabilities for _, probabilities in predictions_per_chunk], ignore_index=True)
+
+    #the same as predict_with_black_box_in_chunks, for the labels only (with chunks, the accuracy is logged per chunk)
+    def predict_labels_with_black_box_in_chunks(self, data_set, memory_budget):
+        chunk_size = memory_budget.compute_chunk_size("black-box predict", len(data_set), self.encoder.estimate_feature_matrix_memory(1))
+        if chunk_size >= len(data_set):
+            return self.BB.predict(data_set, self.instrumentation)
+
+        return np.concatenate([self.BB.predict(data_set.create_view(np.arange(start, end)), self.instrumentation)
+                               for start, end in iterate_over_row_chunks(len(data_set), chunk_size)])
+
     def learn_class_rules_associated_with_prot_itemsets(self, val_data_with_preds):
         disc_rules_per_prot_itemset = {}
         for prot_itemset in self.pd_itemsets:
-            print("Learning rules for: " + str(prot_itemset))
+            logger.info("Learning rules for: %s", prot_itemset)
             disc_rules_for_prot_itemset = self.extract_disc_rules_for_one_prot_itemset(prot_itemset, val_data_with_preds)
             disc_rules_per_prot_itemset[prot_itemset] = disc_rules_for_prot_itemset
 
@@ -101,40 +287,52 @@ class IFAC:
 
 
     def extract_disc_rules_for_one_prot_itemset(self, prot_itemset, val_data):
-        data_belonging_to_prot_itemset = get_instances_covered_by_rule_base(prot_itemset.dict_notation, val_data)
-        data_belonging_to_prot_itemset = data_belonging_to_prot_itemset.drop(columns=self.sensitive_attributes)
-
-        data_apriori_format = convert_to_apriori_format(data_belonging_to_prot_itemset)
-        all_rules = list(apriori(transactions=data_apriori_format, min_support=0.01,
-                               min_confidence=0.85, min_lift=1.0, min_length=2,
-                               max_length=4))
+        candidate_rules = self.mine_candidate_rules_for_one_prot_itemset(prot_itemset, val_data)
 
         discriminatory_rules = []
-
-        for rule in all_rules:
-            if rule.items.isdisjoint(self.class_items):
-                continue
-            for ordering in rule.ordered_statistics:
-                rule_base = ordering.items_base
-                rule_consequence = ordering.items_add
-                if (not rule_consequence.isdisjoint(self.class_items)) & (len(rule_consequence) == 1):
-                    rule_base_with_prot_itemset = rule_base.union(prot_itemset.frozenset_notation)
-                    myRule = initialize_rule(rule_base_with_prot_itemset, rule_consequence)
-                    support_over_all_data, conf_over_all_data, slift, slift_p = calculate_support_conf_slift_and_significance(
-                        myRule, val_data, prot_itemset)
-                    myRule.set_support(support_over_all_data); myRule.set_confidence(conf_over_all_data)
-                    myRule.set_slift(slift); myRule.set_slift_p_value(slift_p)
-                    discriminatory_rules.append(myRule)
+        with self.instrumentation.stage("rule scoring", details=prot_itemset, n_rows=len(val_data), n_rules=len(candidate_rules)):
+            for myRule in candidate_rules:
+                support_over_all_data, conf_over_all_data, slift, slift_p = calculate_support_conf_slift_and_significance(
+                    myRule, val_data, prot_itemset)
+                myRule.set_support(support_over_all_data); myRule.set_confidence(conf_over_all_data)
+                myRule.set_slift(slift); myRule.set_slift_p_value(slift_p)
+                discriminatory_rules.append(myRule)
         return discriminatory_rules
 
+    #the class rules that apriori finds in the data of the protected itemset, before they are scored
+    def mine_candidate_rules_for_one_prot_itemset(self, prot_itemset, val_data):
+        with self.instrumentation.stage("rule mining", details=prot_itemset) as mining_stage:
+            data_belonging_to_prot_itemset = get_instances_covered_by_rule_base(prot_itemset.dict_notation, val_data)
+            data_belonging_to_prot_itemset = data_belonging_to_prot_itemset.drop(columns=self.sensitive_attributes)
+            #apriori needs all transactions at once, so rule mining can't be split into chunks
+            self.memory_budget.check("rule mining", estimate_apriori_memory(*data_belonging_to_prot_itemset.shape), what=str(prot_itemset))
+
+            data_apriori_format = convert_to_apriori_format(data_belonging_to_prot_itemset)
+            #apyori is only needed for fitting, so it isn't imported by scoring jobs
+            from apyori import apriori
+            all_rules = list(apriori(transactions=data_apriori_format, min_support=0.01,
+                                   min_confidence=0.85, min_lift=1.0, min_length=2,
+                                   max_length=4))
+
+            candidate_rules = []
+            for rule in all_rules:
+                if rule.items.isdisjoint(self.class_items):
+                    continue
+                for ordering in rule.ordered_statistics:
+                    rule_base = ordering.items_base
+                    rule_consequence = ordering.items_add
+                    if (not rule_consequence.isdisjoint(self.class_items)) & (len(rule_consequence) == 1):
+                        rule_base_with_prot_itemset = rule_base.union(prot_itemset.frozenset_notation)
+                        candidate_rules.append(initialize_rule(rule_base_with_prot_itemset, rule_consequence))
+            mining_stage.set_rows(len(data_belonging_to_prot_itemset))
+            mining_stage.set_rules(len(candidate_rules))
+        return candidate_rules
+
     def learn_reject_rules(self, val_data_with_preds):
         class_rules_per_prot_itemset = self.learn_class_rules_associated_with_prot_itemsets(val_data_with_preds)
+        return self.select_reject_rules(class_rules_per_prot_itemset)
 
-        reject_rules_per_prot_itemset = {}
-        for pd_itemset in self.pd_itemsets:
-            if pd_itemset.dict_notation != {}:
-                reject_rules_per_prot_itemset[pd_itemset] = []
-
+    def select_reject_rules(self, class_rules_per_prot_itemset):
         reject_rules_per_prot_itemset = {}
         #could do a more advanced thing here, also taking confidence and everything into account
         for pd_itemset, rules in class_rules_per_prot_itemset.items():
@@ -156,84 +354,167 @@ class IFAC:
                 print(reject_rule)
 
     def learn_reject_thresholds(self, val_data_with_preds):
+        disc_scores = self.compute_disc_scores_of_data_falling_under_rules(val_data_with_preds)
+        self.prepare_reject_threshold_learning(val_data_with_preds, disc_scores)
+        return self.compute_reject_thresholds(self.coverage, self.fairness_weight)
+
+    def compute_disc_scores_of_data_falling_under_rules(self, val_data_with_preds):
         #first need to understand which instances are covered by reject rules
         val_data_covered_by_rules, relevant_rules_per_index = self.extract_data_falling_under_rules(val_data_with_preds)
         #afterwards need to run situation testing
-        sit_test_labels_of_val_data_covered_by_rules, sit_test_info_of_val_data_covered_by_rules = self.situationTester.predict(val_data_covered_by_rules)
+        disc_scores, _, _ = self.situationTester.compute_discrimination_scores(val_data_covered_by_rules, self.instrumentation, self.memory_budget)
+        return disc_scores
+
+    def prepare_reject_threshold_learning(self, val_data_with_preds, disc_scores):
+        with self.instrumentation.stage("threshold learning", n_rows=len(val_data_with_preds)):
+            self.sort_probabilities_for_reject_thresholds(val_data_with_preds, disc_scores)
+
+    def sort_probabilities_for_reject_thresholds(self, val_data_with_preds, disc_scores):
+        sit_test_labels_of_val_data_covered_by_rules = disc_scores > self.sit_test_t
         discriminated_indices = (sit_test_labels_of_val_data_covered_by_rules[sit_test_labels_of_val_data_covered_by_rules == True]).index
 
         unfair_proportion_of_predictions = val_data_with_preds.loc[discriminated_indices]
         fair_proportion_of_predictions = val_data_with_preds[~val_data_with_preds.index.isin(discriminated_indices)]
 
-        n_total_rejections = int((1-self.coverage) * len(val_data_with_preds))
-        n_unfair_rejections = min(int(n_total_rejections * self.fairness_weight), len(unfair_proportion_of_predictions))
+        #the probabilities are sorted only once, afterwards the thresholds for any coverage and fairness weight
+        #come down to an index lookup (see compute_reject_thresholds)
+        self.n_reject_threshold_instances = len(val_data_with_preds)
+        self.unfair_probabilities_descending = np.sort(unfair_proportion_of_predictions['pred. probability'].to_numpy())[::-1]
+        self.fair_probabilities_ascending = np.sort(fair_proportion_of_predictions['pred. probability'].to_numpy())
+
+    def compute_reject_thresholds(self, coverage, fairness_weight):
+        n_total_rejections = int((1-coverage) * self.n_reject_threshold_instances)
+        n_unfair_rejections = min(int(n_total_rejections * fairness_weight), len(self.unfair_probabilities_descending))
         n_uncertainty_rejections = n_total_rejections - n_unfair_rejections
 
-        t_unfair_data = self.decide_on_probability_threshold_unfair_but_certain(unfair_proportion_of_predictions, n_unfair_rejections)
-        t_uncertain_data = self.decide_on_probability_threshold_fair_but_uncertain(fair_proportion_of_predictions, n_uncertainty_rejections)
+        t_unfair_data = self.decide_on_probability_threshold_unfair_but_certain(self.unfair_probabilities_descending, n_unfair_rejections)
+        t_uncertain_data = self.decide_on_probability_threshold_fair_but_uncertain(self.fair_probabilities_ascending, n_uncertainty_rejections)
 
         return t_unfair_data, t_uncertain_data
 
+    #gives the reject thresholds of every (coverage, fairness_weight) combination, without having to fit IFAC again
+    def learn_reject_thresholds_for_grid(self, coverages, fairness_weights):
+        thresholds_per_setting = []
+        for coverage, fairness_weight in itertools.product(coverages, fairness_weights):
+            unfair_and_certain_limit, fair_and_uncertain_limit = self.compute_reject_thresholds(coverage, fairness_weight)
+            thresholds_per_setting.append({"coverage": coverage, "fairness_weight": fairness_weight,
+                                           "unfair_and_certain_limit": unfair_and_certain_limit,
+                                           "fair_and_uncertain_limit": fair_and_uncertain_limit})
+
+        return pd.DataFrame(thresholds_per_setting, columns=["coverage", "fairness_weight", "unfair_and_certain_limit", "fair_and_uncertain_limit"])
+
 
     def extract_data_falling_under_rules(self, data):
         reject_rules_as_list = list(itertools.chain.from_iterable(self.reject_rules.values()))
 
-        data_covered_by_rules = pd.DataFrame([])
-        relevant_rules_per_index = pd.Series([], dtype='float64')
+        with self.instrumentation.stage("rule matching", n_rows=len(data), n_rules=len(reject_rules_as_list)):
+            data_covered_by_rules = pd.DataFrame([])
+            relevant_rules_per_index = pd.Series([], dtype='float64')
 
-        relevant_data = deepcopy(data)
+            #drop returns a new frame, so data itself is never changed
+            relevant_data = data
 
-        for rule in reject_rules_as_list:
-            data_covered_by_rule = get_instances_covered_by_rule(rule, relevant_data)
-            indices_covered_by_rule = pd.Series(rule, index=data_covered_by_rule.index)
-            data_covered_by_rules = pd.concat([data_covered_by_rules, data_covered_by_rule], axis=0)
-            relevant_rules_per_index = pd.concat([relevant_rules_per_index, indices_covered_by_rule])
-            #remove the data that is covered by one rule from rest of relevant data
-            relevant_data = relevant_data.drop(data_covered_by_rule.index)
+            for rule in reject_rules_as_list:
+                data_covered_by_rule = get_instances_covered_by_rule(rule, relevant_data)
+                indices_covered_by_rule = pd.Series(rule, index=data_covered_by_rule.index)
+                data_covered_by_rules = pd.concat([data_covered_by_rules, data_covered_by_rule], axis=0)
+                relevant_rules_per_index = pd.concat([relevant_rules_per_index, indices_covered_by_rule])
+                #remove the data that is covered by one rule from rest of relevant data
+                relevant_data = relevant_data.drop(data_covered_by_rule.index)
 
         return data_covered_by_rules, relevant_rules_per_index
 
     # Meaning of cut_off_probability: if an instance falls under a discriminatory rule and has a high disc score ->
     # Reject from making a prediciton if prob is BIGGER than cut_off_value (unfair but certain)
     # Else (if prob is SMALLER than cut_off_value) than Intervene (unfair and uncertain)
-    def decide_on_probability_threshold_unfair_but_certain(self, relevant_data, n_instances_to_reject):
-        prediction_probs_of_data = relevant_data['pred. probability']
-        ordered_prediction_probs = prediction_probs_of_data.sort_values(ascending=False)
-
-        if (n_instances_to_reject >= len(relevant_data)):
+    # ordered_prediction_probs needs to be sorted in descending order
+    def decide_on_probability_threshold_unfair_but_certain(self, ordered_prediction_probs, n_instances_to_reject):
+        if (n_instances_to_reject >= len(ordered_prediction_probs)):
             cut_off_probability = 0.5
 
         else:
-            cut_off_probability = ordered_prediction_probs.iloc[n_instances_to_reject-1]
+            cut_off_probability = ordered_prediction_probs[n_instances_to_reject-1]
 
         return cut_off_probability
 
     # Meaning of cut_off_probability: if an instance doesn't fall under any of the discrimination rules OR doesn't have a high
     # disc score, then we are only going to reject that instance if it's prediction_probability is SMALLER than the cut_off_probability
-    def decide_on_probability_threshold_fair_but_uncertain(self, relevant_data, n_instances_to_reject):
-        prediction_probs_of_data = relevant_data['pred. probability']
-        ordered_prediction_probs = prediction_probs_of_data.sort_values(ascending=True)
-
-        if (n_instances_to_reject > len(relevant_data)):
+    # ordered_prediction_probs needs to be sorted in ascending order
+    def decide_on_probability_threshold_fair_but_uncertain(self, ordered_prediction_probs, n_instances_to_reject):
+        if (n_instances_to_reject > len(ordered_prediction_probs)):
             cut_off_probability = 0.5
 
         else:
-            cut_off_probability = ordered_prediction_probs.iloc[n_instances_to_reject-1]
+            cut_off_probability = ordered_prediction_probs[n_instances_to_reject-1]
 
         return cut_off_probability
 
+    #predict only reads the fitted model, so one fitted IFAC can be used by multiple threads at the same time
+    #(as long as it isn't refitted meanwhile)
     def predict(self, test_dataset):
+        return self.predict_within_memory_budget(test_dataset, self.memory_budget)
+
+    #With a memory budget, half of it goes to the intermediate frames of predict and the rows are predicted in chunks
+    #whose frames fit in that half. The other half goes to the stages inside predict (black box and kNN), which split
+    #their chunk of rows further when needed
+    def predict_within_memory_budget(self, test_dataset, memory_budget):
+        frame_budget = memory_budget.split(2)
+        n_columns = len(self.encoder.numerical_columns) + len(self.encoder.encoded_categorical_features) + 1
+        chunk_size = frame_budget.compute_chunk_size("predict", len(test_dataset), PREDICTION_BYTES_PER_ITEM * (n_columns + 2))
+        if chunk_size >= len(test_dataset):
+            return self.predict_rows(test_dataset, frame_budget)
+
+        chunk_row_indices = [np.arange(start, end) for start, end in iterate_over_row_chunks(len(test_dataset), chunk_size)]
+        predictions_per_chunk = [self.predict_rows(test_dataset.create_view(row_indices), frame_budget) for row_indices in chunk_row_indices]
+        return self.combine_predictions_of_shards(chunk_row_indices, predictions_per_chunk)
+
+    def predict_rows(self, test_dataset, memory_budget):
         #Step 1: Apply black box classifier, and store predictions
-        test_data_with_preds = self.make_preds_and_preds_proba_for_data(test_dataset)
-        predictions = test_data_with_preds[self.decision_attribute]
+        test_data_with_preds = self.make_preds_and_preds_proba_for_data(test_dataset, memory_budget)
 
         #Step 2: Check which instances fall under reject rules
         test_data_covered_by_rules, relevant_rule_per_index = self.extract_data_falling_under_rules(test_data_with_preds)
 
         #Step 3: Run situation testing on those instances
-        sit_test_labels, sit_test_info = self.situationTester.predict(test_data_covered_by_rules)
+        sit_test_labels, sit_test_info = self.situationTester.predict(test_data_covered_by_rules, self.instrumentation, memory_budget)
         discriminated_indices = (sit_test_labels[sit_test_labels == True]).index
 
+        with self.instrumentation.stage("result assembly", n_rows=len(test_data_with_preds)):
+            return self.assemble_predictions(test_data_with_preds, discriminated_indices, sit_test_info, relevant_rule_per_index)
+
+    #the rows are split into one shard per thread (every thread gets an equal share of the memory budget), the
+    #predictions of the shards are put back together in the order (and with the index) that predict would give for the whole dataset
+    def predict_parallel(self, test_dataset, n_threads=None):
+        if n_threads is None:
+            n_threads = os.cpu_count()
+        shard_row_indices = [row_indices for row_indices in np.array_split(np.arange(len(test_dataset)), n_threads) if len(row_indices) != 0]
+        if len(shard_row_indices) <= 1:
+            return self.predict(test_dataset)
+
+        shards = [test_dataset.create_view(row_indices) for row_indices in shard_row_indices]
+        shard_memory_budget = self.memory_budget.split(len(shards))
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            predictions_per_shard = list(executor.map(lambda shard: self.predict_within_memory_budget(shard, shard_memory_budget), shards))
+        return self.combine_predictions_of_shards(shard_row_indices, predictions_per_shard)
+
+    #shard_row_indices are the positions of the rows of every shard in the whole dataset
+    def combine_predictions_of_shards(self, shard_row_indices, predictions_per_shard):
+        all_predictions = []
+        all_flips = []
+        for row_indices, (predictions, flips) in zip(shard_row_indices, predictions_per_shard):
+            all_predictions.append(predictions.set_axis(row_indices[predictions.index]))
+            all_flips.append(flips.set_axis(row_indices[flips.index.to_numpy(dtype=int)]))
+        predictions = pd.concat(all_predictions)
+        flips = pd.concat(all_flips)
+
+        #predict lists the flipped instances per reject rule (in the order of the rules), and per rule in the order of the rows
+        rule_positions = {id(rule): position for position, rule in enumerate(itertools.chain.from_iterable(self.reject_rules.values()))}
+        flip_order = sorted(range(len(flips)), key=lambda i: (rule_positions[id(flips.iloc[i].rule_reject_is_based_upon)], flips.index[i]))
+        return predictions, flips.iloc[flip_order]
+
+    def assemble_predictions(self, test_data_with_preds, discriminated_indices, sit_test_info, relevant_rule_per_index):
+        predictions = test_data_with_preds[self.decision_attribute]
+
         #Step 4: Divide into fair + unfair counterpart
         unfair_proportion_of_predictions = test_data_with_preds.loc[discriminated_indices]
         fair_proportion_of_predictions = test_data_with_preds[~test_data_with_preds.index.isin(discriminated_indices)]
@@ -276,7 +557,10 @@ class IFAC:
         }, index=to_reject_from_fair_part.index)
         all_uncertainty_based_rejects_series = all_uncertainty_based_rejects_df.apply(create_uncertainty_based_reject, axis=1)
 
-        print("IFAC is rejecting " + str(len(all_unfairness_based_rejects_series) + len(all_uncertainty_based_rejects_series)) + " instances")
+        n_rejected_instances = len(all_unfairness_based_rejects_series) + len(all_uncertainty_based_rejects_series)
+        logger.info("IFAC is rejecting %d instances", n_rejected_instances)
+        self.instrumentation.record_metric("rejected instances", n_rejected_instances)
+        self.instrumentation.record_metric("flipped instances", len(flipped_predictions))
 
         predictions.update(all_unfairness_based_rejects_series)
         predictions.update(all_uncertainty_based_rejects_series)
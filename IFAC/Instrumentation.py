@@ -0,0 +1,325 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import collections
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+
+class StageRecord:
+    def __init__(self, name, details=None, n_rows=None, n_rules=None):
+        self.name = name
+        self.details = details
+        self.n_rows = n_rows
+        self.n_rules = n_rules
+        self.duration = None
+        self.peak_memory_in_bytes = None
+        self.profile = None
+
+    def set_rows(self, n_rows):
+        self.n_rows = n_rows
+
+    def set_rules(self, n_rules):
+        self.n_rules = n_rules
+
+    def to_dict(self):
+        return {"Stage": self.name, "Details": self.details, "Duration (s)": self.duration, "Rows": self.n_rows,
+                "Rules": self.n_rules, "Peak Memory (bytes)": self.peak_memory_in_bytes}
+
+    def profile_to_string(self, sort_by='cumulative', n_lines=20):
+        if self.profile is None:
+            return ""
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats(sort_by).print_stats(n_lines)
+        return stream.getvalue()
+
+    def __str__(self):
+        output_string = self.name
+        if self.details is not None:
+            output_string += " (" + str(self.details) + ")"
+        output_string += f": {self.duration:.4f}s"
+        if self.n_rows is not None:
+            output_string += f", Rows: {self.n_rows}"
+        if self.n_rules is not None:
+            output_string += f", Rules: {self.n_rules}"
+        if self.peak_memory_in_bytes is not None:
+            output_string += f", Peak Memory: {self.peak_memory_in_bytes / 1024**2:.2f}MB"
+        return output_string
+
+
+#with max_records, only the most recent records and metrics are kept, so that a long running process doesn't keep
+#every stage it ever ran
+class InstrumentationReport:
+    def __init__(self, max_records=None):
+        self.max_records = max_records
+        self.records = [] if max_records is None else collections.deque(maxlen=max_records)
+        self.metrics = [] if max_records is None else collections.deque(maxlen=max_records)
+
+    def get_metric_values(self, name):
+        return [value for metric_name, value in self.metrics if metric_name == name]
+
+    def get_records_of_stage(self, name):
+        return [record for record in self.records if record.name == name]
+
+    def to_dataframe(self):
+        return pd.DataFrame([record.to_dict() for record in self.records],
+                            columns=["Stage", "Details", "Duration (s)", "Rows", "Rules", "Peak Memory (bytes)"])
+
+    #one row per stage name, stages that ran multiple times (e.g. rule mining for every pd itemset) are added up
+    def summarize(self):
+        records_df = self.to_dataframe()
+        grouped_records = records_df.groupby("Stage", sort=False)
+        summary_df = grouped_records.agg({"Duration (s)": "sum", "Rows": "sum", "Rules": "sum", "Peak Memory (bytes)": "max"})
+        summary_df.insert(1, "Calls", grouped_records.size())
+        return summary_df.reset_index()
+
+    def __str__(self):
+        return "\n".join(str(record) for record in self.records)
+
+
+#Base class for hooks, subclasses only need to override the methods they are interested in
+class InstrumentationHook:
+    def on_stage_start(self, record):
+        pass
+
+    def on_stage_end(self, record):
+        pass
+
+    def on_metric(self, name, value):
+        pass
+
+
+class StageTimer:
+    def __init__(self, instrumentation, record):
+        self.instrumentation = instrumentation
+        self.record = record
+        self.profiler = None
+
+    def __enter__(self):
+        instrumentation = self.instrumentation
+        for hook in instrumentation.hooks:
+            hook.on_stage_start(self.record)
+
+        if instrumentation.track_memory == 'rss':
+            self.start_rss_tracking()
+        elif instrumentation.track_memory:
+            self.start_memory_tracking()
+
+        #cProfile can't be nested, so stages inside a profiled stage are not profiled themselves
+        if instrumentation.should_profile(self.record.name) and not getattr(instrumentation.local, 'profiling', False):
+            instrumentation.local.profiling = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        self.start_time = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record.duration = time.perf_counter() - self.start_time
+        instrumentation = self.instrumentation
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            instrumentation.local.profiling = False
+            self.record.profile = self.profiler
+
+        if instrumentation.track_memory == 'rss':
+            self.stop_rss_tracking()
+        elif instrumentation.track_memory:
+            self.stop_memory_tracking()
+
+        with instrumentation.lock:
+            instrumentation.report.records.append(self.record)
+        for hook in instrumentation.hooks:
+            hook.on_stage_end(self.record)
+        return False
+
+    #tracemalloc only keeps one peak, so when a stage starts inside another stage, the peak reached so far
+    #is handed to the outer stage before resetting it. tracemalloc is shared by all threads, it keeps tracing as long
+    #as any thread is inside a stage (when stages run in parallel threads, their peaks include each other's memory)
+    def start_memory_tracking(self):
+        instrumentation = self.instrumentation
+        with instrumentation.lock:
+            if instrumentation.n_memory_tracking_stages == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                instrumentation.started_tracing = True
+            instrumentation.n_memory_tracking_stages += 1
+
+        memory_stack = self.instrumentation.get_memory_stack()
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        if len(memory_stack) != 0:
+            memory_stack[-1]['peak'] = max(memory_stack[-1]['peak'], peak_memory)
+        tracemalloc.reset_peak()
+        memory_stack.append({'start': current_memory, 'peak': current_memory})
+
+    def stop_memory_tracking(self):
+        memory_stack = self.instrumentation.get_memory_stack()
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        memory_of_stage = memory_stack.pop()
+        peak_memory = max(memory_of_stage['peak'], peak_memory)
+        self.record.peak_memory_in_bytes = peak_memory - memory_of_stage['start']
+        if len(memory_stack) != 0:
+            memory_stack[-1]['peak'] = max(memory_stack[-1]['peak'], peak_memory)
+
+        instrumentation = self.instrumentation
+        with instrumentation.lock:
+            instrumentation.n_memory_tracking_stages -= 1
+            if instrumentation.n_memory_tracking_stages == 0 and instrumentation.started_tracing:
+                tracemalloc.stop()
+                instrumentation.started_tracing = False
+            elif tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+
+    #The resident set size costs nothing to measure, but the operating system only keeps the peak of the whole process.
+    #When the stage raised that peak, its peak memory is the peak minus the resident set size at its start, otherwise
+    #it is the growth of the resident set size over the stage (a lower bound of its peak). Like tracemalloc, this
+    #includes the memory of stages running in parallel threads
+    def start_rss_tracking(self):
+        self.start_peak_rss = get_peak_rss()
+        self.start_rss = get_current_rss()
+
+    def stop_rss_tracking(self):
+        peak_rss = get_peak_rss()
+        if peak_rss is None:
+            return
+        current_rss = get_current_rss()
+        if self.start_rss is None or current_rss is None:
+            self.record.peak_memory_in_bytes = peak_rss - self.start_peak_rss
+        elif peak_rss > self.start_peak_rss:
+            self.record.peak_memory_in_bytes = max(peak_rss - self.start_rss, 0)
+        else:
+            self.record.peak_memory_in_bytes = max(current_rss - self.start_rss, 0)
+
+
+#the peak resident set size of the process in bytes, None where the resource module doesn't exist (Windows)
+def get_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #macOS reports bytes, Linux kilobytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+#the current resident set size of the process in bytes, None where /proc doesn't exist
+def get_current_rss():
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class Instrumentation:
+    #profile_stages can be a list of stage names or "all"
+    #metrics like the accuracy of the black box are only computed when record_metrics is True
+    #track_memory=True measures the peak memory of every stage exactly with tracemalloc, which slows down the stages
+    #considerably, track_memory='rss' measures it from the resident set size of the process at almost no cost
+    #max_records limits the report to the most recent records
+    def __init__(self, hooks=None, track_memory=False, profile_stages=None, record_metrics=True, max_records=None):
+        self.hooks = [] if hooks is None else list(hooks)
+        self.record_metrics = record_metrics
+        self.track_memory = track_memory
+        self.profile_stages = profile_stages
+        self.max_records = max_records
+        self.report = InstrumentationReport(max_records)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.n_memory_tracking_stages = 0
+        self.started_tracing = False
+
+    def stage(self, name, details=None, n_rows=None, n_rules=None):
+        return StageTimer(self, StageRecord(name, details, n_rows, n_rules))
+
+    def record_metric(self, name, value):
+        if not self.record_metrics:
+            return
+        with self.lock:
+            self.report.metrics.append((name, value))
+        for hook in self.hooks:
+            hook.on_metric(name, value)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def should_profile(self, name):
+        if self.profile_stages is None:
+            return False
+        return self.profile_stages == "all" or name in self.profile_stages
+
+    def get_memory_stack(self):
+        if not hasattr(self.local, 'memory_stack'):
+            self.local.memory_stack = []
+        return self.local.memory_stack
+
+    def reset(self):
+        self.report = InstrumentationReport(self.max_records)
+
+    #the thread local storage, the lock and the recorded profiles can't be pickled, so a pickled
+    #model gets a fresh report when it is loaded
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['local']
+        del state['lock']
+        del state['report']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.report = InstrumentationReport(state.get('max_records'))
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.n_memory_tracking_stages = 0
+        self.started_tracing = False
+
+
+class DisabledStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_rows(self, n_rows):
+        pass
+
+    def set_rules(self, n_rules):
+        pass
+
+
+#Used whenever no instrumentation is given, it hands out the same do-nothing stage every time so it costs next to nothing
+class DisabledInstrumentation:
+    disabled_stage = DisabledStage()
+    record_metrics = False
+
+    def stage(self, name, details=None, n_rows=None, n_rules=None):
+        return self.disabled_stage
+
+    def record_metric(self, name, value):
+        pass
+
+
+DISABLED_INSTRUMENTATION = DisabledInstrumentation()
+
+
+def get_instrumentation(instrumentation):
+    if instrumentation is None:
+        return DISABLED_INSTRUMENTATION
+    return instrumentation
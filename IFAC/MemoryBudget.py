@@ -0,0 +1,93 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .Instrumentation import InstrumentationHook
+import logging
+import numbers
+import re
+
+logger = logging.getLogger(__name__)
+
+MEMORY_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+
+
+#The stages whose memory grows with the size of the data ask the budget how many rows they can process at once
+#(compute_chunk_size) or whether they fit at all (check). The sizes are estimated from the row counts and dtypes before
+#anything is allocated, so a stage that can't fit fails right away instead of after minutes of work.
+#A budget without a limit lets every stage process all of its rows at once
+class MemoryBudget:
+    def __init__(self, memory_limit=None):
+        self.memory_limit = parse_memory_limit(memory_limit)
+
+    def is_limited(self):
+        return self.memory_limit is not None
+
+    #the largest number of rows (at most n_rows, at least 1) for which fixed_bytes plus bytes_per_row for every row
+    #stays within the limit
+    def compute_chunk_size(self, stage, n_rows, bytes_per_row, fixed_bytes=0):
+        if self.memory_limit is None:
+            return max(n_rows, 1)
+        self.check(stage, fixed_bytes + bytes_per_row, what="one row")
+        chunk_size = (self.memory_limit - fixed_bytes) // max(bytes_per_row, 1)
+        return int(max(min(chunk_size, n_rows), 1))
+
+    def check(self, stage, required_bytes, what=None):
+        if self.memory_limit is not None and required_bytes > self.memory_limit:
+            stage_description = stage if what is None else f"{stage} ({what})"
+            raise ValueError(f"{stage_description} needs about {format_memory(required_bytes)}, which exceeds the memory limit of {format_memory(self.memory_limit)}")
+
+    #for stages that run in parallel threads, every thread gets an equal share of the budget
+    def split(self, n_parts):
+        if self.memory_limit is None:
+            return self
+        return MemoryBudget(self.memory_limit // n_parts)
+
+
+#Warns when the peak memory that was measured for a stage (with Instrumentation(track_memory=True) or track_memory='rss') exceeds the limit,
+#which means that the estimate of that stage was too low
+class MemoryLimitHook(InstrumentationHook):
+    def __init__(self, memory_limit):
+        self.memory_limit = parse_memory_limit(memory_limit)
+
+    def on_stage_end(self, record):
+        if record.peak_memory_in_bytes is not None and record.peak_memory_in_bytes > self.memory_limit:
+            logger.warning("%s used %s at its peak, which exceeds the memory limit of %s", record.name,
+                           format_memory(record.peak_memory_in_bytes), format_memory(self.memory_limit))
+
+
+#a number of bytes (also a float like 4e9 or a NumPy integer) or a string like '512MB' or '4 GB'
+def parse_memory_limit(memory_limit):
+    if memory_limit is None:
+        parsed_memory_limit = None
+    elif isinstance(memory_limit, numbers.Real) and not isinstance(memory_limit, bool):
+        parsed_memory_limit = int(memory_limit)
+    else:
+        match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([KMGT]?B)\s*", str(memory_limit).upper())
+        if match is None:
+            raise ValueError(f"Can't read the memory limit {memory_limit}, give a number of bytes or a string like '512MB'")
+        parsed_memory_limit = int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+    if parsed_memory_limit is not None and parsed_memory_limit <= 0:
+        raise ValueError("The memory limit has to be positive")
+    return parsed_memory_limit
+
+
+def format_memory(n_bytes):
+    return f"{n_bytes / 1024**2:.2f}MB"
+
+
+UNLIMITED_MEMORY_BUDGET = MemoryBudget()
+
+
+def get_memory_budget(memory_budget):
+    if memory_budget is None:
+        return UNLIMITED_MEMORY_BUDGET
+    return memory_budget
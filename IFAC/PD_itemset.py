@@ -66,7 +66,7 @@ def generate_potentially_discriminated_itemsets(data, sensitive_attributes):
     unique_values_per_sens_attribute = dict()
 
     for sens_attribute in sensitive_attributes:
-        unique_values_of_sens_attribute = pd.unique(data.descriptive_data[sens_attribute])
+        unique_values_of_sens_attribute = pd.unique(data.get_column(sens_attribute))
         unique_values_per_sens_attribute[sens_attribute] = unique_values_of_sens_attribute
 
     all_pd_itemsets = []
@@ -26,6 +26,11 @@ class Reject:
         reject_str_pres += "\nPrediction Probability: " + str(self.prediction_probability)
         return reject_str_pres
 
+    #the reason and the explanation of the reject, without the instance itself
+    def to_dict(self):
+        return {'reason': self.reject_threat, 'prediction_without_reject': self.prediction_without_reject,
+                'prediction_probability': float(self.prediction_probability)}
+
 
 
 class UnfairnessFlip(Reject):
@@ -34,6 +39,12 @@ class UnfairnessFlip(Reject):
         self.sit_test_summary = sit_test_summary
         self.rule_reject_is_based_upon = rule_flip_is_based_upon
 
+    def to_dict(self):
+        reject_dict = Reject.to_dict(self)
+        reject_dict['rule'] = self.rule_reject_is_based_upon.to_dict()
+        reject_dict['situation_testing'] = None if self.sit_test_summary is None else self.sit_test_summary.to_dict()
+        return reject_dict
+
     def __str__(self):
         str_pres = Reject.__str__(self)
         str_pres += "\nFlip Based on this rule\n"
@@ -52,6 +63,12 @@ class UnfairnessReject(Reject):
         self.rule_reject_is_based_upon = rule_reject_is_based_upon
 
 
+    def to_dict(self):
+        reject_dict = Reject.to_dict(self)
+        reject_dict['rule'] = self.rule_reject_is_based_upon.to_dict()
+        reject_dict['situation_testing'] = None if self.sit_test_summary is None else self.sit_test_summary.to_dict()
+        return reject_dict
+
     def __str__(self):
         str_pres = Reject.__str__(self)
         str_pres += "\nRejection Based on this rule\n"
@@ -96,4 +113,18 @@ def create_uncertainty_based_reject(row):
         instance=row['instance'],
         prediction_without_reject=row['prediction_without_reject'],
         prediction_probability=row['prediction probability'],
-    )
\ No newline at end of file
+    )
+
+
+#predictions and flips are what IFAC.predict returns for an instance
+def convert_decision_to_dict(prediction, flip=None):
+    if isinstance(prediction, Reject):
+        decision = {'decision': None, 'status': 'reject'}
+        decision.update(prediction.to_dict())
+    elif flip is not None:
+        decision = {'decision': prediction, 'status': 'flip'}
+        decision.update(flip.to_dict())
+        decision['reason'] = "Unfairness Flip"
+    else:
+        decision = {'decision': prediction, 'status': 'prediction'}
+    return decision
@@ -11,9 +11,10 @@
 # limitations under the License.
 
 from copy import deepcopy
-from scipy import stats
 from math import sqrt
 
+APRIORI_BYTES_PER_ITEM = 256
+
 class Rule:
     def __init__(self, rule_base, rule_consequence, support=0, confidence=0, lift=0, slift=0, slift_p_value=0):
         self.rule_base = rule_base
@@ -36,6 +37,11 @@ class Rule:
     def set_slift_p_value(self, p_value):
         self.slift_p_value = p_value
 
+    #a JSON friendly description of the rule, e.g. for the decisions of the scoring server
+    def to_dict(self):
+        return {'rule_base': dict(self.rule_base), 'rule_consequence': dict(self.rule_consequence), 'support': float(self.support),
+                'confidence': float(self.confidence), 'lift': float(self.lift), 'slift': float(self.slift), 'slift_p_value': float(self.slift_p_value)}
+
     def __str__(self):
         output_string = "("
         counter = 1
@@ -116,17 +122,28 @@ def initialize_rule(rule_base_frozenset, rule_consequence_frozenset):
     rule = Rule(rule_base_dict, rule_consequence_dict)
     return rule
 
+#every item string ('key : value') is made once and shared by all transactions that contain it, which keeps the
+#transactions small for large data
 def convert_to_apriori_format(X):
-    list_of_dicts_format = X.to_dict('records')
+    item_strings = {}
     list_of_lists = []
-    for dictionary in list_of_dicts_format:
+    for values in zip(*(X[key].tolist() for key in X.columns)):
         one_entry = set()
-        for key, value in dictionary.items():
-            one_entry.add(key + " : " + str(value))
+        for key, value in zip(X.columns, values):
+            item_string = item_strings.get((key, value))
+            if item_string is None:
+                item_string = item_strings[(key, value)] = key + " : " + str(value)
+            one_entry.add(item_string)
         list_of_lists.append(one_entry)
     return list_of_lists
 
 
+#the memory that apriori needs for the transactions of n_rows rows with n_columns items each: the transactions
+#themselves and the index of the transactions that contain each item (measured with tracemalloc on the income data)
+def estimate_apriori_memory(n_rows, n_columns):
+    return n_rows * n_columns * APRIORI_BYTES_PER_ITEM
+
+
 #rule come in this format {'rule_base': {'sex': 'Male'}, 'rule_consequence': {'income': '<=50K'}, 'support': 0.46460489542704464, 'confidence': 0.6942634235888022, 'lift': 0.9144786138946193}
 def calculate_support_conf_slift_and_significance(rule, data, protected_itemset):
     pd_itemset_dict_notation = protected_itemset.dict_notation
@@ -225,6 +242,7 @@ def calculate_significance_of_slift(number_instances_covered_by_org_rule_base, n
 
     Z = (confidence_org_rule-confidence_reference_pd_rule) / sqrt((total_proportion_both_groups * (1 - total_proportion_both_groups) * ((1 / number_instances_covered_by_complete_org_rule) + (1 / number_instances_covered_by_complete_ref_rule))))
 
+    from scipy import stats
     p_value = stats.norm.sf(abs(Z))*2
     return p_value
 
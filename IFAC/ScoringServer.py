@@ -0,0 +1,325 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .Reject import convert_decision_to_dict
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import asyncio
+import copy
+import json
+import logging
+import numbers
+import pickle
+import time
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+#requests with a larger body are refused, a single request can still hold thousands of instances
+MAX_REQUEST_BODY_SIZE = 16 * 1024**2
+#the latency percentiles of the stats endpoint are computed over this many of the most recent requests
+LATENCY_WINDOW_SIZE = 10000
+
+
+#Serves a fitted IFAC over local HTTP (host and port) or a Unix socket:
+#   POST /score with {"instances": [{...}, ...]} (or a single instance) returns {"decisions": [...]}
+#   GET /stats returns the throughput, the p50/p99 latency and a histogram of the batch sizes
+#Requests that arrive at the same time are scored together: a batch is closed when it holds max_batch_size instances,
+#or max_wait_time seconds after its first request arrived. Every batch becomes one Dataset and one call of predict,
+#which runs in a worker thread while the next batch is being collected
+class ScoringServer:
+    def __init__(self, ifac, max_batch_size=64, max_wait_time=0.005, host='127.0.0.1', port=8080, unix_socket_path=None):
+        #compiled trees score small batches without sklearn's per call overhead, with the same probabilities. They are
+        #compiled into a copy of the black box, so the IFAC that was passed in is left as it is
+        if ifac.BB.classifier_name in ['Decision Tree', 'Random Forest'] and ifac.BB.compiled_classifier is None:
+            ifac = copy.copy(ifac)
+            ifac.BB = copy.copy(ifac.BB)
+            ifac.BB.compile_trees()
+        self.ifac = ifac
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.host = host
+        self.port = port
+        self.unix_socket_path = unix_socket_path
+        #the columns every instance has to describe, the decision attribute is what is being predicted
+        self.feature_columns = [column for column in ifac.fit_data.storage.columns if column != ifac.decision_attribute]
+        self.known_values = get_known_values(ifac.encoder)
+        self.stats = ScoringStats()
+        self.server = None
+
+    #a fitted IFAC that was stored with pickle
+    @staticmethod
+    def from_model_file(model_path, **kwargs):
+        with open(model_path, 'rb') as model_file:
+            ifac = pickle.load(model_file)
+        return ScoringServer(ifac, **kwargs)
+
+    def run(self):
+        asyncio.run(self.serve_forever())
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def start(self):
+        self.request_queue = asyncio.Queue()
+        self.batching_task = asyncio.create_task(self.score_batches())
+        if self.unix_socket_path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=self.unix_socket_path)
+            logger.info("Scoring server listening on %s", self.unix_socket_path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host=self.host, port=self.port)
+            #with port 0 the operating system picks a free port
+            self.port = self.server.sockets[0].getsockname()[1]
+            logger.info("Scoring server listening on http://%s:%d", self.host, self.port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batching_task.cancel()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_http_request(reader)
+                except ValueError as error:
+                    write_http_response(writer, HTTPStatus.BAD_REQUEST, {'error': str(error)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, response = await self.handle_request(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                write_http_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        #connections that are still open when the server stops are cancelled while they wait for a request
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, path, body):
+        if path == '/stats' and method == 'GET':
+            return HTTPStatus.OK, self.stats.to_dict()
+        if path != '/score':
+            return HTTPStatus.NOT_FOUND, {'error': f"Unknown endpoint {path}, use POST /score or GET /stats"}
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED, {'error': "Instances are scored with POST /score"}
+
+        start_time = time.perf_counter()
+        try:
+            records = self.parse_instances(body)
+        except ValueError as error:
+            self.stats.record_error()
+            return HTTPStatus.BAD_REQUEST, {'error': str(error)}
+
+        decisions_future = asyncio.get_running_loop().create_future()
+        await self.request_queue.put((records, decisions_future))
+        try:
+            decisions = await decisions_future
+        except Exception as error:
+            self.stats.record_error()
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f"Scoring failed: {error}"}
+        self.stats.record_request(time.perf_counter() - start_time, len(records))
+        return HTTPStatus.OK, {'decisions': decisions}
+
+    def parse_instances(self, body):
+        try:
+            request_content = json.loads(body)
+        except json.JSONDecodeError as error:
+            raise ValueError(f"The request body isn't valid JSON: {error}")
+        records = request_content.get('instances', [request_content]) if isinstance(request_content, dict) else None
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            raise ValueError("Send an instance as a JSON object, or several as {\"instances\": [...]}")
+        for position, record in enumerate(records):
+            missing_columns = [column for column in self.feature_columns if column not in record]
+            if len(missing_columns) != 0:
+                raise ValueError(f"Instance {position} is missing: {missing_columns}")
+            unknown_values = {column: record[column] for column in self.feature_columns if not self.is_known_value(column, record[column])}
+            if len(unknown_values) != 0:
+                raise ValueError(f"Instance {position} has unknown values: {unknown_values}")
+        return records
+
+    #categorical and ordinal values have to be in the vocabulary of the encoder, the other columns have to be numbers
+    def is_known_value(self, column, value):
+        if column not in self.known_values:
+            return isinstance(value, numbers.Real) and not isinstance(value, bool) and np.isfinite(value)
+        try:
+            return value in self.known_values[column]
+        except TypeError:
+            return False
+
+    #collects the waiting requests into batches and scores every batch in a worker thread
+    async def score_batches(self):
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                batch = [await self.request_queue.get()]
+                n_instances = len(batch[0][0])
+                deadline = loop.time() + self.max_wait_time
+                while n_instances < self.max_batch_size:
+                    #requests that are already waiting are always taken, otherwise the batch waits until its deadline
+                    if self.request_queue.empty():
+                        remaining_wait_time = deadline - loop.time()
+                        if remaining_wait_time <= 0:
+                            break
+                        try:
+                            queued_request = await asyncio.wait_for(self.request_queue.get(), timeout=remaining_wait_time)
+                        except asyncio.TimeoutError:
+                            break
+                    else:
+                        queued_request = self.request_queue.get_nowait()
+                    batch.append(queued_request)
+                    n_instances += len(queued_request[0])
+
+                self.stats.record_batch(n_instances)
+                try:
+                    decisions_per_request = await loop.run_in_executor(executor, self.score_requests, [records for records, _ in batch])
+                except Exception as error:
+                    logger.exception("Scoring a batch of %d requests failed", len(batch))
+                    decisions_per_request = [error] * len(batch)
+                for (_, decisions_future), decisions in zip(batch, decisions_per_request):
+                    if decisions_future.done():
+                        continue
+                    if isinstance(decisions, Exception):
+                        decisions_future.set_exception(decisions)
+                    else:
+                        decisions_future.set_result(decisions)
+
+    #When the batch as a whole can't be scored (e.g. one instance has a value the distance function doesn't know),
+    #the requests are scored one by one, so only the requests that cause the error fail
+    def score_requests(self, records_per_request):
+        all_records = [record for records in records_per_request for record in records]
+        try:
+            decisions = self.score_records(all_records)
+        except Exception:
+            if len(records_per_request) == 1:
+                raise
+            decisions_per_request = []
+            for records in records_per_request:
+                try:
+                    decisions_per_request.append(self.score_records(records))
+                except Exception as error:
+                    decisions_per_request.append(error)
+            return decisions_per_request
+
+        decisions_per_request = []
+        start = 0
+        for records in records_per_request:
+            decisions_per_request.append(decisions[start:start + len(records)])
+            start += len(records)
+        return decisions_per_request
+
+    def score_records(self, records):
+        if len(records) == 0:
+            return []
+        descriptive_data = pd.DataFrame.from_records(records, columns=self.feature_columns)
+        dataset = self.ifac.fit_data.create_dataset_from_descriptive_data(descriptive_data)
+        predictions, flips = self.ifac.predict(dataset)
+        flip_per_row = dict(zip(flips.index, flips))
+        return [convert_decision_to_dict(prediction, flip_per_row.get(row)) for row, prediction in zip(predictions.index, predictions)]
+
+
+#the values the encoder knows for every categorical and ordinal column, unknown values would silently be encoded as
+#all zeros or as NaN
+def get_known_values(encoder):
+    known_values = {column: set(encoder.vocabularies[column]) for column in encoder.encoded_categorical_features}
+    for column, (vocabulary, _) in encoder.ordinal_vocabularies.items():
+        known_values[column] = set(vocabulary)
+    return known_values
+
+
+class ScoringStats:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.n_requests = 0
+        self.n_instances = 0
+        self.n_errors = 0
+        self.n_batches = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW_SIZE)
+        #the number of batches per number of instances in the batch
+        self.batch_size_counts = Counter()
+
+    def record_request(self, latency, n_instances):
+        self.n_requests += 1
+        self.n_instances += n_instances
+        self.latencies.append(latency)
+
+    def record_error(self):
+        self.n_errors += 1
+
+    def record_batch(self, n_instances):
+        self.n_batches += 1
+        self.batch_size_counts[n_instances] += 1
+
+    def to_dict(self):
+        uptime = time.perf_counter() - self.start_time
+        latencies_in_ms = 1000 * np.array(self.latencies)
+        return {
+            'uptime_s': uptime,
+            'requests': self.n_requests,
+            'instances': self.n_instances,
+            'errors': self.n_errors,
+            'batches': self.n_batches,
+            'requests_per_s': self.n_requests / uptime,
+            'instances_per_s': self.n_instances / uptime,
+            'latency_ms': {'p50': float(np.percentile(latencies_in_ms, 50)) if len(latencies_in_ms) != 0 else None,
+                           'p99': float(np.percentile(latencies_in_ms, 99)) if len(latencies_in_ms) != 0 else None,
+                           'mean': float(latencies_in_ms.mean()) if len(latencies_in_ms) != 0 else None},
+            'batch_size_histogram': {str(batch_size): count for batch_size, count in sorted(self.batch_size_counts.items())}}
+
+
+#returns (method, path, headers, body), or None when the client closed the connection
+async def read_http_request(reader):
+    request_line = await reader.readline()
+    if len(request_line) == 0:
+        return None
+    request_line_parts = request_line.decode('latin-1').split()
+    if len(request_line_parts) != 3:
+        raise ValueError("Malformed request line")
+    method, target, _ = request_line_parts
+
+    headers = {}
+    while True:
+        header_line = await reader.readline()
+        if header_line in (b'\r\n', b'\n', b''):
+            break
+        name, separator, value = header_line.decode('latin-1').partition(':')
+        if separator == '':
+            raise ValueError("Malformed header line")
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = int(headers.get('content-length', 0))
+    if content_length > MAX_REQUEST_BODY_SIZE:
+        raise ValueError(f"The request body is larger than {MAX_REQUEST_BODY_SIZE} bytes")
+    body = await reader.readexactly(content_length) if content_length > 0 else b''
+    return method.upper(), target.split('?')[0], headers, body
+
+
+def write_http_response(writer, status, content, keep_alive=True):
+    body = json.dumps(content, default=convert_to_json_value).encode()
+    header = (f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(header.encode('latin-1') + body)
+
+
+#the labels and probabilities that come from sklearn are NumPy values
+def convert_to_json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} can't be written as JSON")
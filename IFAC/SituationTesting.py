@@ -11,23 +11,26 @@
 # limitations under the License.
 
 import pandas as pd
-from copy import deepcopy
 from .Rule import get_instances_covered_by_rule_base
-from scipy.spatial.distance import cdist
-from load_datasets import distance_function_income_pred
+from .Instrumentation import get_instrumentation
+from .MemoryBudget import get_memory_budget
+from ColumnStorage import iterate_over_row_chunks
 
+#distance_function compares two instances (rows of descriptive data), it is the distance_function of the Dataset
 class SituationTesting:
-    def __init__(self, reference_group_list, decision_label, desirable_label, k, t):
+    def __init__(self, reference_group_list, decision_label, desirable_label, k, t, distance_function):
         self.reference_group_list = reference_group_list
         self.decision_label = decision_label
         self.desirable_label = desirable_label
         self.k = k
         self.t = t
+        self.distance_function = distance_function
 
     #the data argument that is passed here will be used for the kNN comparison
     def fit(self, data):
         #we need to divide the data into the instances that are part of the reference group, and the ones that are not
-        relevant_data = deepcopy(data)
+        #the selections and drops below all return new frames, so data itself is never changed
+        relevant_data = data
         self.all_reference_group_data = pd.DataFrame([])
         for reference_group in self.reference_group_list:
             reference_group_data = get_instances_covered_by_rule_base(reference_group, relevant_data)
@@ -37,8 +40,24 @@ class SituationTesting:
         return
 
 
-    def compute_k_nearest_neighbours_of_reference_and_non_reference(self, dataset):
-        distance_matrix_to_non_reference = cdist(dataset, self.non_reference_group_data, metric=distance_function_income_pred)
+    #The distance matrices hold one float per pair of an instance and a neighbour candidate. With a memory budget, the
+    #instances are processed in chunks so that the distance matrices of one chunk fit in the budget
+    def compute_k_nearest_neighbours_of_reference_and_non_reference(self, dataset, memory_budget=None):
+        n_candidates = len(self.non_reference_group_data) + len(self.all_reference_group_data)
+        #next to the float distances (which are also wrapped in frames), cdist turns the instances and the candidates into object arrays
+        chunk_size = get_memory_budget(memory_budget).compute_chunk_size("kNN", len(dataset), bytes_per_row=8 * (2 * n_candidates + 2 * dataset.shape[1]),
+                                                                         fixed_bytes=8 * n_candidates * dataset.shape[1])
+        if chunk_size >= len(dataset):
+            return self.compute_k_nearest_neighbours_of_chunk(dataset)
+
+        neighbours_per_chunk = [self.compute_k_nearest_neighbours_of_chunk(dataset.iloc[start:end]) for start, end in iterate_over_row_chunks(len(dataset), chunk_size)]
+        nearest_non_reference_neighbors_df = pd.concat([non_reference_neighbours for non_reference_neighbours, _ in neighbours_per_chunk])
+        nearest_reference_neighbors_df = pd.concat([reference_neighbours for _, reference_neighbours in neighbours_per_chunk])
+        return nearest_non_reference_neighbors_df, nearest_reference_neighbors_df
+
+    def compute_k_nearest_neighbours_of_chunk(self, dataset):
+        from scipy.spatial.distance import cdist
+        distance_matrix_to_non_reference = cdist(dataset, self.non_reference_group_data, metric=self.distance_function)
         distance_df_to_non_reference = pd.DataFrame(distance_matrix_to_non_reference, index=dataset.index, columns=self.non_reference_group_data.index)
 
         # Find the k nearest neighbors of the non_reference_group for each index in the dataset
@@ -49,7 +68,7 @@ class SituationTesting:
 
 
         distance_matrix_to_reference = cdist(dataset, self.all_reference_group_data,
-                                                 metric=distance_function_income_pred)
+                                                 metric=self.distance_function)
         distance_df_to_reference = pd.DataFrame(distance_matrix_to_reference, index=dataset.index,
                                                     columns=self.all_reference_group_data.index)
 
@@ -67,14 +86,24 @@ class SituationTesting:
         return positive_decision_count/ len(neighbours_indices)  # Compute the ratio
 
 
-    #return true if instance is being discriminated
-    def predict(self, data):
-        nearest_non_reference_neighbors_df, nearest_reference_neighbors_df = self.compute_k_nearest_neighbours_of_reference_and_non_reference(data)
+    #the discrimination scores don't depend on t, so they can be reused when only t changes
+    def compute_discrimination_scores(self, data, instrumentation=None, memory_budget=None):
+        with get_instrumentation(instrumentation).stage("kNN", n_rows=len(data)):
+            nearest_non_reference_neighbors_df, nearest_reference_neighbors_df = self.compute_k_nearest_neighbours_of_reference_and_non_reference(data, memory_budget)
+        #apply returns an empty frame instead of a series when there are no instances (e.g. when a small batch has no
+        #instances that fall under a reject rule)
+        if len(data) == 0:
+            return pd.Series([], index=data.index, dtype='float64'), nearest_non_reference_neighbors_df, nearest_reference_neighbors_df
 
         pos_ratio_non_reference_neighbours = nearest_non_reference_neighbors_df.apply(lambda row: self.positive_decision_ratio(self.non_reference_group_data, row), axis=1)
         pos_ratio_reference_neighbours = nearest_reference_neighbors_df.apply(lambda row: self.positive_decision_ratio(self.all_reference_group_data, row), axis=1)
 
         disc_scores = pos_ratio_reference_neighbours - pos_ratio_non_reference_neighbours
+        return disc_scores, nearest_non_reference_neighbors_df, nearest_reference_neighbors_df
+
+    #return true if instance is being discriminated
+    def predict(self, data, instrumentation=None, memory_budget=None):
+        disc_scores, nearest_non_reference_neighbors_df, nearest_reference_neighbors_df = self.compute_discrimination_scores(data, instrumentation, memory_budget)
         disc_labels = disc_scores>self.t
 
         combined_situation_test_info_df = pd.DataFrame({
@@ -84,7 +113,10 @@ class SituationTesting:
             'closest_reference': nearest_reference_neighbors_df.values.tolist()
         }, index=data.index)
 
-        sit_test_info = combined_situation_test_info_df.apply(create_sit_test_info, axis=1)
+        if len(data) == 0:
+            sit_test_info = pd.Series([], index=data.index, dtype=object)
+        else:
+            sit_test_info = combined_situation_test_info_df.apply(create_sit_test_info, axis=1)
 
         return disc_labels, sit_test_info
 
@@ -99,6 +131,10 @@ class SituationTestingInfo:
         self.closest_reference = closest_reference
 
 
+    def to_dict(self):
+        return {'disc_score': float(self.disc_score), 'closest_reference': list(self.closest_reference),
+                'closest_non_reference': list(self.closest_non_reference)}
+
     def __str__(self):
         str_repr = f"Disc Score: {self.disc_score:.2f}"
         str_repr += "\nClosest neighbours from reference group:\n"
@@ -114,4 +150,4 @@ def create_sit_test_info(row):
         discriminated_label=row['disc_label'],
         closest_non_reference=row['closest_non_reference'],
         closest_reference=row['closest_reference']
-    )
\ No newline at end of file
+    )
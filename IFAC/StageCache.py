@@ -0,0 +1,90 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import pickle
+
+#increase whenever the artifacts that are stored for a stage change, so that old cache entries are not used anymore
+CACHE_FORMAT_VERSION = 2
+
+
+class StageCache:
+    def __init__(self, cache_dir, max_size_in_bytes=1024**3):
+        self.cache_dir = cache_dir
+        self.max_size_in_bytes = max_size_in_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def contains(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def load(self, key):
+        path = self.get_path(key)
+        with open(path, 'rb') as cache_file:
+            artifacts = pickle.load(cache_file)
+        #the modification time is used as last access time when deciding which entries to evict
+        os.utime(path)
+        return artifacts
+
+    def store(self, key, artifacts):
+        path = self.get_path(key)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'wb') as cache_file:
+            pickle.dump(artifacts, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        #replacing is atomic, so a job that gets interrupted never leaves a half written entry behind
+        os.replace(temporary_path, path)
+        self.evict(keep_key=key)
+
+    #removes the least recently used entries until the cache is smaller than max_size_in_bytes
+    def evict(self, keep_key=None):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".pkl"):
+                file_stats = os.stat(os.path.join(self.cache_dir, file_name))
+                entries.append((file_stats.st_mtime, file_stats.st_size, file_name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size_in_bytes:
+                break
+            if keep_key is not None and file_name == keep_key + ".pkl":
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".pkl"):
+                os.remove(os.path.join(self.cache_dir, file_name))
+
+
+#the key of a stage combines the key of the stage before it (which covers the data and all earlier parameters)
+#with the parameters that are used in the stage itself
+def compute_stage_key(previous_key, stage, parameters):
+    hasher = hashlib.sha256()
+    key_parameters = sorted((name, get_key_value(value)) for name, value in parameters.items())
+    hasher.update(repr((CACHE_FORMAT_VERSION, previous_key, stage, key_parameters)).encode())
+    return hasher.hexdigest()
+
+
+#the repr of an object (e.g. a shared BlackBoxClassifier) holds its memory address, which differs between runs and can
+#be reused by another object within a run, so objects are identified by their fingerprint instead
+def get_key_value(value):
+    if hasattr(value, 'compute_fingerprint'):
+        return value.compute_fingerprint()
+    return value
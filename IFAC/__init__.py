@@ -11,4 +11,6 @@
 # limitations under the License.
 
 from .IFAC import IFAC
-from .BlackBoxClassifier import BlackBoxClassifier
\ No newline at end of file
+from .BlackBoxClassifier import BlackBoxClassifier
+from .Instrumentation import Instrumentation, InstrumentationHook
+from .ScoringServer import ScoringServer
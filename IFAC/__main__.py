@@ -0,0 +1,197 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#Scores a file of instances with a fitted IFAC that was stored with pickle, chunk by chunk:
+#   python -m IFAC score --model ifac.pkl --input instances.parquet --output decisions.parquet
+#The input can be a csv, Parquet or Arrow IPC file (by its extension), the output gets the columns of the input and
+#the decision columns, in a format that is also chosen by its extension
+
+import argparse
+import logging
+import os
+import pickle
+import sys
+import time
+import pandas as pd
+from .MemoryBudget import MemoryBudget
+from .Reject import Reject, convert_decision_to_dict
+from ColumnStorage import import_pyarrow_module
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCORING_CHUNK_SIZE = 10000
+DECISION_COLUMNS = ['decision', 'status', 'reason', 'prediction_without_reject', 'prediction_probability', 'rule', 'disc_score']
+PARQUET_EXTENSIONS = ['.parquet', '.pq']
+ARROW_EXTENSIONS = ['.arrow', '.feather', '.ipc']
+
+
+def load_model(model_path):
+    with open(model_path, 'rb') as model_file:
+        return pickle.load(model_file)
+
+
+def get_file_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in PARQUET_EXTENSIONS:
+        return 'parquet'
+    if extension in ARROW_EXTENSIONS:
+        return 'arrow'
+    raise ValueError(f"Can't tell the format of {path}, use a .csv, .parquet or .arrow file")
+
+
+#DataFrames of at most chunk_size rows, only one chunk of the file is held in memory at a time
+def read_input_chunks(input_path, chunk_size):
+    file_format = get_file_format(input_path)
+    if file_format == 'csv':
+        yield from pd.read_csv(input_path, chunksize=chunk_size)
+    elif file_format == 'parquet':
+        pq = import_pyarrow_module('pyarrow.parquet')
+        for record_batch in pq.ParquetFile(input_path, memory_map=True).iter_batches(batch_size=chunk_size):
+            yield record_batch.to_pandas()
+    else:
+        pa = import_pyarrow_module('pyarrow')
+        reader = pa.ipc.open_file(pa.memory_map(input_path, 'r'))
+        for batch in range(reader.num_record_batches):
+            record_batch = reader.get_batch(batch)
+            for start in range(0, record_batch.num_rows, chunk_size):
+                yield record_batch.slice(start, chunk_size).to_pandas()
+
+
+#Appends the chunks to the output file as they come. The Arrow schema of the output is taken from the first chunk,
+#the decision columns get fixed types, as a chunk without rejects would otherwise only hold nulls in some of them
+class ChunkWriter:
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.file_format = get_file_format(output_path)
+        self.writer = None
+        self.schema = None
+        self.n_chunks = 0
+
+    def write(self, chunk):
+        if self.file_format == 'csv':
+            chunk.to_csv(self.output_path, mode='w' if self.n_chunks == 0 else 'a', header=self.n_chunks == 0, index=False)
+        else:
+            pa = import_pyarrow_module('pyarrow')
+            if self.writer is None:
+                self.schema = create_output_schema(chunk)
+                self.writer = self.open_arrow_writer(pa)
+            self.writer.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+        self.n_chunks += 1
+
+    def open_arrow_writer(self, pa):
+        if self.file_format == 'parquet':
+            pq = import_pyarrow_module('pyarrow.parquet')
+            return pq.ParquetWriter(self.output_path, self.schema)
+        return pa.ipc.new_file(self.output_path, self.schema)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def create_output_schema(chunk):
+    pa = import_pyarrow_module('pyarrow')
+    input_schema = pa.Schema.from_pandas(chunk.drop(columns=DECISION_COLUMNS), preserve_index=False)
+    decision_types = {'decision': pa.string(), 'status': pa.string(), 'reason': pa.string(), 'prediction_without_reject': pa.string(),
+                      'prediction_probability': pa.float64(), 'rule': pa.string(), 'disc_score': pa.float64()}
+    return pa.schema(list(input_schema) + [pa.field(column, decision_types[column]) for column in DECISION_COLUMNS]).remove_metadata()
+
+
+#one row of the decision columns, the rule is written as text and only the discrimination score of situation testing is kept
+def convert_decision_to_row(prediction, flip=None):
+    decision = convert_decision_to_dict(prediction, flip)
+    explanation = prediction if isinstance(prediction, Reject) else flip
+    rule = getattr(explanation, 'rule_reject_is_based_upon', None)
+    sit_test_summary = getattr(explanation, 'sit_test_summary', None)
+    return [to_label_text(decision['decision']), decision['status'], decision.get('reason'),
+            to_label_text(decision.get('prediction_without_reject')), decision.get('prediction_probability'),
+            None if rule is None else str(rule), None if sit_test_summary is None else float(sit_test_summary.disc_score)]
+
+
+#the labels are written as text, so that a column of labels has the same type in every chunk
+def to_label_text(label):
+    return None if label is None else str(label)
+
+
+#the input chunk with the decision columns added, in the order of its rows
+def score_chunk(ifac, chunk, memory_budget=None):
+    feature_columns = [column for column in ifac.fit_data.storage.columns if column != ifac.decision_attribute]
+    missing_columns = [column for column in feature_columns if column not in chunk.columns]
+    if len(missing_columns) != 0:
+        raise ValueError(f"The input is missing the columns {missing_columns}")
+    chunk = chunk.reset_index(drop=True)
+
+    dataset = ifac.fit_data.create_dataset_from_descriptive_data(chunk[feature_columns].astype(object))
+    if memory_budget is None:
+        predictions, flips = ifac.predict(dataset)
+    else:
+        predictions, flips = ifac.predict_within_memory_budget(dataset, memory_budget)
+    #the predictions are indexed by the position of their row in the chunk
+    predictions = predictions.sort_index()
+    flip_per_row = dict(zip(flips.index, flips))
+    decision_rows = [convert_decision_to_row(prediction, flip_per_row.get(row)) for row, prediction in zip(predictions.index, predictions)]
+    decisions = pd.DataFrame(decision_rows, columns=DECISION_COLUMNS)
+    return pd.concat([chunk.drop(columns=[column for column in DECISION_COLUMNS if column in chunk.columns]), decisions], axis=1)
+
+
+def score_file(model_path, input_path, output_path, chunk_size=DEFAULT_SCORING_CHUNK_SIZE, memory_limit=None):
+    #the output format is checked before the model is loaded
+    get_file_format(output_path)
+    ifac = load_model(model_path)
+    memory_budget = None if memory_limit is None else MemoryBudget(memory_limit)
+    #compiled trees score a chunk without sklearn's per call overhead, with the same probabilities
+    if ifac.BB.classifier_name in ['Decision Tree', 'Random Forest'] and ifac.BB.compiled_classifier is None:
+        ifac.BB.compile_trees()
+
+    start_time = time.perf_counter()
+    n_rows = 0
+    chunk_writer = ChunkWriter(output_path)
+    try:
+        for chunk in read_input_chunks(input_path, chunk_size):
+            chunk_writer.write(score_chunk(ifac, chunk, memory_budget))
+            n_rows += len(chunk)
+            logger.info("Scored %d rows", n_rows)
+    finally:
+        chunk_writer.close()
+    logger.info("Wrote the decisions for %d rows to %s in %.2fs", n_rows, output_path, time.perf_counter() - start_time)
+    return n_rows
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m IFAC', description="Scores data with a fitted IFAC")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    score_parser = subparsers.add_parser('score', help="scores a csv, Parquet or Arrow IPC file chunk by chunk")
+    score_parser.add_argument('--model', required=True, help="pickle file of a fitted IFAC")
+    score_parser.add_argument('--input', required=True, help="csv, Parquet or Arrow IPC file with the instances to score")
+    score_parser.add_argument('--output', required=True, help="csv, Parquet or Arrow IPC file the decisions are written to")
+    score_parser.add_argument('--chunk-size', type=int, default=DEFAULT_SCORING_CHUNK_SIZE, help="number of rows that are scored at once")
+    score_parser.add_argument('--memory-limit', help="memory limit of scoring a chunk, e.g. 512MB")
+    args = parser.parse_args(arguments)
+
+    #only the progress of the scoring is logged, not that of IFAC itself
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    logger.setLevel(logging.INFO)
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size has to be positive")
+    for path in [args.input, args.output]:
+        try:
+            get_file_format(path)
+        except ValueError as error:
+            parser.error(str(error))
+    score_file(args.model, args.input, args.output, args.chunk_size, args.memory_limit)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pandas as pd
+from ColumnStorage import MemmapStorage, iterate_over_row_chunks
+
+DEFAULT_GENERATION_CHUNK_SIZE = 1000000
+
+
+#Learns the joint distribution of categorical data as a Bayesian network with a given structure: every column gets a
+#conditional probability table given its parent columns. The tables are smoothed towards the marginal distribution of
+#the column, so combinations of parent values that are rare in the data still get sensible probabilities.
+#Rows are sampled column by column (parents first) for all rows of a chunk at once.
+#group_biases shift the probability of the desirable label of the decision attribute for the rows of a group, e.g.
+#[({'sex': 'Female'}, -0.1)] lowers the probability of a desirable decision for women by 0.1
+class SyntheticDataGenerator:
+    def __init__(self, parents_per_column, decision_attribute=None, desirable_label=None, group_biases=None, smoothing=1.0):
+        self.parents_per_column = parents_per_column
+        self.decision_attribute = decision_attribute
+        self.desirable_label = desirable_label
+        self.group_biases = [] if group_biases is None else group_biases
+        self.smoothing = smoothing
+        #the generated data has the columns in the order of parents_per_column, they are sampled parents first
+        self.columns = list(parents_per_column)
+        self.sampling_order = order_columns_by_parents(parents_per_column)
+
+    def fit(self, descriptive_data):
+        self.vocabularies = {}
+        codes_per_column = {}
+        for column in self.columns:
+            values = descriptive_data[column]
+            categorical_values = values.array if values.dtype.name == 'category' else pd.Categorical(values)
+            self.vocabularies[column] = list(categorical_values.categories)
+            codes_per_column[column] = np.asarray(categorical_values.codes, dtype=np.int64)
+        known_rows = np.all([codes >= 0 for codes in codes_per_column.values()], axis=0)
+
+        #per column, the probabilities of its values (columns) for every combination of parent values (rows)
+        self.probabilities = {}
+        self.alias_tables = {}
+        for column in self.columns:
+            n_values = len(self.vocabularies[column])
+            parent_codes = self.get_parent_codes(column, codes_per_column, len(descriptive_data))
+            counts = np.bincount(parent_codes[known_rows] * n_values + codes_per_column[column][known_rows],
+                                 minlength=self.get_number_of_parent_combinations(column) * n_values).reshape(-1, n_values)
+            marginal_probabilities = counts.sum(axis=0) / max(counts.sum(), 1)
+            probabilities = counts + self.smoothing * marginal_probabilities
+            probabilities /= probabilities.sum(axis=1, keepdims=True)
+            self.probabilities[column] = probabilities
+            self.alias_tables[column] = create_alias_tables(probabilities)
+
+        if len(self.group_biases) != 0:
+            if self.decision_attribute not in self.vocabularies or len(self.vocabularies[self.decision_attribute]) != 2:
+                raise ValueError("Group biases can only be injected into a binary decision attribute")
+            if self.desirable_label not in self.vocabularies[self.decision_attribute]:
+                raise ValueError(f"{self.desirable_label} is not a value of {self.decision_attribute}")
+            for group, _ in self.group_biases:
+                for attribute, value in group.items():
+                    if value not in self.vocabularies.get(attribute, []):
+                        raise ValueError(f"{attribute} : {value} doesn't appear in the data the generator was fitted on")
+                    #the values of the group have to be sampled before the decision attribute
+                    if self.sampling_order.index(attribute) > self.sampling_order.index(self.decision_attribute):
+                        raise ValueError(f"{attribute} has to be an ancestor of {self.decision_attribute} to inject a bias for it")
+        return self
+
+    def get_number_of_parent_combinations(self, column):
+        return int(np.prod([len(self.vocabularies[parent]) for parent in self.parents_per_column[column]], dtype=np.int64))
+
+    def get_parent_codes(self, column, codes_per_column, n_rows):
+        parent_codes = np.zeros(n_rows, dtype=np.int64)
+        for parent in self.parents_per_column[column]:
+            parent_codes = parent_codes * len(self.vocabularies[parent]) + np.maximum(codes_per_column[parent], 0)
+        return parent_codes
+
+    #a DataFrame of n_rows rows with the columns (and categories) of the data the generator was fitted on
+    def generate(self, n_rows, chunk_size=DEFAULT_GENERATION_CHUNK_SIZE, seed=0):
+        data_chunks = list(self.generate_chunks(n_rows, chunk_size, seed))
+        if len(data_chunks) == 1:
+            return data_chunks[0]
+        #the chunks have the same categories, so the columns stay categorical
+        return pd.concat(data_chunks, ignore_index=True)
+
+    #the rows in chunks of at most chunk_size rows, so that any number of rows can be generated with bounded memory
+    def generate_chunks(self, n_rows, chunk_size=DEFAULT_GENERATION_CHUNK_SIZE, seed=0):
+        random_generator = np.random.default_rng(seed)
+        if n_rows == 0:
+            yield self.generate_chunk(0, random_generator)
+        for start, end in iterate_over_row_chunks(n_rows, chunk_size):
+            yield self.generate_chunk(end - start, random_generator)
+
+    #writes the rows to a MemmapStorage chunk by chunk, a Dataset on this storage keeps the data on disk
+    def generate_to_memmap_storage(self, n_rows, directory, chunk_size=DEFAULT_GENERATION_CHUNK_SIZE, seed=0):
+        return MemmapStorage.write_chunks(self.generate_chunks(n_rows, chunk_size, seed), n_rows, directory)
+
+    def generate_chunk(self, n_rows, random_generator):
+        codes_per_column = {}
+        for column in self.sampling_order:
+            parent_codes = self.get_parent_codes(column, codes_per_column, n_rows)
+            uniform_values = random_generator.random(n_rows)
+            if column == self.decision_attribute and len(self.group_biases) != 0:
+                codes_per_column[column] = self.sample_biased_decisions(parent_codes, uniform_values, codes_per_column)
+            else:
+                codes_per_column[column] = sample_codes(self.alias_tables[column], parent_codes, uniform_values)
+
+        code_dtype = np.int8 if max(len(vocabulary) for vocabulary in self.vocabularies.values()) < 128 else np.int32
+        return pd.DataFrame({column: pd.Categorical.from_codes(codes_per_column[column].astype(code_dtype), categories=self.vocabularies[column])
+                             for column in self.columns}, columns=self.columns)
+
+    def sample_biased_decisions(self, parent_codes, uniform_values, codes_per_column):
+        desirable_code = self.vocabularies[self.decision_attribute].index(self.desirable_label)
+        desirable_probabilities = self.probabilities[self.decision_attribute][parent_codes, desirable_code]
+
+        for group, bias in self.group_biases:
+            rows_of_group = np.ones(len(parent_codes), dtype=bool)
+            for attribute, value in group.items():
+                rows_of_group &= codes_per_column[attribute] == self.vocabularies[attribute].index(value)
+            desirable_probabilities = np.where(rows_of_group, desirable_probabilities + bias, desirable_probabilities)
+
+        desirable_probabilities = np.clip(desirable_probabilities, 0.0, 1.0)
+        return np.where(uniform_values < desirable_probabilities, desirable_code, 1 - desirable_code)
+
+
+#Walker's alias method: every value of a row gets a slot, a slot holds its own value with the acceptance probability
+#and another value (the alias) otherwise. Sampling then takes a fixed number of steps, whatever the number of values
+def create_alias_tables(probabilities):
+    n_rows, n_values = probabilities.shape
+    acceptance_probabilities = np.ones((n_rows, n_values))
+    aliases = np.tile(np.arange(n_values), (n_rows, 1))
+    for row in range(n_rows):
+        scaled_probabilities = probabilities[row] * n_values
+        small_values = [value for value in range(n_values) if scaled_probabilities[value] < 1.0]
+        large_values = [value for value in range(n_values) if scaled_probabilities[value] >= 1.0]
+        while len(small_values) != 0 and len(large_values) != 0:
+            small_value = small_values.pop()
+            large_value = large_values[-1]
+            acceptance_probabilities[row, small_value] = scaled_probabilities[small_value]
+            aliases[row, small_value] = large_value
+            scaled_probabilities[large_value] -= 1.0 - scaled_probabilities[small_value]
+            if scaled_probabilities[large_value] < 1.0:
+                small_values.append(large_values.pop())
+    return acceptance_probabilities, aliases
+
+
+#the integer part of uniform_values * n_values picks the slot, the fractional part decides between the value of the
+#slot and its alias
+def sample_codes(alias_tables, parent_codes, uniform_values):
+    acceptance_probabilities, aliases = alias_tables
+    n_values = acceptance_probabilities.shape[1]
+    scaled_uniform_values = uniform_values * n_values
+    slots = np.minimum(scaled_uniform_values.astype(np.int64), n_values - 1)
+    flat_slots = parent_codes * n_values + slots
+    accepted = (scaled_uniform_values - slots) < acceptance_probabilities.ravel()[flat_slots]
+    return np.where(accepted, slots, aliases.ravel()[flat_slots])
+
+
+#the parents of every column have to come before it
+def order_columns_by_parents(parents_per_column):
+    for column, parents in parents_per_column.items():
+        for parent in parents:
+            if parent not in parents_per_column:
+                raise ValueError(f"The parent {parent} of {column} is not one of the columns")
+
+    ordered_columns = []
+    while len(ordered_columns) < len(parents_per_column):
+        added_column = False
+        for column, parents in parents_per_column.items():
+            if column not in ordered_columns and all(parent in ordered_columns for parent in parents):
+                ordered_columns.append(column)
+                added_column = True
+        if not added_column:
+            raise ValueError("The parents of the columns contain a cycle")
+    return ordered_columns
@@ -15,20 +15,29 @@ import pandas as pd
 from IFAC.Reject import create_uncertainty_based_reject
 
 class UBAC:
-    def __init__(self, coverage, val_ratio, base_classifier):
+    #black_box is an already fitted BlackBoxClassifier that is used instead of training a new one, e.g. the black box of
+    #an IFAC fitted on the same data. With val_ratio equal to the val1_ratio of that IFAC, the validation data of UBAC is
+    #the first validation set of IFAC, which the black box hasn't been trained on
+    def __init__(self, coverage, val_ratio, base_classifier, sparse_encoding=False, base_classifier_kwargs=None, black_box=None):
         self.coverage = coverage
         self.val_ratio = val_ratio
         self.base_classifier = base_classifier
+        self.sparse_encoding = sparse_encoding
+        self.base_classifier_kwargs = {} if base_classifier_kwargs is None else base_classifier_kwargs
+        self.black_box = black_box
 
     def fit(self, X):
-        val_n = int(self.val_ratio * len(X.descriptive_data))
+        val_n = int(self.val_ratio * len(X))
         X_train_dataset, X_val_dataset = X.split_into_train_test(val_n)
 
         n_to_reject = int((1-self.coverage) * val_n)
 
         # Step 1: Train Black-Box Model
-        self.BB = BlackBoxClassifier(self.base_classifier)
-        self.BB.fit(X_train_dataset)
+        if self.black_box is not None:
+            self.BB = self.black_box
+        else:
+            self.BB = BlackBoxClassifier(self.base_classifier, sparse=self.sparse_encoding)
+            self.BB.fit(X_train_dataset, **self.base_classifier_kwargs)
 
         #Step 2: Apply on validation data
         pred_val, proba_val = self.BB.predict_with_proba(X_val_dataset)
@@ -55,7 +64,9 @@ class UBAC:
 
         indices_below_uncertainty_threshold = probabilities[probabilities < self.threshold].index
 
+        rejected_instances = X.descriptive_data.loc[indices_below_uncertainty_threshold]
         all_uncertainty_based_rejects_df = pd.DataFrame({
+            'instance': [rejected_instances.loc[i].to_dict() for i in indices_below_uncertainty_threshold],
             'prediction_without_reject': predictions[indices_below_uncertainty_threshold],
             'prediction probability': probabilities[indices_below_uncertainty_threshold],
         }, index=indices_below_uncertainty_threshold)
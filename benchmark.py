@@ -0,0 +1,186 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#Times the hot paths of IFAC one by one, for several dataset sizes, and writes the results to a JSON file that can be
+#compared against a saved baseline:
+#   python benchmark.py --sizes 2000 5000 10000 --output baseline.json
+#   python benchmark.py --sizes 2000 5000 10000 --baseline baseline.json
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import numpy as np
+import pandas as pd
+import sklearn
+from load_datasets import create_income_dataset, load_synthetic_income_data, INCOME_COLUMNS
+from IFAC import IFAC, BlackBoxClassifier, Instrumentation
+from IFAC.Rule import calculate_support_conf_slift_and_significance, remove_rules_that_are_subsets_from_other_rules
+from IFAC.SituationTesting import SituationTesting
+from performance_measuring import extract_performance_df_over_non_rejected_instances
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [2000, 5000, 10000]
+#a benchmark counts as a regression when it takes this much longer than in the baseline, and at least
+#MIN_REGRESSION_SECONDS longer (very short benchmarks are too noisy to compare by their ratio alone)
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+MIN_REGRESSION_SECONDS = 0.01
+
+
+#rows of the income sample, or synthetic income data when more rows are asked for than the sample has. The columns
+#hold plain strings, like data that was just read from a csv
+def create_benchmark_data(n_rows, seed=0):
+    income_data = pd.read_csv('data/income_sample.csv')[INCOME_COLUMNS]
+    if n_rows <= len(income_data):
+        return income_data.sample(n=n_rows, random_state=seed).reset_index(drop=True)
+    return load_synthetic_income_data(n_rows, seed=seed).descriptive_data.astype(object)
+
+
+#Every benchmark is a function without arguments, it is run repeats times without and once with memory tracking.
+#The fastest run is reported, as it is the least disturbed by whatever else runs on the machine
+def run_benchmark(results, name, n_rows, benchmark_function, repeats, details=None):
+    durations = []
+    for _ in range(repeats):
+        instrumentation = Instrumentation()
+        with instrumentation.stage(name, details=details, n_rows=n_rows):
+            output = benchmark_function()
+        durations.append(instrumentation.report.records[0].duration)
+
+    instrumentation = Instrumentation(track_memory=True)
+    with instrumentation.stage(name, details=details, n_rows=n_rows):
+        benchmark_function()
+    peak_memory_in_bytes = instrumentation.report.records[0].peak_memory_in_bytes
+
+    results.append({'benchmark': name, 'details': None if details is None else str(details), 'n_rows': n_rows,
+                    'duration_s': min(durations), 'durations_s': durations, 'peak_memory_bytes': peak_memory_in_bytes})
+    logger.info("%s%s, %d rows: %.4fs, %.2fMB", name, "" if details is None else f" ({details})", n_rows, min(durations), peak_memory_in_bytes / 1024**2)
+    return output
+
+
+def run_benchmarks_for_size(n_rows, repeats, seed=0):
+    results = []
+    raw_data = create_benchmark_data(n_rows, seed)
+
+    dataset = run_benchmark(results, "dataset construction", n_rows, lambda: create_income_dataset(raw_data), repeats)
+    run_benchmark(results, "encoding", n_rows, lambda: create_income_dataset(raw_data).get_feature_matrix(dataset.fit_encoder()), repeats)
+
+    train_data, test_data = dataset.split_into_train_test(int(0.2 * n_rows))
+    def fit_black_box():
+        black_box = BlackBoxClassifier('Random Forest')
+        black_box.fit(train_data, random_state=seed)
+        return black_box
+    black_box = run_benchmark(results, "black-box fit", len(train_data), fit_black_box, repeats)
+    #a view without an encoded feature matrix, so the encoding of the test data is part of every predict
+    run_benchmark(results, "black-box predict", len(test_data), lambda: black_box.predict_with_proba(test_data.create_view(np.arange(len(test_data)))), repeats)
+
+    #the parts of fit are benchmarked on the data that a fitted IFAC works with
+    np.random.seed(seed)
+    ifac = IFAC(coverage=0.8, fairness_weight=1.0, val1_ratio=0.2, val2_ratio=0.2, base_classifier='Random Forest', base_classifier_kwargs={'random_state': seed})
+    ifac.fit(train_data)
+    val_data = ifac.val_1_data_with_preds
+    for prot_itemset in ifac.pd_itemsets:
+        candidate_rules = run_benchmark(results, "apriori mining", len(val_data), lambda: ifac.mine_candidate_rules_for_one_prot_itemset(prot_itemset, val_data),
+                                        repeats, details=prot_itemset)
+        run_benchmark(results, "calculate_support_conf_slift_and_significance", len(val_data),
+                      lambda: [calculate_support_conf_slift_and_significance(rule, val_data, prot_itemset) for rule in candidate_rules], repeats, details=prot_itemset)
+        run_benchmark(results, "remove_rules_that_are_subsets_from_other_rules", len(val_data),
+                      lambda: remove_rules_that_are_subsets_from_other_rules(ifac.class_rules_per_prot_itemset[prot_itemset]), repeats, details=prot_itemset)
+
+    test_data_with_preds = ifac.make_preds_and_preds_proba_for_data(test_data)
+    test_data_covered_by_rules, _ = run_benchmark(results, "extract_data_falling_under_rules", len(test_data),
+                                                  lambda: ifac.extract_data_falling_under_rules(test_data_with_preds), repeats)
+
+    def fit_situation_testing():
+        situation_tester = SituationTesting(k=ifac.sit_test_k, t=ifac.sit_test_t, reference_group_list=ifac.reference_group_list,
+                                            decision_label=ifac.decision_attribute, desirable_label=ifac.positive_label,
+                                            distance_function=dataset.distance_function)
+        situation_tester.fit(ifac.val_1_data_with_preds_and_probas)
+        return situation_tester
+    situation_tester = run_benchmark(results, "situation testing fit", len(ifac.val_1_data_with_preds_and_probas), fit_situation_testing, repeats)
+    run_benchmark(results, "situation testing predict", len(test_data_covered_by_rules), lambda: situation_tester.predict(test_data_covered_by_rules), repeats)
+
+    predictions, _ = run_benchmark(results, "IFAC predict", len(test_data), lambda: ifac.predict(test_data), repeats)
+    run_benchmark(results, "performance measuring", len(test_data),
+                  lambda: extract_performance_df_over_non_rejected_instances("IFAC", test_data, predictions, ifac.pd_itemsets), repeats)
+    return results
+
+
+def run_benchmarks(sizes=None, repeats=3, seed=0):
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+    results = []
+    for n_rows in sizes:
+        logger.info("Benchmarking %d rows", n_rows)
+        results.extend(run_benchmarks_for_size(n_rows, repeats, seed))
+    return {'metadata': {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+                         'platform': platform.platform(), 'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__,
+                         'sizes': list(sizes), 'repeats': repeats, 'seed': seed},
+            'results': results}
+
+
+#one row per benchmark that is in both runs, with the ratio of the durations (above 1 means slower than the baseline)
+def compare_benchmark_results(results, baseline_results, regression_threshold=DEFAULT_REGRESSION_THRESHOLD):
+    def to_dataframe(benchmark_results):
+        return pd.DataFrame(benchmark_results['results'], columns=['benchmark', 'details', 'n_rows', 'duration_s', 'peak_memory_bytes'])
+
+    key_columns = ['benchmark', 'details', 'n_rows']
+    comparison_df = to_dataframe(results).fillna({'details': ''}).merge(to_dataframe(baseline_results).fillna({'details': ''}),
+                                                                       on=key_columns, suffixes=('', ' baseline'))
+    comparison_df['duration ratio'] = comparison_df['duration_s'] / comparison_df['duration_s baseline']
+    comparison_df['memory ratio'] = comparison_df['peak_memory_bytes'] / comparison_df['peak_memory_bytes baseline']
+    comparison_df['regression'] = (comparison_df['duration ratio'] > regression_threshold) & \
+                                  (comparison_df['duration_s'] - comparison_df['duration_s baseline'] > MIN_REGRESSION_SECONDS)
+    return comparison_df
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths of IFAC for several dataset sizes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="numbers of rows of the benchmarked datasets")
+    parser.add_argument('--repeats', type=int, default=3, help="number of timed runs of every benchmark, the fastest is reported")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON file the results are written to")
+    parser.add_argument('--baseline', help="JSON file of an earlier run to compare against")
+    parser.add_argument('--regression-threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="duration ratio above which a benchmark counts as a regression")
+    args = parser.parse_args(arguments)
+    #the baseline is read before anything is written, writing the results to it would compare the run with itself
+    baseline_results = None
+    if args.baseline is not None:
+        if os.path.abspath(args.baseline) == os.path.abspath(args.output):
+            parser.error(f"--output is the baseline {args.baseline}, write the results to another file with --output")
+        with open(args.baseline) as baseline_file:
+            baseline_results = json.load(baseline_file)
+
+    #only the progress of the benchmarks is logged, not that of IFAC itself
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    logger.setLevel(logging.INFO)
+    results = run_benchmarks(args.sizes, args.repeats, args.seed)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    logger.info("Wrote the results to %s", args.output)
+
+    if baseline_results is None:
+        return 0
+    comparison_df = compare_benchmark_results(results, baseline_results, args.regression_threshold)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 250):
+        print(comparison_df[['benchmark', 'details', 'n_rows', 'duration_s', 'duration_s baseline', 'duration ratio', 'memory ratio', 'regression']])
+    n_regressions = int(comparison_df['regression'].sum())
+    logger.info("%d of %d benchmarks are more than %.0f%% slower than the baseline", n_regressions, len(comparison_df), 100 * (args.regression_threshold - 1))
+    return 1 if n_regressions != 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
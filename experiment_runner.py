@@ -0,0 +1,162 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import itertools
+import json
+import logging
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from load_datasets import load_income_data
+from IFAC import IFAC
+from IFAC.PD_itemset import generate_potentially_discriminated_itemsets
+from UBAC import UBAC
+from performance_measuring import extract_performance_df_over_non_rejected_instances, average_performance_results_over_multiple_splits
+
+logger = logging.getLogger(__name__)
+
+#bump whenever the way an experiment is run changes, results that were stored before are then recomputed
+RESULT_FORMAT_VERSION = 1
+
+#every key of a config can be set in the grid, the keys that are left out get these values
+DEFAULT_EXPERIMENT_CONFIG = {
+    'coverage': 0.8,
+    'fairness_weight': 1.0,
+    'base_classifier': 'Random Forest',
+    'seed': 4,
+    'train_size': 12000,
+    'number_of_test_sets': 4,
+    'val_ratio': 0.2,
+    #UBAC uses the black box of IFAC instead of training its own, every test set is then only predicted once
+    'shared_black_box': False}
+
+
+#all combinations of the given values, e.g. create_experiment_grid(coverage=[0.7, 0.8], seed=[1, 2, 3])
+def create_experiment_grid(**values_per_parameter):
+    for parameter in values_per_parameter:
+        if parameter not in DEFAULT_EXPERIMENT_CONFIG:
+            raise ValueError(f"Unknown experiment parameter: {parameter}. Known parameters are: {list(DEFAULT_EXPERIMENT_CONFIG.keys())}")
+    parameters = list(values_per_parameter.keys())
+    return [dict(zip(parameters, values)) for values in itertools.product(*values_per_parameter.values())]
+
+
+#Runs the fit and evaluation of UBAC and IFAC for every config of the grid over a pool of processes. The performances
+#of every finished config are stored in result_dir right away, so a sweep that is interrupted, or extended with new
+#configs, only runs the configs whose results aren't stored yet. Results are only reused for the same data.
+#Returns the averaged performances (see average_performance_results_over_multiple_splits) of every config, with the
+#parameters of the config as the first columns
+def run_experiment_grid(configs, result_dir='experiment_results', n_processes=None, load_data=load_income_data):
+    configs = [complete_experiment_config(config) for config in configs]
+    os.makedirs(result_dir, exist_ok=True)
+    #the data is loaded once before the pool is started, which also builds its cache (if any) only once
+    data_fingerprint = load_data().compute_fingerprint()
+    result_keys = [compute_result_key(config, data_fingerprint) for config in configs]
+
+    performances_per_key = {}
+    configs_to_run = {}
+    for config, result_key in zip(configs, result_keys):
+        stored_performances = read_stored_performances(result_dir, result_key)
+        if stored_performances is not None:
+            performances_per_key[result_key] = stored_performances
+        else:
+            configs_to_run[result_key] = config
+    logger.info("%d of %d configs are already stored, running %d configs", len(configs) - len(configs_to_run), len(configs), len(configs_to_run))
+
+    if n_processes == 1:
+        for result_key, config in configs_to_run.items():
+            performances_per_key[result_key] = run_experiment(config, load_data)
+            store_performances(result_dir, result_key, config, performances_per_key[result_key])
+    elif len(configs_to_run) != 0:
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            futures = {executor.submit(run_experiment, config, load_data): result_key for result_key, config in configs_to_run.items()}
+            for future in as_completed(futures):
+                result_key = futures[future]
+                performances_per_key[result_key] = future.result()
+                store_performances(result_dir, result_key, configs_to_run[result_key], performances_per_key[result_key])
+                logger.info("Finished config %s", configs_to_run[result_key])
+
+    averaged_performances = []
+    for config, result_key in zip(configs, result_keys):
+        config_performances = average_performance_results_over_multiple_splits(performances_per_key[result_key])
+        for position, (parameter, value) in enumerate(config.items()):
+            config_performances.insert(position, parameter, [value] * len(config_performances))
+        averaged_performances.append(config_performances)
+    return pd.concat(averaged_performances, ignore_index=True)
+
+
+#Fits UBAC and IFAC on the train split of the config and returns the performances of both on every test split
+def run_experiment(config, load_data=load_income_data):
+    config = complete_experiment_config(config)
+    seed = config['seed']
+    np.random.seed(seed)
+    data = load_data()
+
+    train_data, test_data_array = data.split_into_train_and_multiple_test_sets(train_size=config['train_size'], number_of_test_sets=config['number_of_test_sets'],
+                                                                               random_state=seed)
+    pd_itemsets = generate_potentially_discriminated_itemsets(train_data, train_data.sensitive_attributes)
+    #the seed also fixes the randomness of the base classifiers, so every config gives the same results in every run
+    base_classifier_kwargs = {'random_state': seed}
+
+    ifac = IFAC(coverage=config['coverage'], fairness_weight=config['fairness_weight'], val1_ratio=config['val_ratio'], val2_ratio=config['val_ratio'],
+                base_classifier=config['base_classifier'], base_classifier_kwargs=base_classifier_kwargs)
+    ifac.fit(train_data)
+
+    shared_black_box = None
+    if config['shared_black_box']:
+        shared_black_box = ifac.BB.enable_prediction_cache(cache_size=config['number_of_test_sets'])
+    ubac = UBAC(coverage=config['coverage'], val_ratio=config['val_ratio'], base_classifier=config['base_classifier'], base_classifier_kwargs=base_classifier_kwargs,
+                black_box=shared_black_box)
+    ubac.fit(train_data)
+
+    all_performances = []
+    for iteration, test_data in enumerate(test_data_array, start=1):
+        logger.info("Config %s, test set %d", config, iteration)
+        ubac_predictions = ubac.predict(test_data)
+        all_performances.append(extract_performance_df_over_non_rejected_instances(classification_method="UBAC", data=test_data, predictions=ubac_predictions, pd_itemsets=pd_itemsets))
+
+        ifac_predictions, ifac_flips = ifac.predict(test_data)
+        logger.info("IFAC flipped %d predictions", len(ifac_flips))
+        all_performances.append(extract_performance_df_over_non_rejected_instances(classification_method="IFAC", data=test_data, predictions=ifac_predictions, pd_itemsets=pd_itemsets))
+    return pd.concat(all_performances)
+
+
+def complete_experiment_config(config):
+    complete_config = dict(DEFAULT_EXPERIMENT_CONFIG)
+    for parameter, value in config.items():
+        if parameter not in DEFAULT_EXPERIMENT_CONFIG:
+            raise ValueError(f"Unknown experiment parameter: {parameter}. Known parameters are: {list(DEFAULT_EXPERIMENT_CONFIG.keys())}")
+        complete_config[parameter] = value
+    return complete_config
+
+
+def compute_result_key(config, data_fingerprint):
+    return hashlib.sha256(json.dumps([RESULT_FORMAT_VERSION, config, data_fingerprint], sort_keys=True).encode()).hexdigest()
+
+
+def read_stored_performances(result_dir, result_key):
+    try:
+        with open(os.path.join(result_dir, result_key + '.pkl'), 'rb') as result_file:
+            return pickle.load(result_file)['performances']
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+#the result is written to a temporary file first, so an interrupted run never leaves a half written result behind
+def store_performances(result_dir, result_key, config, performances):
+    result_path = os.path.join(result_dir, result_key + '.pkl')
+    temporary_result_path = result_path + '.tmp' + str(os.getpid())
+    with open(temporary_result_path, 'wb') as result_file:
+        pickle.dump({'config': config, 'performances': performances}, result_file)
+    os.replace(temporary_result_path, result_path)
@@ -11,13 +11,48 @@
 # limitations under the License.
 
 from Dataset import Dataset
+from DatasetCache import load_csv_with_cache
+from SyntheticDataGenerator import SyntheticDataGenerator
 import pandas as pd
 
-def load_income_data():
+INCOME_COLUMNS = ['age', 'marital status', 'education', 'workinghours', 'workclass', 'occupation', 'race', 'sex', 'income']
+
+#the structure of the Bayesian network that synthetic income data is generated with, the parents of every column
+INCOME_NETWORK_PARENTS = {
+    'age': ['sex', 'race'],
+    'marital status': ['age', 'sex'],
+    'education': ['age', 'sex', 'race'],
+    'workinghours': ['age', 'sex'],
+    'workclass': ['education'],
+    'occupation': ['education', 'sex'],
+    'race': ['sex'],
+    'sex': [],
+    'income': ['education', 'occupation', 'workinghours', 'sex', 'race']}
+
+#with use_cache, the parsed and encoded data is stored in data/income_sample.csv.cache and memory-mapped on later loads
+def load_income_data(use_cache=True):
+    if use_cache:
+        return load_csv_with_cache('data/income_sample.csv', INCOME_COLUMNS, create_income_dataset)
+
     raw_data = pd.read_csv('data/income_sample.csv')
-    descriptive_dataframe = raw_data[
-        ['age', 'marital status', 'education', 'workinghours', 'workclass', 'occupation', 'race', 'sex', 'income']]
+    descriptive_dataframe = raw_data[INCOME_COLUMNS]
+    return create_income_dataset(descriptive_dataframe)
+
+#Synthetic income data with the same schema as the income sample, generated from a Bayesian network that is learned
+#from the sample. group_biases shift the probability of a high income for the given groups, e.g.
+#[({'sex': 'Female'}, -0.1)]. With a directory, the data is written to disk chunk by chunk and stays there, so that
+#millions of rows can be generated without holding them in memory
+def load_synthetic_income_data(n_rows, group_biases=None, seed=0, directory=None):
+    income_sample = pd.read_csv('data/income_sample.csv')[INCOME_COLUMNS]
+    generator = SyntheticDataGenerator(INCOME_NETWORK_PARENTS, decision_attribute='income', desirable_label='high', group_biases=group_biases).fit(income_sample)
+    if directory is None:
+        descriptive_data = generator.generate(n_rows, seed=seed)
+    else:
+        descriptive_data = generator.generate_to_memmap_storage(n_rows, directory, seed=seed)
+    return create_income_dataset(descriptive_data)
 
+#descriptive_data can also be a storage from ColumnStorage, e.g. ParquetStorage('income.parquet') for data that doesn't fit in memory
+def create_income_dataset(descriptive_data):
     age_dict = {"Younger than 25": 1, "25-29": 2, "30-39": 3, "40-49": 4, "50-59": 5, "60-69": 6, "Older than 70": 7}
     education_dict = {"No Elementary School": 1, "Elementary School": 2, "Middle School": 3,
                       "Started High School, No Diploma": 4, "High School or GED Diploma": 5,
@@ -31,7 +66,7 @@ def load_income_data():
     sensitive_attributes = ['sex', 'race']
     reference_group_list = [{'sex': 'Male', 'race': 'White alone'}]
 
-    dataset = Dataset(descriptive_dataframe, dicts_ordinal_to_numeric, decision_attribute="income", undesirable_label="low",
+    dataset = Dataset(descriptive_data, dicts_ordinal_to_numeric, decision_attribute="income", undesirable_label="low",
                       desirable_label="high", sensitive_attributes=sensitive_attributes, reference_group_list=reference_group_list, categorical_features=categorical_features,
                       distance_function=distance_function_income_pred)
 
@@ -13,10 +13,14 @@
 from load_datasets import load_income_data
 from IFAC import IFAC
 from IFAC.Reject import Reject
+import logging
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
+    #the first load writes a binary cache of the data to data/income_sample.csv.cache, which later runs memory-map
+    #instead of parsing the csv again. Use load_income_data(use_cache=False) to leave data/ untouched
     income_prediction_data = load_income_data()
     train, test = income_prediction_data.split_into_train_test(test_fraction=2000)
 
@@ -10,54 +10,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from IFAC.Reject import Reject
-from sklearn.metrics import confusion_matrix
+import warnings
+import numpy as np
 import pandas as pd
-from IFAC.Rule import get_instances_covered_by_rule_base
+from scipy import sparse as scipy_sparse
 
-def extract_performance_df_over_non_rejected_instances(classification_method, data, predictions, pd_itemsets):
-    desirable_label = data.desirable_label
-    undesirable_label = data.undesirable_label
-    ground_truth = data.descriptive_data[data.decision_attribute]
-
-    rejected_predictions = predictions[predictions.apply(lambda x: isinstance(x, Reject))]
-
-    non_rejected_predictions = predictions[predictions.apply(lambda x: not isinstance(x, Reject))]
-    non_rejected_part_of_data = data.descriptive_data.loc[non_rejected_predictions.index]
-
-    performance_df = pd.DataFrame([])
-
-    for protected_itemset in pd_itemsets:
-        performance_entry = {"Classification Type": classification_method, "Group": protected_itemset.string_notation,
-                             "Sensitive Features": protected_itemset.sensitive_features}
-        indices_of_protected_itemsets_data = get_instances_covered_by_rule_base(protected_itemset.dict_notation, non_rejected_part_of_data).index
-        predictions_for_protected_itemset = predictions[indices_of_protected_itemsets_data]
-        ground_truth_for_protected_itemset = ground_truth[indices_of_protected_itemsets_data]
-
-        conf_matrix = confusion_matrix(ground_truth_for_protected_itemset, predictions_for_protected_itemset,
-                                       labels=[desirable_label, undesirable_label])
+PERFORMANCE_COLUMNS = ["Classification Type", "Group", "Sensitive Features", "Accuracy", "Positive Dec. Ratio", "FNR", "FPR", "Number of instances"]
 
-        performance_entry["Accuracy"] = calculate_accuracy_based_on_conf_matrix(conf_matrix)
-        performance_entry["Positive Dec. Ratio"] = calculate_positive_decision_ratio_based_on_conf_matrix(conf_matrix)
-        performance_entry["FNR"] = calculate_false_negative_rate_based_on_conf_matrix(conf_matrix)
-        performance_entry["FPR"] = calculate_false_positive_rate_based_on_conf_matrix(conf_matrix)
-        performance_entry["Number of instances"] = calculate_number_of_instances_based_on_conf_matrix(conf_matrix)
-
-        performance_df = performance_df.append(performance_entry, ignore_index=True)
+def extract_performance_df_over_non_rejected_instances(classification_method, data, predictions, pd_itemsets):
+    descriptive_data = data.descriptive_data
+    ground_truth = descriptive_data[data.decision_attribute]
+    #rejected instances are neither predicted as the desirable nor as the undesirable label, so they are left out of
+    #every confusion matrix
+    predicted_labels = predictions.reindex(descriptive_data.index)
+
+    conf_matrices = compute_confusion_matrices_of_protected_itemsets(descriptive_data, ground_truth, predicted_labels, pd_itemsets,
+                                                                      data.desirable_label, data.undesirable_label)
+    #the metric functions index conf_matrix[row][column], with the groups as last axis they compute all groups at once
+    conf_matrix_per_cell = conf_matrices.transpose(1, 2, 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        performance_df = pd.DataFrame({
+            "Classification Type": classification_method,
+            "Group": [protected_itemset.string_notation for protected_itemset in pd_itemsets],
+            "Sensitive Features": [protected_itemset.sensitive_features for protected_itemset in pd_itemsets],
+            "Accuracy": calculate_accuracy_based_on_conf_matrix(conf_matrix_per_cell),
+            "Positive Dec. Ratio": calculate_positive_decision_ratio_based_on_conf_matrix(conf_matrix_per_cell),
+            "FNR": calculate_false_negative_rate_based_on_conf_matrix(conf_matrix_per_cell),
+            "FPR": calculate_false_positive_rate_based_on_conf_matrix(conf_matrix_per_cell),
+            "Number of instances": calculate_number_of_instances_based_on_conf_matrix(conf_matrix_per_cell)},
+            columns=PERFORMANCE_COLUMNS)
     return performance_df
 
 
-
-
 def make_confusion_matrix_for_every_protected_itemset(desirable_label, undesirable_label, ground_truth, predicted_labels, protected_info, protected_itemsets, print_matrix=False):
+    conf_matrices = compute_confusion_matrices_of_protected_itemsets(protected_info, ground_truth.reindex(protected_info.index),
+                                                                      predicted_labels.reindex(protected_info.index), protected_itemsets,
+                                                                      desirable_label, undesirable_label)
     conf_matrix_dict = {}
 
-    for protected_itemset in protected_itemsets:
-        protected_itemset_dict = protected_itemset.dict_notation
-        indices_belonging_to_this_pi = get_instances_covered_by_rule_base(protected_itemset_dict, protected_info).index
-        ground_truth_of_indices = ground_truth.loc[indices_belonging_to_this_pi]
-        predictions_for_indices = predicted_labels.loc[indices_belonging_to_this_pi]
-        conf_matrix = confusion_matrix(ground_truth_of_indices, predictions_for_indices, labels=[desirable_label, undesirable_label])
+    for protected_itemset, conf_matrix in zip(protected_itemsets, conf_matrices):
         conf_matrix_dict[protected_itemset] = conf_matrix
         if print_matrix:
             print(protected_itemset)
@@ -70,6 +62,84 @@ def make_confusion_matrix_for_every_protected_itemset(desirable_label, undesirab
     return conf_matrix_dict
 
 
+#Returns the 2x2 confusion matrix (rows: ground truth, columns: prediction, both in the order desirable, undesirable)
+#of every protected itemset, as an array of shape (number of itemsets, 2, 2).
+#Every row belongs to one cell, a combination of values of the sensitive attributes. The confusion matrices of all
+#cells come out of a single np.bincount over (cell, truth, prediction), the matrix of a protected itemset is the sum
+#over the cells it covers
+def compute_confusion_matrices_of_protected_itemsets(sensitive_data, ground_truth, predicted_labels, protected_itemsets, desirable_label, undesirable_label):
+    conf_matrix_codes, membership = encode_confusion_matrix_cells(sensitive_data, ground_truth, predicted_labels, protected_itemsets,
+                                                                  desirable_label, undesirable_label)
+    conf_matrix_per_cell = np.bincount(conf_matrix_codes[conf_matrix_codes >= 0], minlength=membership.shape[1] * 4).reshape(-1, 4)
+    return (membership.astype(np.int64) @ conf_matrix_per_cell).reshape(len(protected_itemsets), 2, 2)
+
+
+#the code of every row is (cell, truth, prediction) flattened, -1 for rows without a label or prediction (e.g. rejected
+#instances). The membership matrix tells which cells every protected itemset covers
+def encode_confusion_matrix_cells(sensitive_data, ground_truth, predicted_labels, protected_itemsets, desirable_label, undesirable_label):
+    labels = [desirable_label, undesirable_label]
+    truth_codes = get_codes_of_labels(ground_truth, labels)
+    prediction_codes = get_codes_of_labels(predicted_labels, labels)
+
+    sensitive_attributes = get_attributes_of_protected_itemsets(protected_itemsets)
+    cell_codes, number_of_values_per_attribute, vocabularies = encode_cells(sensitive_data, sensitive_attributes)
+
+    labeled_rows = (truth_codes >= 0) & (prediction_codes >= 0)
+    conf_matrix_codes = np.where(labeled_rows, (cell_codes * 2 + truth_codes) * 2 + prediction_codes, -1)
+
+    membership = compute_cell_membership_of_protected_itemsets(protected_itemsets, sensitive_attributes, number_of_values_per_attribute, vocabularies)
+    return conf_matrix_codes, membership
+
+
+def get_attributes_of_protected_itemsets(protected_itemsets):
+    sensitive_attributes = []
+    for protected_itemset in protected_itemsets:
+        for attribute in protected_itemset.dict_notation:
+            if attribute not in sensitive_attributes:
+                sensitive_attributes.append(attribute)
+    return sensitive_attributes
+
+
+#code 0 and 1 for the labels, -1 for anything else (e.g. rejected instances)
+def get_codes_of_labels(values, labels):
+    return pd.Categorical(np.asarray(values, dtype=object), categories=labels).codes.astype(np.int64)
+
+
+#code 0 is kept for missing values (and values outside of the given vocabularies), the values of the attribute get
+#codes 1 and up. Without vocabularies, the values of the data are used
+def encode_cells(sensitive_data, sensitive_attributes, vocabularies=None):
+    if vocabularies is not None:
+        vocabularies = [pd.Index(vocabulary) for vocabulary in vocabularies]
+    cell_codes = np.zeros(len(sensitive_data), dtype=np.int64)
+    number_of_values_per_attribute = []
+    used_vocabularies = []
+    for position, attribute in enumerate(sensitive_attributes):
+        column = sensitive_data[attribute]
+        if vocabularies is not None:
+            column = pd.Categorical(column, categories=vocabularies[position])
+        else:
+            column = column.array if column.dtype.name == 'category' else pd.Categorical(column)
+        number_of_values = len(column.categories) + 1
+        cell_codes = cell_codes * number_of_values + column.codes + 1
+        number_of_values_per_attribute.append(number_of_values)
+        used_vocabularies.append(column.categories)
+    return cell_codes, number_of_values_per_attribute, used_vocabularies
+
+
+def compute_cell_membership_of_protected_itemsets(protected_itemsets, sensitive_attributes, number_of_values_per_attribute, vocabularies):
+    number_of_cells = int(np.prod(number_of_values_per_attribute))
+    attribute_codes_per_cell = np.unravel_index(np.arange(number_of_cells), number_of_values_per_attribute)
+
+    membership = np.ones((len(protected_itemsets), number_of_cells), dtype=bool)
+    for row, protected_itemset in enumerate(protected_itemsets):
+        for attribute, value in protected_itemset.dict_notation.items():
+            position = sensitive_attributes.index(attribute)
+            vocabulary = vocabularies[position]
+            value_code = vocabulary.get_loc(value) + 1 if value in vocabulary else -1
+            membership[row] &= attribute_codes_per_cell[position] == value_code
+    return membership
+
+
 def calculate_accuracy_based_on_conf_matrix(conf_matrix):
     number_true_negatives = conf_matrix[1][1]
     number_true_positives = conf_matrix[0][0]
@@ -124,4 +194,86 @@ def calculate_precision_based_on_conf_matrix(conf_matrix):
 
 def calculate_number_of_instances_based_on_conf_matrix(conf_matrix):
     total = conf_matrix[0][0] + conf_matrix[0][1] + conf_matrix[1][0] + conf_matrix[1][1]
-    return total
\ No newline at end of file
+    return total
+
+
+def average_performance_results_over_multiple_splits(performance_dataframes):
+    performance_measures_of_interest = ['Accuracy', 'FPR', 'FNR', 'Positive Dec. Ratio', 'Number of instances']
+    grouped_performances = performance_dataframes.groupby(['Classification Type', 'Group', "Sensitive Features"])
+    summary_df = grouped_performances[performance_measures_of_interest].agg(['mean', 'std'])
+    summary_df.columns = [' '.join(col).strip() for col in summary_df.columns.values]
+    summary_df.reset_index(inplace=True)
+    #the standard error of a group is based on the number of splits the group appears in
+    number_of_splits = grouped_performances.size().to_numpy()
+
+    # calculate upper and lower bounds of confidence intervals
+    for performance_measure in performance_measures_of_interest:
+        summary_df[performance_measure + ' ci'] = 1.96 * (
+                    summary_df[performance_measure + ' std'] / np.sqrt(number_of_splits))
+        summary_df[performance_measure + ' ci_low'] = summary_df[performance_measure + ' mean'] - 1.96 * (
+                    summary_df[performance_measure + ' std'] / np.sqrt(number_of_splits))
+        summary_df[performance_measure + ' ci_high'] = summary_df[performance_measure + ' mean'] + 1.96 * (
+                    summary_df[performance_measure + ' std'] / np.sqrt(number_of_splits))
+
+        if performance_measure != "Number of instances":
+            # make sure confidence intervals range from 0 to 1
+            summary_df[performance_measure + ' ci_low'] = summary_df[
+                performance_measure + ' ci_low'].apply(lambda x: 0 if x < 0 else x)
+            summary_df[performance_measure + ' ci_high'] = summary_df[
+                performance_measure + ' ci_high'].apply(lambda x: 1 if x > 1 else x)
+
+    return summary_df
+
+
+#Bootstrap confidence intervals of the performance of every protected itemset, by resampling the instances of the
+#test data. A resample is a row of a multinomial weight matrix (how often every instance is drawn), so the confusion
+#matrices of all groups in all resamples follow from one matrix product with the (sparse) confusion matrix codes of
+#the instances. The weight matrix is drawn in chunks of resamples of at most max_weights_in_memory entries.
+#The ' mean' columns hold the performance on the test data itself, the ' std' columns the bootstrap standard error
+#and ci_low and ci_high the percentile interval, so the result can be plotted in the same way as the averaged results
+def bootstrap_performance_df_over_non_rejected_instances(classification_method, data, predictions, pd_itemsets, number_of_resamples=1000,
+                                                         confidence_level=0.95, random_state=None, max_weights_in_memory=10**7):
+    descriptive_data = data.descriptive_data
+    predicted_labels = predictions.reindex(descriptive_data.index)
+    conf_matrix_codes, membership = encode_confusion_matrix_cells(descriptive_data, descriptive_data[data.decision_attribute], predicted_labels,
+                                                                  pd_itemsets, data.desirable_label, data.undesirable_label)
+    number_of_instances = len(conf_matrix_codes)
+    number_of_codes = membership.shape[1] * 4
+    labeled_rows = np.flatnonzero(conf_matrix_codes >= 0)
+    code_matrix = scipy_sparse.csr_matrix((np.ones(len(labeled_rows)), (conf_matrix_codes[labeled_rows], labeled_rows)),
+                                          shape=(number_of_codes, number_of_instances))
+
+    random_generator = np.random.default_rng(random_state)
+    draw_probabilities = np.full(number_of_instances, 1 / number_of_instances)
+    resamples_per_chunk = max(1, max_weights_in_memory // max(number_of_instances, 1))
+    resampled_counts = np.empty((number_of_resamples, number_of_codes))
+    for start in range(0, number_of_resamples, resamples_per_chunk):
+        stop = min(start + resamples_per_chunk, number_of_resamples)
+        resample_weights = random_generator.multinomial(number_of_instances, draw_probabilities, size=stop - start)
+        resampled_counts[start:stop] = (code_matrix @ resample_weights.T).T
+
+    #(2, 2, resamples, groups), so the metric functions compute all resamples and groups at once
+    conf_matrices = np.einsum('gc,bck->kbg', membership.astype(np.float64), resampled_counts.reshape(number_of_resamples, -1, 4)).reshape(2, 2, number_of_resamples, -1)
+    performance_df = extract_performance_df_over_non_rejected_instances(classification_method, data, predictions, pd_itemsets)
+
+    percentiles = [100 * (1 - confidence_level) / 2, 100 * (1 + confidence_level) / 2]
+    bootstrap_df = performance_df[["Classification Type", "Group", "Sensitive Features"]].copy()
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        #groups that are empty in every resample have no interval
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for performance_measure, calculate_measure in BOOTSTRAPPED_MEASURES.items():
+            resampled_measure = calculate_measure(conf_matrices)
+            ci_low, ci_high = np.nanpercentile(resampled_measure, percentiles, axis=0)
+            bootstrap_df[performance_measure + ' mean'] = performance_df[performance_measure].to_numpy()
+            bootstrap_df[performance_measure + ' std'] = np.nanstd(resampled_measure, axis=0, ddof=1)
+            bootstrap_df[performance_measure + ' ci_low'] = ci_low
+            bootstrap_df[performance_measure + ' ci_high'] = ci_high
+    return bootstrap_df
+
+
+BOOTSTRAPPED_MEASURES = {
+    'Accuracy': calculate_accuracy_based_on_conf_matrix,
+    'FPR': calculate_false_positive_rate_based_on_conf_matrix,
+    'FNR': calculate_false_negative_rate_based_on_conf_matrix,
+    'Positive Dec. Ratio': calculate_positive_decision_ratio_based_on_conf_matrix,
+    'Number of instances': calculate_number_of_instances_based_on_conf_matrix}
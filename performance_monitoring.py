@@ -0,0 +1,134 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from IFAC.Reject import Reject, UncertaintyReject
+from IFAC.PD_itemset import generate_potentially_discriminated_itemsets
+from performance_measuring import encode_cells, compute_cell_membership_of_protected_itemsets, get_attributes_of_protected_itemsets, \
+    get_codes_of_labels, calculate_accuracy_based_on_conf_matrix, calculate_false_positive_rate_based_on_conf_matrix, \
+    calculate_false_negative_rate_based_on_conf_matrix, calculate_number_of_instances_based_on_conf_matrix
+import numpy as np
+import pandas as pd
+
+#the kinds of decisions IFAC makes, a flip is a prediction that was changed because it was deemed unfair
+DECISION_KINDS = ['prediction', 'flip', 'uncertainty reject', 'unfairness reject']
+#the ground truth is often only known later (or never) for decisions made in production
+TRUTH_VALUES = ['desirable', 'undesirable', 'unknown']
+
+MONITORING_COLUMNS = ["Group", "Sensitive Features", "Number of decisions", "Number of labeled decisions", "Accuracy",
+                      "Positive Dec. Ratio", "FNR", "FPR", "Reject Rate", "Uncertainty Reject Rate", "Unfairness Reject Rate", "Flip Rate"]
+
+
+#Keeps count of the decisions that are made in production, per cell (combination of sensitive attribute values),
+#ground truth, prediction and decision kind. The number of counts is fixed, so updates cost O(batch size) and a
+#snapshot of the metrics of all protected itemsets costs O(groups), however many decisions were made.
+#Every worker can keep its own accumulator, merge adds the counts of another accumulator
+class FairnessMetricsAccumulator:
+    def __init__(self, pd_itemsets, decision_attribute, desirable_label, undesirable_label):
+        self.pd_itemsets = pd_itemsets
+        self.decision_attribute = decision_attribute
+        self.desirable_label = desirable_label
+        self.undesirable_label = undesirable_label
+
+        #the vocabularies are fixed up front (values that don't appear in any itemset share code 0), so that
+        #accumulators of different workers always have the same cells
+        self.sensitive_attributes = get_attributes_of_protected_itemsets(pd_itemsets)
+        self.vocabularies = []
+        for attribute in self.sensitive_attributes:
+            vocabulary = []
+            for pd_itemset in pd_itemsets:
+                value = pd_itemset.dict_notation.get(attribute)
+                if value is not None and value not in vocabulary:
+                    vocabulary.append(value)
+            self.vocabularies.append(vocabulary)
+        self.number_of_values_per_attribute = [len(vocabulary) + 1 for vocabulary in self.vocabularies]
+        self.number_of_cells = int(np.prod(self.number_of_values_per_attribute))
+        self.membership = compute_cell_membership_of_protected_itemsets(pd_itemsets, self.sensitive_attributes, self.number_of_values_per_attribute,
+                                                                        [pd.Index(vocabulary) for vocabulary in self.vocabularies]).astype(np.int64)
+
+        self.counts = np.zeros((self.number_of_cells, len(TRUTH_VALUES), 2, len(DECISION_KINDS)), dtype=np.int64)
+
+    #the pd itemsets are generated from the sensitive attributes of the dataset, like IFAC does
+    @staticmethod
+    def from_dataset(dataset):
+        pd_itemsets = generate_potentially_discriminated_itemsets(dataset, dataset.sensitive_attributes)
+        return FairnessMetricsAccumulator(pd_itemsets, dataset.decision_attribute, dataset.desirable_label, dataset.undesirable_label)
+
+    #descriptive_data holds the sensitive attributes of the batch (and the decision attribute if the ground truth is
+    #known), predictions and flips are what IFAC.predict returns for it
+    def update(self, descriptive_data, predictions, flips=None):
+        predictions = predictions.reindex(descriptive_data.index)
+        decision_kinds = np.zeros(len(predictions), dtype=np.int64)
+        predicted_labels = np.empty(len(predictions), dtype=object)
+        for row, prediction in enumerate(predictions.to_numpy()):
+            if isinstance(prediction, Reject):
+                predicted_labels[row] = prediction.prediction_without_reject
+                decision_kinds[row] = DECISION_KINDS.index('uncertainty reject') if isinstance(prediction, UncertaintyReject) else DECISION_KINDS.index('unfairness reject')
+            else:
+                predicted_labels[row] = prediction
+        if flips is not None and len(flips) != 0:
+            flipped_rows = descriptive_data.index.get_indexer(flips.index)
+            flipped_rows = flipped_rows[(flipped_rows >= 0) & (decision_kinds[np.maximum(flipped_rows, 0)] == 0)]
+            decision_kinds[flipped_rows] = DECISION_KINDS.index('flip')
+
+        labels = [self.desirable_label, self.undesirable_label]
+        prediction_codes = get_codes_of_labels(predicted_labels, labels)
+        if self.decision_attribute in descriptive_data.columns:
+            truth_codes = get_codes_of_labels(descriptive_data[self.decision_attribute], labels)
+            truth_codes[truth_codes < 0] = TRUTH_VALUES.index('unknown')
+        else:
+            truth_codes = np.full(len(descriptive_data), TRUTH_VALUES.index('unknown'), dtype=np.int64)
+
+        cell_codes, _, _ = encode_cells(descriptive_data, self.sensitive_attributes, self.vocabularies)
+        decided_rows = prediction_codes >= 0
+        count_codes = np.ravel_multi_index((cell_codes[decided_rows], truth_codes[decided_rows], prediction_codes[decided_rows], decision_kinds[decided_rows]),
+                                           self.counts.shape)
+        self.counts += np.bincount(count_codes, minlength=self.counts.size).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        if self.counts.shape != other.counts.shape or self.vocabularies != other.vocabularies:
+            raise ValueError("Only accumulators of the same protected itemsets can be merged")
+        self.counts += other.counts
+        return self
+
+    #counts per protected itemset, shape: (groups, truth values, predictions, decision kinds)
+    def get_counts_per_pd_itemset(self):
+        return (self.membership @ self.counts.reshape(self.number_of_cells, -1)).reshape((len(self.pd_itemsets),) + self.counts.shape[1:])
+
+    def snapshot(self):
+        counts = self.get_counts_per_pd_itemset()
+        accepted_decisions = counts[..., [DECISION_KINDS.index('prediction'), DECISION_KINDS.index('flip')]].sum(axis=-1)
+        #the confusion matrix of the accepted decisions whose ground truth is known, with the groups as last axis
+        conf_matrix = accepted_decisions[:, :2, :].transpose(1, 2, 0)
+
+        decisions_per_kind = counts.sum(axis=(1, 2))
+        number_of_decisions = decisions_per_kind.sum(axis=1)
+        number_of_accepted_decisions = accepted_decisions.sum(axis=(1, 2))
+        number_of_positive_decisions = accepted_decisions[:, :, 0].sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            snapshot_df = pd.DataFrame({
+                "Group": [pd_itemset.string_notation for pd_itemset in self.pd_itemsets],
+                "Sensitive Features": [pd_itemset.sensitive_features for pd_itemset in self.pd_itemsets],
+                "Number of decisions": number_of_decisions,
+                "Number of labeled decisions": calculate_number_of_instances_based_on_conf_matrix(conf_matrix),
+                "Accuracy": calculate_accuracy_based_on_conf_matrix(conf_matrix),
+                #the positive decision ratio doesn't need the ground truth, so it is computed over all accepted decisions
+                "Positive Dec. Ratio": number_of_positive_decisions / number_of_accepted_decisions,
+                "FNR": calculate_false_negative_rate_based_on_conf_matrix(conf_matrix),
+                "FPR": calculate_false_positive_rate_based_on_conf_matrix(conf_matrix),
+                "Reject Rate": (decisions_per_kind[:, DECISION_KINDS.index('uncertainty reject')] + decisions_per_kind[:, DECISION_KINDS.index('unfairness reject')]) / number_of_decisions,
+                "Uncertainty Reject Rate": decisions_per_kind[:, DECISION_KINDS.index('uncertainty reject')] / number_of_decisions,
+                "Unfairness Reject Rate": decisions_per_kind[:, DECISION_KINDS.index('unfairness reject')] / number_of_decisions,
+                "Flip Rate": decisions_per_kind[:, DECISION_KINDS.index('flip')] / number_of_decisions},
+                columns=MONITORING_COLUMNS)
+        return snapshot_df
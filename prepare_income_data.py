@@ -11,8 +11,10 @@
 # limitations under the License.
 
 
+from concurrent.futures import ProcessPoolExecutor
 from folktables import ACSDataSource, ACSEmployment, ACSPublicCoverage
 import folktables
+import numpy as np
 import pandas as pd
 
 ACS_categories = {
@@ -78,56 +80,46 @@ ACS_categories = {
 
 }
 
-def change_employment_label_names(row):
-    if row['work status']:
-        return "employed"
-    else:
-        return "unemployed"
+#the functions below work on whole columns at once instead of row by row, so they stay fast for full ACS extracts
+def change_employment_label_names(raw_data):
+    raw_data['work status'] = np.where(raw_data['work status'].astype(bool), "employed", "unemployed")
+    return raw_data
 
 
-def change_income_label_names(row):
-    if row['income']:
-        return "high"
-    else:
-        return "low"
+def change_income_label_names(raw_data):
+    raw_data['income'] = np.where(raw_data['income'].astype(bool), "high", "low")
+    return raw_data
 
 
-def change_insurance_coverage_label_names(row):
-    if row['insurance coverage']:
-        return "with coverage"
-    else:
-        return "without coverage"
+def change_insurance_coverage_label_names(raw_data):
+    raw_data['insurance coverage'] = np.where(raw_data['insurance coverage'].astype(bool), "with coverage", "without coverage")
+    return raw_data
 
 
-def bin_workclass(row):
-    if row['workclass'] in [1.0, 2.0]:
-        return "private"
-    if row['workclass'] in [3.0, 4.0, 5.0]:
-        return "governmental"
-    if row['workclass'] in [6.0, 7.0]:
-        return "self employed"
-    return "no paid work"
+def bin_workclass(raw_data):
+    workclass = raw_data['workclass']
+    raw_data['workclass'] = np.select([workclass.isin([1.0, 2.0]), workclass.isin([3.0, 4.0, 5.0]), workclass.isin([6.0, 7.0])],
+                                      ["private", "governmental", "self employed"], default="no paid work")
+    return raw_data
 
 
-def bin_marital_status(row):
-    if row['marital status'] in ['Divorced', 'Separated']:
-        return 'Separated'
-    else:
-        return row['marital status']
+def bin_marital_status(raw_data):
+    marital_status = raw_data['marital status'].astype(object)
+    raw_data['marital status'] = marital_status.where(~marital_status.isin(['Divorced', 'Separated']), 'Separated')
+    return raw_data
 
 
-# def bin_race(row):
-#     if row['race'] in ['American Indian and Alaska Native tribes specified;or American Indian or Alaska Native,not specified and no other', 'Alaska Native alone', 'American Indian alone']:
-#         return "American Indian or Alaska Native"
-#     if row['race'] in ['Some Other Race alone', 'Two or More Races']:
-#         return 'One or More Other Races'
-#     return row['race']
+# def bin_race(raw_data):
+#     race = raw_data['race']
+#     american_indian_or_alaska_native = ['American Indian and Alaska Native tribes specified;or American Indian or Alaska Native,not specified and no other', 'Alaska Native alone', 'American Indian alone']
+#     race = race.where(~race.isin(american_indian_or_alaska_native), "American Indian or Alaska Native")
+#     raw_data['race'] = race.where(~race.isin(['Some Other Race alone', 'Two or More Races']), 'One or More Other Races')
+#     return raw_data
 
-def bin_race(row):
-    if row['race'] in ['Black or African American alone', 'White alone']:
-        return row['race']
-    else:
-        return 'Other'
+def bin_race(raw_data):
+    race = raw_data['race'].astype(object)
+    raw_data['race'] = race.where(race.isin(['Black or African American alone', 'White alone']), 'Other')
+    return raw_data
 
 
 def bin_education(raw_data):
@@ -180,76 +172,120 @@ def bin_income(raw_data):
     return raw_data
 
 
-def bin_occupation(row):
-    occupation_mapping = {
-        range(0, 751): "Management/Business",
-        range(800, 961): "Finance/Accounting",
-        range(1005, 1981): "Science, Engineering, Technology",
-        range(2001, 2061): "Counseling/Mental Health Services",
-        range(2100, 2181): "Legal Services",
-        range(2205, 2556): "Education",
-        range(2600, 2921): "Entertainment",
-        range(3000, 3656): "Healthcare/Medical Services",
-        range(3700, 3971): "Protective Services",
-        range(4000, 4656): "Service/Hospitality",
-        range(4700, 4966): "Sales",
-        range(5000, 5941): "Office/Administrative Support",
-        range(6005, 6131): "Farming, Fishing, Forestry",
-        range(6200, 6951): "Construction/Extraction",
-        range(7000, 7641): "Repair/Maintenance",
-        range(7700, 8991): "Production/Assembly",
-        range(9005, 9761): "Transport",
-        range(9800, 9831): "Military Services",
-        range(9920, 9921): "Unemployed"
-    }
+#occupation codes from first code up to and including last code, the codes in between these ranges are "Unemployed"
+OCCUPATION_RANGES = [
+    (0, 750, "Management/Business"),
+    (800, 960, "Finance/Accounting"),
+    (1005, 1980, "Science, Engineering, Technology"),
+    (2001, 2060, "Counseling/Mental Health Services"),
+    (2100, 2180, "Legal Services"),
+    (2205, 2555, "Education"),
+    (2600, 2920, "Entertainment"),
+    (3000, 3655, "Healthcare/Medical Services"),
+    (3700, 3970, "Protective Services"),
+    (4000, 4655, "Service/Hospitality"),
+    (4700, 4965, "Sales"),
+    (5000, 5940, "Office/Administrative Support"),
+    (6005, 6130, "Farming, Fishing, Forestry"),
+    (6200, 6950, "Construction/Extraction"),
+    (7000, 7640, "Repair/Maintenance"),
+    (7700, 8990, "Production/Assembly"),
+    (9005, 9760, "Transport"),
+    (9800, 9830, "Military Services"),
+    (9920, 9920, "Unemployed")
+]
+
+
+#the ranges are sorted, so np.searchsorted finds the only range that can contain a code
+def bin_occupation(raw_data):
+    first_codes = np.array([first_code for first_code, _, _ in OCCUPATION_RANGES])
+    last_codes = np.array([last_code for _, last_code, _ in OCCUPATION_RANGES])
+    occupation_labels = np.array([label for _, _, label in OCCUPATION_RANGES] + ["Unemployed"], dtype=object)
+
+    occupation_codes = raw_data['occupation'].to_numpy(dtype=np.float64)
+    range_of_code = np.searchsorted(first_codes, occupation_codes, side='right') - 1
+    #codes that are missing, not whole numbers or fall between two ranges get the "Unemployed" label at the end
+    code_is_in_range = (range_of_code >= 0) & (occupation_codes <= last_codes[np.maximum(range_of_code, 0)]) & \
+                       (occupation_codes == np.floor(occupation_codes))
+    range_of_code[~code_is_in_range] = len(OCCUPATION_RANGES)
+    raw_data['occupation'] = occupation_labels[range_of_code]
+    return raw_data
 
-    for key, value in occupation_mapping.items():
-        if row['occupation'] in key:
-            return value
 
-    return "Unemployed"
+INCOME_FEATURE_NAMES = ['AGEP','COW', 'SCHL', 'MAR','OCCP','WKHP','SEX','RAC1P', 'ENG', 'FER']
+#the columns that folktables.adult_filter needs on top of the features
+INCOME_FILTER_COLUMNS = ['PINCP', 'PWGTP']
+INCOME_RENAMED_FEATURES_DICT = {'AGEP': 'age', 'COW': 'workclass', 'SCHL': 'education',
+                                'MAR': 'marital status', 'OCCP': 'occupation', 'POBP': 'place of birth',
+                                'WKHP': 'workinghours', 'SEX': 'sex', 'RAC1P': 'race',
+                                'ENG': 'ability to speak english', 'FER': 'gave birth this year'
+                                }
+INCOME_SAMPLE_COLUMNS = ['age', 'age_num', 'marital status', 'workinghours', 'workinghours_num', 'education', 'education_num',
+                         'workclass', 'occupation', 'race', 'sex', 'income']
 
 
-def prepare_income_prediction_data(sample_size = 20000):
+def create_income_prediction_task():
     #'AGEP','COW', 'SCHL', 'MAR','OCCP','POBP','RELP','WKHP','SEX','RAC1P',
-    feature_names = ['AGEP','COW', 'SCHL', 'MAR','OCCP','WKHP','SEX','RAC1P', 'ENG', 'FER']
-    renamed_features_dict = {'AGEP': 'age', 'COW': 'workclass', 'SCHL': 'education',
-                             'MAR': 'marital status', 'OCCP': 'occupation', 'POBP': 'place of birth',
-                             'WKHP': 'workinghours', 'SEX': 'sex', 'RAC1P': 'race',
-                             'ENG': 'ability to speak english', 'FER': 'gave birth this year'
-                             }
-
-    ACSIncomePredictionTask = folktables.BasicProblem(
-        features=feature_names,
+    return folktables.BasicProblem(
+        features=INCOME_FEATURE_NAMES,
         target='PINCP',  #PINCP stands for total person's income
         target_transform=lambda x: x > 50000,
         group='RAC1P',
         preprocess=folktables.adult_filter,
     )
 
-    data_source = ACSDataSource(survey_year='2018', horizon='1-Year', survey='person')
-    al_data = data_source.get_data(states=["AL"], download=True)
-    raw_data, labels, _ = ACSIncomePredictionTask.df_to_pandas(al_data, categories=ACS_categories)
+
+def preprocess_income_data(acs_data):
+    raw_data, labels, _ = create_income_prediction_task().df_to_pandas(acs_data, categories=ACS_categories)
     raw_data['income'] = labels
 
-    raw_data = raw_data.rename(columns=renamed_features_dict)
+    raw_data = raw_data.rename(columns=INCOME_RENAMED_FEATURES_DICT)
 
     raw_data = bin_education(raw_data)
     raw_data = bin_age(raw_data)
     raw_data = bin_workinghours(raw_data)
 
-    raw_data['workclass'] = raw_data.apply(lambda  row: bin_workclass(row), axis=1)
-    raw_data['marital status'] = raw_data.apply(lambda row: bin_marital_status(row), axis=1)
-    raw_data['occupation'] = raw_data.apply(lambda row: bin_occupation(row), axis=1)
-    raw_data['race'] = raw_data.apply(lambda row: bin_race(row), axis=1)
-    raw_data['income'] = raw_data.apply(lambda row: change_income_label_names(row), axis=1)
+    raw_data = bin_workclass(raw_data)
+    raw_data = bin_marital_status(raw_data)
+    raw_data = bin_occupation(raw_data)
+    raw_data = bin_race(raw_data)
+    raw_data = change_income_label_names(raw_data)
+    return raw_data
+
+
+#the prepared data is written to a parquet file (this needs pyarrow), which can be read with ColumnStorage.ParquetStorage
+def prepare_income_prediction_data(sample_size = 20000, output_path = 'income_sample.parquet'):
+    data_source = ACSDataSource(survey_year='2018', horizon='1-Year', survey='person')
+    al_data = data_source.get_data(states=["AL"], download=True)
+    raw_data = preprocess_income_data(al_data)
 
     raw_data_sample = raw_data.sample(n=sample_size, random_state=7)
-    numerical_and_descriptive_dataframe = raw_data_sample[
-        ['age', 'age_num', 'marital status', 'workinghours', 'workinghours_num', 'education', 'education_num', 'workclass', 'occupation', 'race',
-         'sex', 'income']]
-    numerical_and_descriptive_dataframe.to_csv('income_sample.csv')
+    numerical_and_descriptive_dataframe = raw_data_sample[INCOME_SAMPLE_COLUMNS]
+    write_columnar_file(numerical_and_descriptive_dataframe, output_path)
 
     return numerical_and_descriptive_dataframe
 
 
+#state_files are locally stored ACS PUMS person files (csv), one per state, e.g. the files folktables downloads.
+#Every state is preprocessed in its own process, afterwards all states are written to one parquet file
+def prepare_income_prediction_data_for_states(state_files, output_path = 'income_data.parquet', n_processes = None, sample_size = None):
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        data_per_state = list(executor.map(preprocess_income_state_file, state_files))
+
+    raw_data = pd.concat(data_per_state, ignore_index=True)
+    if sample_size is not None:
+        raw_data = raw_data.sample(n=sample_size, random_state=7).reset_index(drop=True)
+    write_columnar_file(raw_data, output_path)
+
+    return raw_data
+
+
+def preprocess_income_state_file(state_file):
+    used_columns = set(INCOME_FEATURE_NAMES + INCOME_FILTER_COLUMNS)
+    acs_data = pd.read_csv(state_file, usecols=lambda column: column in used_columns)
+    raw_data = preprocess_income_data(acs_data)
+    return raw_data[INCOME_SAMPLE_COLUMNS]
+
+
+def write_columnar_file(data, output_path):
+    data.to_parquet(output_path, index=False)
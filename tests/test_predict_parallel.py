@@ -0,0 +1,93 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#predict_parallel and concurrent calls of predict on one fitted IFAC have to give the same result as serial predict
+#run from the root of the repository: python -m pytest tests
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_ROOT)
+
+from load_datasets import load_income_data
+from IFAC import IFAC
+from IFAC.Reject import convert_decision_to_dict
+
+
+@pytest.fixture(scope='module')
+def fitted_ifac_and_test_data():
+    current_directory = os.getcwd()
+    os.chdir(REPOSITORY_ROOT)
+    try:
+        dataset = load_income_data(use_cache=False)
+    finally:
+        os.chdir(current_directory)
+    train_data, test_data = dataset.split_into_train_test(0.1, random_state=0)
+    np.random.seed(0)
+    ifac = IFAC(coverage=0.7, fairness_weight=1.0, val1_ratio=0.2, val2_ratio=0.2, base_classifier='Decision Tree',
+                base_classifier_kwargs={'random_state': 0, 'max_depth': 8})
+    ifac.fit(train_data.create_view(np.arange(6000)))
+    return ifac, test_data.create_view(np.arange(600))
+
+
+#the decisions in the order and with the index of the predictions, and the flips with their index
+def describe_predictions(predictions, flips):
+    flip_per_row = dict(zip(flips.index, flips))
+    decisions = [(row, convert_decision_to_dict(prediction, flip_per_row.get(row))) for row, prediction in zip(predictions.index, predictions)]
+    return decisions, list(flips.index)
+
+
+#positions of test rows that are covered by a reject rule and of rows that are not
+def split_rows_by_rule_coverage(ifac, test_data):
+    test_data_with_preds = ifac.make_preds_and_preds_proba_for_data(test_data)
+    test_data_covered_by_rules, _ = ifac.extract_data_falling_under_rules(test_data_with_preds)
+    covered = test_data_with_preds.index.isin(test_data_covered_by_rules.index)
+    return np.flatnonzero(covered), np.flatnonzero(~covered)
+
+
+def test_predict_parallel_equals_predict(fitted_ifac_and_test_data):
+    ifac, test_data = fitted_ifac_and_test_data
+    expected = describe_predictions(*ifac.predict(test_data))
+    for n_threads in [2, 3, 7]:
+        assert describe_predictions(*ifac.predict_parallel(test_data, n_threads=n_threads)) == expected
+
+
+def test_predict_parallel_with_more_threads_than_rows(fitted_ifac_and_test_data):
+    ifac, test_data = fitted_ifac_and_test_data
+    covered_rows, uncovered_rows = split_rows_by_rule_coverage(ifac, test_data)
+    assert len(covered_rows) != 0 and len(uncovered_rows) >= 2
+    #every row becomes a shard of its own, two of the shards have no rows that fall under a reject rule
+    small_test_data = test_data.create_view(np.array([uncovered_rows[0], covered_rows[0], uncovered_rows[1]]))
+    expected = describe_predictions(*ifac.predict(small_test_data))
+    assert describe_predictions(*ifac.predict_parallel(small_test_data, n_threads=8)) == expected
+
+
+def test_predict_parallel_without_rows_under_reject_rules(fitted_ifac_and_test_data):
+    ifac, test_data = fitted_ifac_and_test_data
+    _, uncovered_rows = split_rows_by_rule_coverage(ifac, test_data)
+    uncovered_test_data = test_data.create_view(uncovered_rows[:20])
+    expected = describe_predictions(*ifac.predict(uncovered_test_data))
+    assert describe_predictions(*ifac.predict_parallel(uncovered_test_data, n_threads=4)) == expected
+
+
+def test_concurrent_predict_on_one_model(fitted_ifac_and_test_data):
+    ifac, test_data = fitted_ifac_and_test_data
+    batches = [test_data.create_view(np.arange(start, start + 150)) for start in range(0, 600, 150)]
+    expected = [describe_predictions(*ifac.predict(batch)) for batch in batches]
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        #every batch is predicted twice, so that the threads overlap
+        results = list(executor.map(lambda batch: describe_predictions(*ifac.predict(batch)), batches + batches))
+    assert results == expected + expected